@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Miller et al. (2008) platform motion rotation of
+``process_micromet.sonic.correct_wind``: the closed-form rotation matrices of
+``sonic.rotation_matrices`` applied with a single einsum, against the
+per-sample loop it replaced (``sonic.rotate`` before 1e6ed3a, reproduced in
+``loop_rotation``).
+
+A synthetic 10 Hz half-hour (18,000 samples by default) of roll, pitch, yaw,
+linear accelerations, angular rates and wind components is generated with
+NumPy. Both rotations must agree to ``--tolerance``; they are then timed.
+
+Examples
+--------
+    python benchmarks/sonic_rotation.py
+    python benchmarks/sonic_rotation.py --samples 36000 --repeat 3
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from process_micromet import sonic  # noqa: E402
+
+# Timestep (s), distance between accelerometer and IRGASON (m) and
+# gravitational constant, as in sonic.correct_wind
+DT = 0.1
+IRGA_ACC_DIST = np.array([0.85, -0.1, 0.1])
+G = 9.80665
+
+
+def half_hour(n_samples, seed=0):
+    """
+    Synthetic motion and wind of a buoy-mounted sonic anemometer.
+
+    Returns
+    -------
+    phi, theta, psi : numpy.ndarray
+        Roll (around 0 once set back from -pi), pitch and yaw (rad).
+    lin_acc : numpy.ndarray
+        Linear accelerations without gravity (m/s²), shape (n, 3).
+    ang_rate : numpy.ndarray
+        Angular rates (rad/s), shape (n, 3).
+    u : numpy.ndarray
+        Measured wind components (m/s), shape (n, 3).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) * DT
+    # Wave motion of a few seconds period, with noise
+    phi = 0.1 * np.sin(2 * np.pi * t / 4) + rng.normal(0, 0.01, n_samples)
+    theta = 0.08 * np.sin(2 * np.pi * t / 5 + 1) + rng.normal(0, 0.01, n_samples)
+    psi = 0.5 + 0.05 * np.sin(2 * np.pi * t / 30) + rng.normal(0, 0.01, n_samples)
+    lin_acc = rng.normal(0, 0.05, (n_samples, 3)) * G
+    ang_rate = rng.normal(0, 0.1, (n_samples, 3))
+    u = np.column_stack([rng.normal(5, 1, n_samples),
+                         rng.normal(0, 1, n_samples),
+                         rng.normal(0, 0.3, n_samples)])
+    return phi, theta, psi, lin_acc, ang_rate, u
+
+
+def loop_rotation(phi, theta, psi, lin_acc, ang_rate, u):
+    """
+    Rotation sample by sample, as in ``sonic.rotate`` before 1e6ed3a.
+    """
+    u_corr = np.empty(u.shape)
+    for i in range(len(phi)):
+        # x-axis rotation (roll)
+        phi_ = np.array([
+            [1, 0, 0],
+            [0, np.cos(phi[i]), -np.sin(phi[i])],
+            [0, np.sin(phi[i]), np.cos(phi[i])]
+            ])
+
+        # y-axis rotation (pitch)
+        theta_ = np.array([
+            [np.cos(theta[i]), 0, np.sin(theta[i])],
+            [0, 1, 0],
+            [-np.sin(theta[i]), 0, np.cos(theta[i])]
+            ])
+
+        # z-axis rotation (yaw)
+        psi_ = np.array([
+            [np.cos(psi[i]), -np.sin(psi[i]), 0],
+            [np.sin(psi[i]), np.cos(psi[i]), 0],
+            [0, 0, 1],
+            ])
+
+        T_ = psi_ @ theta_ @ phi_
+
+        u_corr[i,:] = T_ @ (u[i,:] + lin_acc[i,:] * DT + ang_rate[i,:] * IRGA_ACC_DIST)
+    return u_corr
+
+
+def vectorized_rotation(phi, theta, psi, lin_acc, ang_rate, u):
+    """
+    Rotation of all samples at once, as in ``sonic.correct_wind``.
+    """
+    T_ = sonic.rotation_matrices(phi, theta, psi)
+    return np.einsum('nij,nj->ni', T_, u + lin_acc * DT + ang_rate * IRGA_ACC_DIST)
+
+
+def best_time(func, args, repeat):
+    """
+    Best wall time of ``repeat`` calls, after a warm-up call.
+    """
+    func(*args)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=18000,
+                        help='Number of 10 Hz samples (default: 18000, a half-hour)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls (default: 5)')
+    parser.add_argument('--tolerance', type=float, default=1e-12,
+                        help='Maximum absolute difference of the wind components '
+                             '[m/s] (default: 1e-12)')
+    args = parser.parse_args()
+
+    data = half_hour(args.samples)
+    expected = loop_rotation(*data)
+    result = vectorized_rotation(*data)
+    max_diff = np.max(np.abs(result - expected))
+    same = max_diff <= args.tolerance
+    print(f'{args.samples} samples: wind components {"agree" if same else "DIFFER"} '
+          f'(max absolute difference {max_diff:.1e} m/s)')
+
+    t_loop = best_time(loop_rotation, data, args.repeat)
+    t_vectorized = best_time(vectorized_rotation, data, args.repeat)
+
+    print(f'\nBest of {args.repeat}:')
+    print(f'  per-sample loop: {t_loop:.3f} s')
+    print(f'  rotation_matrices + einsum: {t_vectorized * 1000:.1f} ms '
+          f'({t_loop / t_vectorized:.0f}x faster)')
+    sys.exit(0 if same else 1)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of ``utils.data_loader.tob3_first_last_timestamp`` against a
+reference implementation taken from the git history (by default, the one
+before the single memory-mapped scan of the TOB3 frames).
+
+Synthetic 10 Hz TOB3 files are generated with NumPy, one for each case the
+function has to handle (invalid frames, empty frames, minor frames, stray
+frames left by a ring wrap, far future frames, header start mismatch,
+trailing partial frame). The outputs of both implementations must be
+identical on every case; the scan is then timed on the largest file, with a
+warm page cache.
+
+Examples
+--------
+    python benchmarks/tob3_first_last_timestamp.py
+    python benchmarks/tob3_first_last_timestamp.py --frames 20000 --repeat 3
+    python benchmarks/tob3_first_last_timestamp.py --reference HEAD~5
+"""
+import argparse
+import datetime as dt
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from utils import data_loader as dl  # noqa: E402
+
+EPOCH = dt.datetime(1990, 1, 1)
+VALIDATION = 0x1234
+INTERVAL_S = 0.1
+N_FIELDS = 20
+FIELD_SIZE = 4
+
+
+def reference_loader(rev):
+    """
+    Import ``utils/data_loader.py`` as it is at the git revision ``rev``.
+    """
+    source = subprocess.run(['git', 'show', f'{rev}:utils/data_loader.py'], cwd=ROOT,
+                            check=True, capture_output=True, text=True).stdout
+    module = types.ModuleType('data_loader_reference')
+    module.__file__ = f'{rev}:utils/data_loader.py'
+    exec(compile(source, module.__file__, 'exec'), module.__dict__)
+    return module
+
+
+def header_lines(header_start, frame_size, intended):
+    """
+    6-line ASCII header of a TOB3 file of IEEE4 fields.
+    """
+    names = [f'v{i}' for i in range(N_FIELDS)]
+    return [
+        f'"TOB3","stn","CR3000","1234","CR3000.Std.32","CPU:prog.CR3","5678",'
+        f'"{header_start:%Y-%m-%d %H:%M:%S}"',
+        f'"ts_data","100 MSEC","{frame_size}","{intended}","{VALIDATION}",'
+        f'"Sec100Usec","0","0","0"',
+        ','.join(f'"{n}"' for n in names),
+        ','.join('"u"' for _ in names),
+        ','.join('"Smp"' for _ in names),
+        ','.join('"IEEE4"' for _ in names),
+    ]
+
+
+def frame_fields(start, first_record, n_records):
+    """
+    (sec, sub) header fields of frames of ``n_records`` records starting at
+    record ``first_record`` of a table starting at ``start``.
+    """
+    t_us = (int((start - EPOCH).total_seconds() * 1_000_000)
+            + np.asarray(first_record, dtype=np.int64) * int(INTERVAL_S * 1_000_000))
+    return t_us // 1_000_000, (t_us % 1_000_000) // 100
+
+
+def make_tob3(path, n_frames, frame_size=4096, start=dt.datetime(2023, 7, 1, 0, 0, 0, 100000),
+              header_start=None, invalid=(), empty=(), minor=(), stray=(), future=(),
+              trailing=3, seed=0):
+    """
+    Write a synthetic 10 Hz TOB3 file.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        File to write.
+    n_frames : int
+        Number of major frames.
+    frame_size : int, optional
+        Size of the major frames [bytes].
+    start : datetime.datetime, optional
+        Timestamp of the first record.
+    header_start : datetime.datetime, optional
+        Table start time of the header. The default is ``start``.
+    invalid, empty, minor, stray, future : sequence of int, optional
+        Frames with a wrong validation stamp, flagged empty, split in two
+        minor frames, left over from a ring wrap one year earlier, or
+        stamped ten years ahead.
+    trailing : int, optional
+        Number of bytes of a trailing partial frame.
+    seed : int, optional
+        Seed of the random values of the records.
+    """
+    n_records = (frame_size - 16) // (N_FIELDS * FIELD_SIZE)
+    rng = np.random.default_rng(seed)
+    frames = rng.normal(0, 1, (n_frames, frame_size // 4)).astype('<f4').view('<u4')
+
+    records = np.arange(n_frames, dtype=np.int64) * n_records
+    sec, sub = frame_fields(start, records, n_records)
+    frames[:, 0], frames[:, 1], frames[:, 2] = sec, sub, records
+    frames[:, -1] = VALIDATION << 16
+
+    for i in invalid:
+        frames[i, -1] = 0x0BAD << 16
+    for i in empty:
+        frames[i, -1] |= 1 << 14
+    for i in stray:
+        frames[i, 0] -= 365 * 86400
+    for i in future:
+        frames[i, 0] += 3650 * 86400
+    for i in minor:
+        # Two minor frames of half the size, each with its header and footer
+        half = frame_size // 2
+        n_half = (half - 16) // (N_FIELDS * FIELD_SIZE)
+        for k in range(2):
+            rec = records[i] + k * n_half
+            words = slice(k * half // 4, (k + 1) * half // 4)
+            frame = frames[i, words]
+            frame[0], frame[1] = (int(x) for x in frame_fields(start, rec, n_half))
+            frame[2] = rec
+            frame[-1] = (VALIDATION << 16) | (1 << 15) | half
+
+    intended = n_frames * n_records
+    lines = header_lines(header_start or start, frame_size, intended)
+    with open(path, 'wb') as f:
+        f.write(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+        f.write(frames.tobytes())
+        f.write(b'\x01' * trailing)
+    return path
+
+
+def cases(folder, n_frames):
+    """
+    Synthetic files covering the cases handled by the scan.
+    """
+    n = min(n_frames, 2000)
+    start = dt.datetime(2023, 7, 1, 0, 0, 0, 100000)
+    yield 'clean', make_tob3(folder / 'clean.dat', n)
+    yield 'invalid frames', make_tob3(folder / 'invalid.dat', n, invalid=[0, 5, n - 1])
+    yield 'empty frames', make_tob3(folder / 'empty.dat', n, empty=[1, n // 2, n - 1])
+    yield 'minor frames', make_tob3(folder / 'minor.dat', n, minor=[0, 3, n - 1])
+    yield 'ring wrap leftovers', make_tob3(folder / 'stray.dat', n, stray=[0, 1, 2])
+    yield 'future frames', make_tob3(folder / 'future.dat', n, future=[n - 2, n - 1])
+    yield 'header start mismatch', make_tob3(
+        folder / 'mismatch.dat', n, header_start=start + dt.timedelta(days=5))
+    yield 'no trailing bytes', make_tob3(folder / 'trailing.dat', n, trailing=0)
+    yield 'single frame', make_tob3(folder / 'single.dat', 1)
+    yield 'header only', make_tob3(folder / 'header.dat', 0, trailing=0)
+    (folder / 'empty_file.dat').touch()
+    yield 'empty file', folder / 'empty_file.dat'
+    yield f'large ({n_frames} frames)', make_tob3(
+        folder / 'large.dat', n_frames, invalid=[10], stray=[0], future=[n_frames - 1])
+
+
+def best_time(func, file, repeat):
+    """
+    Best wall time of ``repeat`` calls, after a warm-up call.
+    """
+    func(file)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(file)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=80000,
+                        help='Number of 4 kB frames of the large file (default: 80000, '
+                             'about 330 MB)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls (default: 5)')
+    parser.add_argument('--reference', default='0d8a2a9^',
+                        help='Git revision of the reference implementation '
+                             '(default: 0d8a2a9^, before the memory-mapped scan)')
+    args = parser.parse_args()
+
+    reference = reference_loader(args.reference)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mismatches = 0
+        for name, file in cases(Path(tmp_dir), args.frames):
+            expected = reference.tob3_first_last_timestamp(file)
+            result = dl.tob3_first_last_timestamp(file)
+            same = result == expected
+            mismatches += not same
+            print(f'{name:<24} {"identical" if same else "DIFFERENT"}: {result}'
+                  + ('' if same else f' (reference: {expected})'))
+
+        size = file.stat().st_size / 1e6
+        t_reference = best_time(reference.tob3_first_last_timestamp, file, args.repeat)
+        t_current = best_time(dl.tob3_first_last_timestamp, file, args.repeat)
+
+    print(f'\n{size:.0f} MB file, best of {args.repeat}:')
+    print(f'  reference ({args.reference}): {t_reference:.3f} s')
+    print(f'  current: {t_current:.3f} s ({t_reference / t_current:.0f}x faster)')
+    sys.exit(1 if mismatches else 0)
@@ -26,4 +26,7 @@ eddyproConfigDir    = Path("./Config/EddyProConfig/")
 gapfillConfigDir    = Path("./Config/GapFillingConfig/")
 filterConfigDir     = Path("./Config/Filtering/")
 gasAnalyzerConfigDir    = Path("./Config/Gas_analyzer/")
-reanalysisConfigDir = Path("./Config/Reanalysis/")
\ No newline at end of file
+reanalysisConfigDir = Path("./Config/Reanalysis/")
+# Columnar archive of the 10 Hz data, stored instead of the _eddy.csv files
+# (see process_micromet.hf_archive). None to write _eddy.csv files
+hfArchiveDir        = None
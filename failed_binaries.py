@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+List or clear the Campbell binary files that failed to be read or converted.
+Failed files are skipped by the workflow until they change on disk.
+
+Examples
+--------
+    python failed_binaries.py                  # list failures of all stations
+    python failed_binaries.py Berge            # list failures of one station
+    python failed_binaries.py Berge --clear    # try all of them again
+    python failed_binaries.py Berge --clear D:/.../ts_data_1.dat
+"""
+import argparse
+import pandas as pd
+import data_paths as path
+from process_micromet import csbinary_to_csv
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('stations', nargs='*', default=list(path.station_name_conversion),
+                    help='Stations, as named in the ascii data (default: all)')
+parser.add_argument('--clear', nargs='*', metavar='FILE',
+                    help='Forget the failures of the given files, or of all files')
+args = parser.parse_args()
+
+for station in args.stations:
+    station_name_raw = path.station_name_conversion[station]
+
+    if args.clear is not None:
+        csbinary_to_csv.clear_failures(station_name_raw, args.clear or None)
+        print(f'{station}: failures cleared')
+        continue
+
+    failures = csbinary_to_csv.list_failures(station_name_raw)
+    print(f'{station}: {len(failures)} failed file(s)')
+    if not failures.empty:
+        with pd.option_context('display.max_colwidth', None, 'display.width', None):
+            print(failures[['failed_at', 'stage', 'reason', 'path']].to_string(index=False))
@@ -1,3 +1,4 @@
+from functools import partial
 import process_micromet as pm
 import data_paths as path
 from utils import data_loader as dl, dataframe_manager as dfm
@@ -33,12 +34,18 @@ for iStation in gapfilledStation:
     pm.reanalysis.retrieve( reanalysis_config['era5-land'], dates, path.reanalysisDir)
     pm.reanalysis.retrieve( reanalysis_config['era5'], dates, path.reanalysisDir)
 
+# List the binary files of all stations at once
+raw_files = pm.csbinary_to_csv.list_raw_files(path.rawFileDir)
+
 for iStation in CampbellStations:
 
     # Binary to ascii
     unconverted_files = pm.csbinary_to_csv.find_unconverted_files(path.station_name_conversion[iStation],iStation,
-                                path.rawFileDir,path.asciiOutDir)
-    pm.csbinary_to_csv.convert(iStation, path.asciiOutDir, unconverted_files)
+                                path.rawFileDir,path.asciiOutDir,raw_files=raw_files,
+                                archive_dir=path.hfArchiveDir)
+    pm.csbinary_to_csv.convert(iStation, path.asciiOutDir, unconverted_files,
+                                station_name_raw=path.station_name_conversion[iStation],
+                                archive_dir=path.hfArchiveDir)
 
     # List slow files
     slow_files = dfm.list_files(iStation, '*slow.csv', path.asciiOutDir)
@@ -52,16 +59,24 @@ for iStation in CampbellStations:
     # First filter
     df = pm.filters.remove_by_variable_and_date(df, path.filterConfigDir, f"{iStation}_erroneous_variables")
 
-    # Correct raw concentrations
+    # Correct raw concentrations and rotate wind, in a single pass over
+    # the 10 Hz files
+    hf_transforms = []
+    hf_suffix = '_eddy_corr.csv'
     if iStation in eddyCovStations:
         gas_analyzer_info = dl.yaml_file(path.gasAnalyzerConfigDir, f"{iStation}_gas_analyzer")
         corr_coeff = pm.gas_analyzer.get_correction_coeff(df,gas_analyzer_info,iStation)
-        uncorrected_files = pm.gas_analyzer.find_uncorrected_files(path.asciiOutDir.joinpath(iStation))
-        pm.gas_analyzer.correct_densities(iStation, corr_coeff, uncorrected_files)
-    # Rotate wind
+        hf_transforms.append(partial(pm.gas_analyzer.correct_h2o, corr_factors=corr_coeff))
     if iStation == 'Reservoir':
-        unrotated_files = pm.sonic.find_unrotated_files(path.asciiOutDir.joinpath(iStation))
-        pm.sonic.rotate(iStation,unrotated_files)
+        # Rotated files, as in the file_prototype of the EddyPro project
+        hf_transforms.append(pm.sonic.correct_wind)
+        hf_suffix = '_eddy_corr_rot.csv'
+    if hf_transforms:
+        uncorrected_files = pm.gas_analyzer.find_uncorrected_files(
+            path.asciiOutDir.joinpath(iStation), suffix=hf_suffix,
+            archive_dir=path.hfArchiveDir)
+        pm.hf_transforms.run(iStation, uncorrected_files, hf_transforms, suffix=hf_suffix,
+                             archive_dir=path.hfArchiveDir)
 
 
     if iStation in eddyCovStations:
@@ -1,3 +1,4 @@
+from functools import partial
 from joblib import Parallel, delayed
 import process_micromet as pm
 import data_paths as path
@@ -36,12 +37,15 @@ def parallel_function_0(dates, path):
         pm.reanalysis.retrieve( reanalysis_config['era5'], dates, path.reanalysisDir)
 
 
-def parallel_function_1(iStation, path):
+def parallel_function_1(iStation, path, raw_files):
 
     # Binary to ascii
     unconverted_files = pm.csbinary_to_csv.find_unconverted_files(path.station_name_conversion[iStation],iStation,
-                                path.rawFileDir,path.asciiOutDir)
-    pm.csbinary_to_csv.convert(iStation, path.asciiOutDir, unconverted_files)
+                                path.rawFileDir,path.asciiOutDir,raw_files=raw_files,
+                                archive_dir=path.hfArchiveDir)
+    pm.csbinary_to_csv.convert(iStation, path.asciiOutDir, unconverted_files,
+                               station_name_raw=path.station_name_conversion[iStation],
+                               archive_dir=path.hfArchiveDir)
     # List slow files
     slow_files = dfm.list_files(iStation, '*slow.csv', path.asciiOutDir)
     # Create reference dataframe and merge slow files
@@ -52,16 +56,24 @@ def parallel_function_1(iStation, path):
     df = pm.names.rename_trim(iStation, df, db_name_map)
     df = pm.filters.remove_by_variable_and_date(df, path.filterConfigDir, f"{iStation}_erroneous_variables")
 
-    # Correct raw concentrations
+    # Correct raw concentrations and rotate wind, in a single pass over
+    # the 10 Hz files
+    hf_transforms = []
+    hf_suffix = '_eddy_corr.csv'
     if iStation in eddyCovStations:
         gas_analyzer_info = dl.yaml_file(path.gasAnalyzerConfigDir, f"{iStation}_gas_analyzer")
         corr_coeff = pm.gas_analyzer.get_correction_coeff(df,gas_analyzer_info,iStation)
-        uncorrected_files = pm.gas_analyzer.find_uncorrected_files(path.asciiOutDir.joinpath(iStation))
-        pm.gas_analyzer.correct_densities(iStation, corr_coeff, uncorrected_files)
-    # Rotate wind
+        hf_transforms.append(partial(pm.gas_analyzer.correct_h2o, corr_factors=corr_coeff))
     if iStation == 'Reservoir':
-        unrotated_files = pm.sonic.find_unrotated_files(path.asciiOutDir.joinpath(iStation))
-        pm.sonic.rotate(iStation,unrotated_files)
+        # Rotated files, as in the file_prototype of the EddyPro project
+        hf_transforms.append(pm.sonic.correct_wind)
+        hf_suffix = '_eddy_corr_rot.csv'
+    if hf_transforms:
+        uncorrected_files = pm.gas_analyzer.find_uncorrected_files(
+            path.asciiOutDir.joinpath(iStation), suffix=hf_suffix,
+            archive_dir=path.hfArchiveDir)
+        pm.hf_transforms.run(iStation, uncorrected_files, hf_transforms, suffix=hf_suffix,
+                             archive_dir=path.hfArchiveDir)
 
 
 
@@ -148,8 +160,11 @@ def parallel_function_4(iStation, path):
 
 parallel_function_0(dates, path)
 
+# List the binary files of all stations at once
+raw_files = pm.csbinary_to_csv.list_raw_files(path.rawFileDir)
+
 Parallel(n_jobs=len(CampbellStations))(delayed(parallel_function_1)(
-    iStation, path)for iStation in CampbellStations)
+    iStation, path, raw_files)for iStation in CampbellStations)
 
 Parallel(n_jobs=len(CampbellStations))(delayed(parallel_function_2)(
         iStation, path)for iStation in CampbellStations)
@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 
 from .compute_storage_flux import compute_storage_flux #noqa
+from . import cospectra #noqa
 from . import csbinary_to_csv #noqa
 from .correct_ernergy_balance import correct_energy_balance #noqa
 from . import eddypro #noqa
 from . import filters #noqa
+from . import flux_engine #noqa
 from . import footprint #noqa
 from . import gap_fill_flux #noqa
 from . import gap_fill_slow_data #noqa
 from . import gas_analyzer #noqa
 from .handle_exception import handle_exception #noqa
+from . import hf_loader #noqa
+from . import hf_transforms #noqa
 from . import ml_utils #noqa
 from . import thermistors #noqa
+from . import time_lag #noqa
 from . import names #noqa
+from . import planar_fit #noqa
 from .merge_eddycov_stations import merge_eddycov_stations #noqa
 from . import reanalysis #noqa
 from . import precipitation_gauge #noqa
-from . import sonic #noqa
\ No newline at end of file
+from . import sonic #noqa
+from . import statistical_tests #noqa
\ No newline at end of file
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Ensemble spectra, cospectra and ogives of the 10 Hz data, binned in
+log-spaced frequency bands and averaged by stability class and wind sector.
+
+Half-hours are loaded in batches (see ``flux_engine.load_batch``), rotated
+(double rotation), detrended and lagged as for the fluxes, and each series
+gets one real FFT per half-hour. The binned (co)spectra are added to an accumulator holding
+sums and counts per stability class, wind sector, series and frequency band,
+so that the memory used does not depend on the length of the period::
+
+    acc = cospectra.run(station, csv_folder, eddypro_config_dir, dates,
+                        n_workers=4)
+    df = cospectra.ensemble(acc)
+
+Series are normalized so that their ensemble averages can be compared with
+model cospectra: f * Co_wx(f) / cov(w, x) for the cospectra, f * S_x(f) /
+var(x) for the spectra and Og_wx(f) / cov(w, x) for the ogives, where the
+ogive at f is the cumulative cospectrum from the Nyquist frequency down to f.
+Missing samples are set to the mean of the series. No taper is applied.
+"""
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from . import eddypro
+from . import flux_engine as fe
+from . import time_lag
+
+# Bounds of the stability classes, on (z-d)/L
+STABILITY_BOUNDS = (-1, -0.1, -0.01, 0.01, 0.1, 1)
+
+
+def run(station_name, csv_folder, eddypro_config_dir, dates, frequency='natural',
+        n_bins=50, stability_bounds=STABILITY_BOUNDS, n_sectors=4,
+        min_correlation=0.05, batch_size=48, n_workers=1):
+    """
+    Accumulate the ensemble spectra, cospectra and ogives of a station over a
+    date range, with the EddyPro configuration of each half-hour.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    csv_folder : pathlib.Path
+        Directory of the 10 Hz files, one subdirectory per station.
+    eddypro_config_dir : pathlib.Path
+        Directory of the .eddypro and .metadata files.
+    dates : dict
+        'start' and 'end' of the date range.
+    frequency : str, optional
+        'natural' to bin the frequencies [Hz], or 'normalized' to bin
+        f * (z - d) / u. The default is 'natural'.
+    n_bins : int, optional
+        Number of log-spaced frequency bands. The default is 50.
+    stability_bounds : sequence of float, optional
+        Bounds of the stability classes on (z-d)/L. The default is
+        ``STABILITY_BOUNDS``.
+    n_sectors : int, optional
+        Number of wind sectors of equal width, the first one starting from
+        north. The default is 4.
+    min_correlation : float, optional
+        Cospectra and ogives of half-hours where the absolute correlation of
+        w and the scalar is below this value are not accumulated, as their
+        normalization by the covariance is unstable. The default is 0.05.
+    batch_size : int, optional
+        Number of half-hours loaded and processed together. The default is
+        48 (one day).
+    n_workers : int, optional
+        Number of worker processes. Each returns the accumulator of its
+        batch, added to the total by the calling process. The default is 1
+        (serial).
+
+    Returns
+    -------
+    acc : dict
+        Accumulator (see ``new_accumulator``), without series nor frequency
+        bands if no 10 Hz file is found in the date range.
+    """
+    print(f'Start computing the cospectra of the {station_name} station')
+
+    timestamps = pd.date_range(dates['start'], dates['end'], freq='30min')
+
+    options = {'frequency': frequency, 'n_bins': n_bins,
+               'stability_bounds': stability_bounds, 'n_sectors': n_sectors,
+               'min_correlation': min_correlation}
+    acc = None
+    for config, settings, config_timestamps, results in fe.map_configs(
+            station_name, csv_folder, eddypro_config_dir, timestamps,
+            batch_cospectra, (options,), batch_size, n_workers):
+
+        edges = frequency_edges(settings, frequency, n_bins)
+        if acc is None:
+            acc = new_accumulator(series_names(settings), edges,
+                                  stability_bounds, n_sectors, frequency)
+        elif not np.allclose(acc['edges'], edges):
+            raise ValueError(f'{config["path"].name}: frequency bands differ from '
+                             'the previous configurations (acquisition frequency '
+                             'or averaging length)')
+
+        n_batches = int(np.ceil(len(config_timestamps) / batch_size))
+        for batch_acc in tqdm(results, total=n_batches,
+                              desc=f'{station_name}: Cospectra'):
+            add(acc, batch_acc)
+
+    if acc is None:
+        # No 10 Hz file in the date range
+        acc = new_accumulator([], [], stability_bounds, n_sectors, frequency)
+
+    print('Done!')
+    return acc
+
+
+def series_names(settings):
+    """
+    Names of the series accumulated for a configuration: spectra of w, ts and
+    the gases, cospectra and ogives of w with ts and the gases.
+    """
+    scalars = ['ts'] + [g for g in fe.GASES if g in settings['columns']]
+    return ([f'{x}_spectrum' for x in ['w'] + scalars]
+            + [f'w/{x}_cospectrum' for x in scalars]
+            + [f'w/{x}_ogive' for x in scalars])
+
+
+def frequency_edges(settings, frequency='natural', n_bins=50):
+    """
+    Edges of the log-spaced frequency bands: from the lowest to the Nyquist
+    frequency of a half-hour for natural frequencies [Hz], or from 1e-4 to
+    1e2 for normalized frequencies.
+    """
+    if frequency == 'natural':
+        fs = settings['acquisition_frequency']
+        f_min = fs / fe.nominal_samples(settings)
+        return np.geomspace(f_min, fs / 2, n_bins + 1)
+    return np.geomspace(1e-4, 1e2, n_bins + 1)
+
+
+def new_accumulator(names, edges, stability_bounds, n_sectors, frequency='natural'):
+    """
+    Empty accumulator of binned (co)spectra.
+
+    Parameters
+    ----------
+    names : list of str
+        Names of the series (see ``series_names``).
+    edges : numpy.ndarray
+        Edges of the frequency bands (none if empty).
+    stability_bounds : sequence of float
+        Bounds of the stability classes on (z-d)/L.
+    n_sectors : int
+        Number of wind sectors.
+    frequency : str, optional
+        'natural' or 'normalized'.
+
+    Returns
+    -------
+    dict
+        'sums' and 'counts' of shape (stability classes, sectors, series,
+        bands), 'half_hours' (stability classes, sectors), the count of
+        half-hours accumulated, and the description of the axes.
+    """
+    n_classes = len(stability_bounds) + 1
+    shape = (n_classes, n_sectors, len(names), max(len(edges) - 1, 0))
+    return {
+        'names': list(names),
+        'edges': np.asarray(edges, dtype=float),
+        'stability_bounds': tuple(stability_bounds),
+        'n_sectors': n_sectors,
+        'frequency': frequency,
+        'sums': np.zeros(shape),
+        'counts': np.zeros(shape, dtype=np.int64),
+        'half_hours': np.zeros((n_classes, n_sectors), dtype=np.int64),
+        }
+
+
+def add(acc, other):
+    """
+    Add the sums and counts of an accumulator to another, in place. Series
+    of ``other`` that are not in ``acc`` (e.g. a gas added by a later
+    configuration) are appended to ``acc``.
+    """
+    new = [n for n in other['names'] if n not in acc['names']]
+    if new:
+        pad = [(0, 0), (0, 0), (0, len(new)), (0, 0)]
+        acc['sums'] = np.pad(acc['sums'], pad)
+        acc['counts'] = np.pad(acc['counts'], pad)
+        acc['names'] = acc['names'] + new
+    idx = [acc['names'].index(n) for n in other['names']]
+    acc['sums'][:, :, idx] += other['sums']
+    acc['counts'][:, :, idx] += other['counts']
+    acc['half_hours'] += other['half_hours']
+    return acc
+
+
+def batch_cospectra(files, timestamps, settings, options):
+    """
+    Accumulate the binned (co)spectra of a batch of half-hours.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        10 Hz files of the half-hours.
+    timestamps : list of pandas.Timestamp
+        End of the half-hours (see ``flux_engine.map_configs``).
+    settings : dict
+        See ``flux_engine.read_settings``.
+    options : dict
+        'frequency', 'n_bins', 'stability_bounds', 'n_sectors' and
+        'min_correlation', see ``run``.
+
+    Returns
+    -------
+    dict
+        Accumulator of the batch.
+    """
+    columns = settings['columns']
+    fs = settings['acquisition_frequency']
+    gases = [g for g in fe.GASES if g in columns]
+    names = series_names(settings)
+    edges = frequency_edges(settings, options['frequency'], options['n_bins'])
+    acc = new_accumulator(names, edges, options['stability_bounds'],
+                          options['n_sectors'], options['frequency'])
+
+    data, _, _, _, _ = fe.load_batch(files, settings, gases)
+    u_mean, v_mean = fe.nanmean(data['u']), fe.nanmean(data['v'])
+    wind_dir = fe.wind_direction(u_mean, v_mean, settings)
+    u, v, w, _ = fe.double_rotation(data['u'], data['v'], data['w'])
+
+    primes = {'w': fe.detrend(w, settings['detrend_meth']),
+              'ts': fe.detrend(data['ts'], settings['detrend_meth'])}
+    for gas in gases:
+        gas_prime = fe.detrend(data[gas], settings['detrend_meth'])
+        lag, _ = time_lag.find_time_lag(
+            primes['w'], gas_prime,
+            int(round(columns[gas]['min_timelag'] * fs)),
+            int(round(columns[gas]['max_timelag'] * fs)),
+            int(round(settings['default_time_lags'][gas] * fs)),
+            time_lag.TIME_LAG_METHODS.get(settings['tlag_meth'], 'covariance_with_default'),
+            int(round(columns[gas]['nom_timelag'] * fs)))
+        primes[gas] = fe.shift(gas_prime, lag)
+
+    # Stability and sector of each half-hour
+    u_prime = fe.detrend(u, settings['detrend_meth'])
+    v_prime = fe.detrend(v, settings['detrend_meth'])
+    ustar = (fe.covariance(primes['w'], u_prime)**2
+             + fe.covariance(primes['w'], v_prime)**2) ** 0.25
+    with np.errstate(divide='ignore', invalid='ignore'):
+        obukhov = -fe.nanmean(data['ts']) * ustar**3 / (
+            fe.VON_KARMAN * fe.G * fe.covariance(primes['w'], primes['ts']))
+        zeta = (settings['height'] - settings['displacement_height']) / obukhov
+    stability_class = np.digitize(zeta, options['stability_bounds'])
+    valid = np.isfinite(zeta) & np.isfinite(wind_dir)
+    sector = np.floor(np.nan_to_num(wind_dir) / (360 / options['n_sectors'])).astype(int) \
+        % options['n_sectors']
+
+    n = fe.nominal_samples(settings)
+    freqs = np.fft.rfftfreq(n, 1 / fs)[1:]
+    if options['frequency'] == 'natural':
+        scaled = np.broadcast_to(freqs, (len(files), len(freqs)))
+    else:
+        mean_speed = np.hypot(u_mean, v_mean)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = freqs[None, :] * (settings['height'] - settings['displacement_height']) \
+                / mean_speed[:, None]
+    n_bands = len(edges) - 1
+    band = np.searchsorted(edges, scaled, side='right') - 1
+    band[scaled == edges[-1]] = n_bands - 1
+    band[(band < 0) | (band >= n_bands)] = -1
+
+    # One FFT per series, missing samples set to the mean (0)
+    ffts = {k: np.fft.rfft(np.nan_to_num(x), axis=-1)[:, 1:] for k, x in primes.items()}
+    variances = {k: cross_contributions(x, x, n) for k, x in ffts.items()}
+    df = fs / n
+
+    series = []
+    cross = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name in names:
+            if name.endswith('_spectrum'):
+                contribution = variances[name.replace('_spectrum', '')]
+                variance = contribution.sum(axis=-1)
+                series.append(freqs * contribution / (variance[:, None] * df))
+                continue
+            x = name.split('/')[1].rsplit('_', 1)[0]
+            if x not in cross:
+                cross[x] = cross_contributions(ffts['w'], ffts[x], n)
+            contribution = cross[x]
+            cov = contribution.sum(axis=-1)
+            correlation = cov / np.sqrt(variances['w'].sum(axis=-1) * variances[x].sum(axis=-1))
+            if name.endswith('_cospectrum'):
+                values = freqs * contribution / (cov[:, None] * df)
+            else:
+                values = np.cumsum(contribution[:, ::-1], axis=-1)[:, ::-1] / cov[:, None]
+            values[~(np.abs(correlation) >= options['min_correlation'])] = np.nan
+            series.append(values)
+    series = np.stack(series, axis=1)           # (half-hours, series, frequencies)
+
+    for i in np.flatnonzero(valid):
+        sums, counts = bin_series(series[i], band[i], n_bands)
+        acc['sums'][stability_class[i], sector[i]] += sums
+        acc['counts'][stability_class[i], sector[i]] += counts
+        acc['half_hours'][stability_class[i], sector[i]] += 1
+    return acc
+
+
+def cross_contributions(x_fft, y_fft, n):
+    """
+    Contribution of each positive frequency to the covariance of two series,
+    from their FFTs (zero frequency excluded). Summed over the frequencies,
+    it gives the covariance.
+    """
+    contribution = 2 * np.real(np.conj(x_fft) * y_fft) / n**2
+    if n % 2 == 0:
+        # The Nyquist frequency is not mirrored
+        contribution[..., -1] /= 2
+    return contribution
+
+
+def bin_series(values, band, n_bands):
+    """
+    Sums and counts of the finite values of each frequency band.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Array of shape (series, frequencies).
+    band : numpy.ndarray
+        Band of each frequency, -1 outside the bands.
+    n_bands : int
+        Number of bands.
+
+    Returns
+    -------
+    sums, counts : numpy.ndarray
+        Arrays of shape (series, bands).
+    """
+    n_series = values.shape[0]
+    finite = np.isfinite(values) & (band >= 0)
+    flat = (np.arange(n_series)[:, None] * n_bands + band[None, :])[finite]
+    sums = np.bincount(flat, weights=values[finite], minlength=n_series * n_bands)
+    counts = np.bincount(flat, minlength=n_series * n_bands)
+    return sums.reshape(n_series, n_bands), counts.reshape(n_series, n_bands)
+
+
+def ensemble(acc):
+    """
+    Ensemble averages of an accumulator.
+
+    Parameters
+    ----------
+    acc : dict
+        See ``new_accumulator``.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Mean of each series (columns) by stability class, wind sector and
+        frequency band (index), with the number of half-hours of each class
+        and sector in 'half_hours'. Stability classes are labelled by their
+        bounds on (z-d)/L and sectors by their start [deg from north].
+    """
+    bounds = (-np.inf,) + tuple(acc['stability_bounds']) + (np.inf,)
+    classes = [f'{lo:g} to {hi:g}' for lo, hi in zip(bounds[:-1], bounds[1:])]
+    sectors = np.arange(acc['n_sectors']) * 360 / acc['n_sectors']
+    edges = acc['edges']
+    centers = np.sqrt(edges[:-1] * edges[1:])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = acc['sums'] / acc['counts']
+    n_classes, n_sectors, n_series, n_bands = means.shape
+    index = pd.MultiIndex.from_product(
+        [classes, sectors, centers],
+        names=['stability', 'sector', f'frequency_{acc["frequency"]}'])
+    df = pd.DataFrame(means.transpose(0, 1, 3, 2).reshape(len(index), n_series),
+                      index=index, columns=acc['names'])
+    df['half_hours'] = np.repeat(acc['half_hours'].ravel(), n_bands)
+    return df
@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
 import os
 import re
-import subprocess
+import json
+import time
+import sqlite3
+import hashlib
+import uuid
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from joblib import Parallel, delayed
 from utils import data_loader as dl
 from tqdm import tqdm
 
 
 def find_unconverted_files(station_name_raw, station_name_ascii,
-                           bin_file_dir, csv_file_dir):
+                           bin_file_dir, csv_file_dir, n_workers=1,
+                           hash_header=False, raw_files=None, archive_dir=None,
+                           skip_redundant=True):
     """
     Find Campbell Scientific binary TOB3 files (*.dat) located in `bin_file_dir`
     and determine which ones still need to be converted to CSV files in
     `csv_file_dir`.
     Once a TOB3 file is read, it will be stored in cache minimize running
-    time for the next execution.
+    time for the next execution. Cache entries are keyed on the file path,
+    size and modification time (and optionally a hash of its header), so a
+    file that was re-downloaded or grew in place is read again.
+    Files that could not be read, or that failed to convert in
+    :func:`convert`, are recorded in the same cache and skipped until they
+    change (see :func:`list_failures` and :func:`clear_failures`). Entries
+    of the files that are no longer found are removed from the cache.
 
     The source directory containing the .dat files should be organized as
     follows:
@@ -47,6 +61,28 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
         If False, only the folder date is checked: if the date present in the
         folder name already exists among the converted files, the entire folder
         is skipped without checking individual .dat files.
+    n_workers : int, optional
+        Number of worker processes used to read the header and timestamps of
+        the files that are not in cache. Results are merged in the listing
+        order, so the cache and log are identical whatever the number of
+        workers. The default is 1 (serial scan).
+    hash_header : bool, optional
+        Also compare a hash of the TOB3 header to validate cache entries.
+        The default is False.
+    raw_files : list of str, optional
+        All binary files under ``bin_file_dir``, as returned by
+        :func:`list_raw_files`, to share one listing between stations. By
+        default the directory is listed for this station only.
+    archive_dir : Path or str, optional
+        Root directory of the columnar archive of the 10 Hz data. Half-hours
+        stored in the archive count as converted: :func:`convert` does not
+        write their ``_eddy.csv`` file, and the 10 Hz transforms read them
+        from the archive (see ``hf_transforms.run``).
+    skip_redundant : bool, optional
+        Skip the files whose time span is covered by files of the same table
+        that are already converted or that are larger, such as repeated card
+        downloads or overlapping backups (see :func:`find_redundant_files`).
+        Skipped files are logged. The default is True.
 
     Returns
     -------
@@ -58,9 +94,16 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
     logf = open(Path('.','Logs','csbinary_to_csv.log'), "a")
 
     # Cache file to store already processed files
-    tob3_cache_file = Path(".", "Logs", f"{station_name_raw}_tob3_timestamps_cache.csv")
-    ts_cache = load_cache(tob3_cache_file)
+    tob3_cache_file = cache_path(station_name_raw)
+    legacy_cache_file = tob3_cache_file.with_suffix('.csv')
+    is_new_cache = not tob3_cache_file.exists()
+    ts_cache = open_cache(tob3_cache_file)
+    if is_new_cache and legacy_cache_file.exists():
+        migrate_csv_cache(ts_cache, legacy_cache_file)
     new_cache_rows = []
+    new_failure_rows = []
+    recovered_files = []
+    spans = []
 
     # Paths
     bin_file_dir = Path(bin_file_dir)
@@ -69,13 +112,44 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
     # List files that are already converted
     csv_files = list_csv_files(csv_file_dir)
     csv_files_stems = {p.name for p in csv_files}
+    if archive_dir is not None:
+        from process_micromet import hf_archive
+        csv_files_stems.update(
+            f'{name}_eddy.csv'
+            for name in hf_archive.list_half_hours(station_name_ascii, archive_dir))
     unconverted_files = []
 
     # List all Campbell binary files located in subdirectories and
     # matching station name
-    csbin_files = list_csbinary_files(bin_file_dir, station_name_raw)
+    csbin_files = list_csbinary_files(bin_file_dir, station_name_raw, raw_files)
+
+    # Look up the files in cache. Entries of files that changed since they
+    # were cached are ignored and will be overwritten. Files that previously
+    # failed are skipped as long as they are unchanged.
+    identities = {}
+    cached_timestamps = {}
+    known_failures = set()
+    for csbin_file in csbin_files:
+        if type_of_file(csbin_file)[0]:
+            path = str(csbin_file)
+            identities[path] = file_identity(csbin_file, hash_header)
+            if lookup_failure(ts_cache, path, identities[path]):
+                known_failures.add(path)
+                continue
+            cached_timestamps[path] = lookup_cache(ts_cache, path, identities[path])
+
+    # Read the header and timestamps of the files that are not in cache
+    to_scan = [f for f in csbin_files
+               if str(f) in cached_timestamps and not cached_timestamps[str(f)]]
+    progress = tqdm(to_scan, miniters=1, desc=f'{station_name_ascii}: Listing unconverted files')
+    if n_workers > 1:
+        scanned = Parallel(n_jobs=n_workers)(
+            delayed(scan_csbinary_file)(f) for f in progress)
+    else:
+        scanned = [scan_csbinary_file(f) for f in progress]
+    scanned = {str(f): result for f, result in zip(to_scan, scanned)}
 
-    for csbin_file in tqdm(csbin_files, miniters=1, desc=f'{station_name_ascii}: Listing unconverted files'):
+    for csbin_file in csbin_files:
 
         # Get the type of file (eddy covariance, regular met data, etc)
         extension, split_interval = type_of_file(csbin_file)
@@ -85,20 +159,20 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
 
         # Check if the file has already been checked for conversion in the cache
         path = str(csbin_file)
-        cached = ts_cache.get(path)
+        if path in known_failures:
+            continue
+        cached = cached_timestamps[path]
 
         if cached:
-            first_ts, last_ts = cached
+            first_ts, last_ts, table_name, span_start = cached
         else:
-            file_header = dl.tob3_header(csbin_file)
-            if not file_header:
-                logf.write(f'{csbin_file}: Cannot read header\n')
-                continue
-
-            first_ts, last_ts = dl.tob3_first_last_timestamp(csbin_file)
-            if not (first_ts and last_ts):
-                logf.write(f'{csbin_file}: Cannot read first timestamp\n')
+            first_ts, last_ts, table_name, error = scanned[path]
+            span_start = first_ts
+            if error:
+                logf.write(f'{csbin_file}: {error}\n')
+                new_failure_rows.append((path, *identities[path], 'scan', error))
                 continue
+            recovered_files.append(path)
 
         if extension == '_eddy.csv':
             start_ts = pd.Timestamp(first_ts).ceil(split_interval)
@@ -120,8 +194,8 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
                 ).unique()
 
         if not cached:
-            ts_cache[path] = (start_ts, last_ts)
-            new_cache_rows.append((path, start_ts, last_ts))
+            new_cache_rows.append((path, *identities[path], start_ts, last_ts,
+                                   table_name, span_start))
 
         # Check if a expected dates are already in csv files
         needs_conversion = False
@@ -134,8 +208,39 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
         if needs_conversion:
             unconverted_files.append(str(csbin_file))
 
+        if table_name and span_start is not None:
+            spans.append((path, extension, table_name, pd.Timestamp(span_start),
+                          pd.Timestamp(last_ts), identities[path][0],
+                          not needs_conversion))
+
+    # Skip the files whose records are all in other files
+    if skip_redundant:
+        redundant_files = find_redundant_files(spans)
+        for path in unconverted_files:
+            if path in redundant_files:
+                logf.write(f'{path}: Skipped, time span covered by '
+                           f'{", ".join(redundant_files[path])}\n')
+        unconverted_files = [f for f in unconverted_files
+                             if f not in redundant_files]
+
     if new_cache_rows:
-        append_to_cache(tob3_cache_file, new_cache_rows)
+        upsert_cache(ts_cache, new_cache_rows)
+    if new_failure_rows:
+        record_failures(ts_cache, new_failure_rows)
+    if recovered_files:
+        _delete_failures(ts_cache, recovered_files)
+
+    # Forget the files that were removed. An empty listing, e.g. if the raw
+    # directory is not mounted, keeps the cache
+    if csbin_files:
+        listed = {str(f) for f in csbin_files}
+        removed = [row for row in ts_cache.execute(
+            "SELECT path FROM tob3_timestamps UNION SELECT path FROM tob3_failures")
+            if row[0] not in listed]
+        with ts_cache:
+            ts_cache.executemany("DELETE FROM tob3_timestamps WHERE path = ?", removed)
+            ts_cache.executemany("DELETE FROM tob3_failures WHERE path = ?", removed)
+    ts_cache.close()
 
     # Close error log file
     logf.close()
@@ -143,26 +248,140 @@ def find_unconverted_files(station_name_raw, station_name_ascii,
     return unconverted_files
 
 
+def find_redundant_files(spans):
+    """
+    Find the files whose time span is covered by other files of the same
+    type and logger table.
+
+    A file can be covered by files that are already converted, or by files
+    that rank higher: longer span, then larger size, then path. The
+    ranking prevents two copies of the same data from covering each other,
+    so that one of them is always converted. A file is redundant if the
+    union of the spans of the files that can cover it, merged where they
+    overlap or touch, contains its whole span.
+
+    Parameters
+    ----------
+    spans : list of tuple
+        ``(path, extension, table_name, first_ts, last_ts, size, converted)``
+        of each file, in listing order. ``first_ts`` and ``last_ts`` are the
+        timestamps of the first and last records of the file.
+
+    Returns
+    -------
+    dict
+        ``{path: [covering paths]}`` of the redundant files that are not
+        converted yet.
+    """
+    df = pd.DataFrame(spans, columns=['path', 'extension', 'table_name',
+                                      'first_ts', 'last_ts', 'size', 'converted'])
+    df['duration'] = df['last_ts'] - df['first_ts']
+
+    redundant_files = {}
+    for _, group in df.groupby(['extension', 'table_name'], sort=False):
+        if len(group) < 2 or group['converted'].all():
+            continue
+
+        # Interval index of the spans of the table, from the highest ranked
+        # file to the lowest
+        group = group.sort_values(['duration', 'size', 'path'],
+                                  ascending=[False, False, True])
+        spans_index = pd.IntervalIndex.from_arrays(
+            group['first_ts'], group['last_ts'], closed='both')
+        converted = group['converted'].to_numpy()
+        redundant = np.zeros(len(group), dtype=bool)
+
+        for i, row in enumerate(group.itertuples()):
+            if row.converted:
+                continue
+
+            # Files overlapping this one that may cover it. Files found
+            # redundant are left out, their span being covered by files that
+            # rank higher anyway.
+            candidates = (spans_index.overlaps(pd.Interval(row.first_ts, row.last_ts,
+                                                           closed='both'))
+                          & (converted | (np.arange(len(group)) < i)) & ~redundant)
+            candidates[i] = False
+            if not candidates.any():
+                continue
+            covering = group[candidates].sort_values('first_ts', kind='stable')
+
+            # Walk the covering spans from the first record of the file
+            covered_until = None
+            used = []
+            for path, first_ts, last_ts in zip(
+                    covering['path'], covering['first_ts'], covering['last_ts']):
+                if first_ts > (row.first_ts if covered_until is None else covered_until):
+                    break
+                if covered_until is None or last_ts > covered_until:
+                    covered_until = last_ts
+                    used.append(path)
+                if covered_until >= row.last_ts:
+                    redundant_files[row.path] = used
+                    redundant[i] = True
+                    break
+
+    return redundant_files
+
+
+def scan_csbinary_file(csbin_file):
+    """
+    Read the header and the first and last timestamps of a Campbell
+    Scientific binary TOB3 file.
+
+    Parameters
+    ----------
+    csbin_file : str or pathlib.Path
+        Path to the binary file.
+
+    Returns
+    -------
+    tuple of (datetime or None, datetime or None, str or None, str or None)
+        ``(first_ts, last_ts, table_name, error)`` where ``table_name`` is
+        the name of the logger table and ``error`` is the message to log if
+        the file cannot be read, else None.
+    """
+    try:
+        file_header = dl.tob3_header(csbin_file)
+        if not file_header:
+            return None, None, None, 'Cannot read header'
+
+        first_ts, last_ts = dl.tob3_first_last_timestamp(csbin_file)
+        if not (first_ts and last_ts):
+            return None, None, None, 'Cannot read first timestamp'
+    except Exception as e:
+        return None, None, None, f'Cannot read file ({e})'
+
+    return first_ts, last_ts, file_header[1][0], None
+
+
 def convert(station_name, csv_file_dir, unconverted_files,
-            enforce_eddypro_half_hour_start = True):
+            enforce_eddypro_half_hour_start = True, station_name_raw=None,
+            n_workers=1, float_precision=None, archive_dir=None,
+            summary=True):
     """
     Convert Campbell Scientific binary TOB3 files to TOA5 CSV blocks and write
     them to disk per station.
 
     For each binary file in ``unconverted_files``, this function:
-    1. Invokes the external converter ``csidft_convert.exe`` to produce a
-       temporary TOA5 CSV file.
+    1. Decodes the binary frames with ``dl.read_tob3`` and builds the
+       matching TOA5 header with :func:`toa5_header_from_tob3`.
     2. Determines the file type (eddy-covariance vs. slow/regular met) and the
        splitting interval via :func:`type_of_file`.
-    3. Loads the converted CSV using ``dl.toa5_file``.
-    4. Optionally resamples to 30‑minute intervals when needed (for 1‑minute
+    3. Optionally resamples to 30‑minute intervals when needed (for 1‑minute
        slow data) via :func:`resample`.
-    5. Splits the data into 30‑minute or daily blocks and writes each block to a
-       CSV file with a preserved 4-line TOA5 header.
+    4. Splits the data into 30‑minute or daily blocks with
+       :func:`block_bounds`, formats them at once with :func:`format_blocks`
+       and writes each block to a CSV file with a preserved 4-line TOA5
+       header, in a single write.
 
     Files are written under ``csv_file_dir / station_name`` with names of the
     form ``YYYYMMDD_HHMM_<suffix>.csv``, where ``<suffix>`` is determined by
-    :func:`type_of_file` (e.g., ``_eddy.csv`` or ``_slow.csv``).
+    :func:`type_of_file` (e.g., ``_eddy.csv`` or ``_slow.csv``). Each block is
+    first written to a uniquely named temporary file. Temporary files are
+    renamed to their final name by the calling process, in the order of
+    ``unconverted_files``, so readers never see a partial block and the
+    result does not depend on the number of workers.
 
     Parameters
     ----------
@@ -176,6 +395,32 @@ def convert(station_name, csv_file_dir, unconverted_files,
     enforce_eddypro_half_hour_start : bool
         Floor the minute in the name to 00 or 30 to make sure that EddyPro
         runs smoothly
+    station_name_raw : str, optional
+        Name of the station as stored in the raw data. If provided, files
+        that fail to convert are recorded in the station cache so that
+        :func:`find_unconverted_files` skips them until they change.
+    n_workers : int, optional
+        Number of worker processes converting files concurrently. Log lines
+        and failures are collected and written by the calling process, in
+        the order of ``unconverted_files``. The default is 1 (serial).
+    float_precision : int, optional
+        Number of significant digits of the float values written. The
+        default, None, writes the shortest representation that round-trips,
+        as ``DataFrame.to_csv`` does.
+    archive_dir : str or pathlib.Path, optional
+        Root directory of the columnar archive of the 10 Hz data (see
+        :mod:`process_micromet.hf_archive`). If provided, the 30 min blocks of
+        the eddy covariance files are stored in the archive instead of
+        ``_eddy.csv`` files: pass the same ``archive_dir`` to
+        ``gas_analyzer.find_uncorrected_files`` and ``hf_transforms.run``,
+        which read them from the archive, and use :func:`export_toa5` to
+        get TOA5 files on demand. Slow data are always written as CSV. The
+        default, None, only writes CSV files.
+    summary : bool, optional
+        Store statistics of each 30 min block of the eddy covariance files
+        (sample counts, means, variances and flagged diagnostics) in the
+        half-hour summary of the station (see :func:`read_summary`). The
+        default is True.
 
     Returns
     -------
@@ -184,91 +429,537 @@ def convert(station_name, csv_file_dir, unconverted_files,
 
     Side Effects
     ------------
-    - Creates or overwrites a log file at ``./Logs/csbinary_to_csv.log``.
-    - Creates a temporary file ``tmp.csv`` under ``csv_file_dir / station_name``.
-      The temporary file is deleted after each iteration.
+    - Appends to the log file at ``./Logs/csbinary_to_csv.log``.
+    - Records conversion failures in the station cache if
+      ``station_name_raw`` is provided.
     - Writes one or more CSV files per input binary file, each with a 4-line
-      TOA5 header preserved from the converter output.
+      TOA5 header derived from the TOB3 header.
+    - Stores the 30 min blocks of the eddy covariance files in the archive,
+      instead of CSV files, if ``archive_dir`` is provided.
+    - Updates the half-hour summary at
+      ``csv_file_dir / <station_name>_half_hour_summary.sqlite`` if
+      ``summary`` is True.
     """
 
     # Paths
     log_file = Path('.','Logs','csbinary_to_csv.log')
     csv_file_dir = Path(csv_file_dir)
-    csidft_exe = Path("./Bin/raw2ascii/csidft_convert.exe")
+
+    archive = archive_dir is not None
+    if archive:
+        from process_micromet import hf_archive
+
+    unconverted_files = list(unconverted_files)
+    progress = tqdm(unconverted_files, miniters=1, desc=f'{station_name}: Converting CS binaries to csv')
+    args = (station_name, csv_file_dir, enforce_eddypro_half_hour_start,
+            float_precision, archive, summary)
+    if n_workers > 1:
+        # Results are consumed in order as they come, so that the archived
+        # blocks of all files are not held in memory at once
+        results = Parallel(n_jobs=n_workers, return_as='generator')(
+            delayed(convert_file)(f, *args) for f in progress)
+    else:
+        results = (convert_file(f, *args) for f in progress)
 
     # Open error log file
     logf = open(log_file, "a")
+    failure_rows = []
+    if summary:
+        summary_conn = open_summary(summary_path(station_name, csv_file_dir))
+
+    for csbin_file, (error, written_blocks, archived_blocks, block_summary) in zip(
+            unconverted_files, results):
+        # Move the finished blocks to their final name
+        for tmp_name, file_name in written_blocks:
+            os.replace(tmp_name, file_name)
+        if archived_blocks:
+            try:
+                hf_archive.write(station_name, archive_dir, archived_blocks)
+            except Exception as e:
+                error = f'Cannot archive ({e})'
+        if block_summary is not None and not error:
+            upsert_summary(summary_conn, block_summary)
+        if error:
+            logf.write(f'{csbin_file}: Cannot convert ({error})\n')
+            if os.path.exists(csbin_file):
+                failure_rows.append(
+                    (str(csbin_file), *file_identity(csbin_file), 'convert', error))
+
+    if summary:
+        summary_conn.close()
+
+    if station_name_raw and failure_rows:
+        conn = open_cache(cache_path(station_name_raw))
+        record_failures(conn, failure_rows)
+        conn.close()
+
+    logf.close()
+
+
+def convert_file(csbin_file, station_name, csv_file_dir,
+                 enforce_eddypro_half_hour_start=True, float_precision=None,
+                 archive=False, summary=True):
+    """
+    Convert one Campbell Scientific binary TOB3 file to TOA5 CSV blocks
+    written to temporary files. See :func:`convert` for details.
+
+    Returns
+    -------
+    error : str or None
+        Reason of the failure, or None if the file was converted.
+    written_blocks : list of tuple
+        ``(tmp_name, file_name)`` of each block written. Empty if the
+        conversion failed, or for eddy covariance files if ``archive``.
+    archived_blocks : list of tuple
+        ``(name, df, header)`` of each 30 min block of an eddy covariance
+        file, to be stored in the archive by the calling process. Empty if
+        ``archive`` is False or if the conversion failed.
+    block_summary : pandas.DataFrame or None
+        Statistics of each 30 min block of an eddy covariance file, as
+        returned by :func:`summarize_blocks`. None if ``summary`` is False,
+        for slow data or if the conversion failed.
+    """
+    csv_file_dir = Path(csv_file_dir)
+    written_blocks = []
+    archived_blocks = []
+    block_summary = None
+
+    try:
+        # Get the type of file (eddy covariance, regular met data, etc)
+        extension, split_interval = type_of_file(csbin_file)
+
+        # Build the header to respect TOA5 format
+        tob3_file_header = dl.tob3_header(csbin_file)
+        header = toa5_header_from_tob3(tob3_file_header)
 
-    for csbin_file in tqdm(unconverted_files, miniters=1, desc=f'{station_name}: Converting CS binaries to csv'):
+        # Decode the Campbell binary file
+        df = dl.read_tob3(csbin_file)
 
-        try:
-            # Conversion from the Campbell binary file to csv format
-            tmp_file = csv_file_dir.joinpath(station_name, 'tmp.csv')
-            subprocess.call(
-                [csidft_exe, csbin_file, tmp_file , 'ToA5'],
-                stdout=subprocess.DEVNULL)
+        if extension == "_eddy.csv":
+            # Locate the 30min blocks
+            df = df.sort_index()
+            starts, stops = block_bounds(df.index, '30min', pd.Timedelta(milliseconds=100))
 
-            # Get the type of file (eddy covariance, regular met data, etc)
-            extension, split_interval = type_of_file(csbin_file)
+        elif extension == "_slow.csv":
+            # Get time step duration (1min files need to be resampled at 30min)
+            if tob3_file_header[1][1] == '1 MIN':
+                df = resample(df)
+            # Locate the daily blocks
+            df = df.sort_index()
+            starts, stops = block_bounds(df.index, '1D', pd.Timedelta(minutes=30))
 
-            # Save the header to respect TOA5 format
-            with open(tmp_file) as f:
-                header = [next(f) for x in range(4)]
+        # Name the blocks after their first timestamp
+        names = []
+        for start in starts:
 
-            # Load file
-            df = dl.toa5_file(tmp_file)
+            ts = df.index[start]
 
-            if extension == "_eddy.csv":
-                # Slice df into 30min blocks
-                blocks = slice_30min_blocks(df)
+            if enforce_eddypro_half_hour_start and extension == "_eddy.csv":
+                if ts.minute not in (0, 30):
+                        minute_floor = 30 if ts.minute >= 30 else 0
+                        ts = ts.replace(minute=minute_floor, second=0, microsecond=0)
 
-            elif extension == "_slow.csv":
-                # Get time step duration (1min files need to be resampled at 30min)
-                tob3_file_header = dl.tob3_header(csbin_file)
-                if tob3_file_header[1][1] == '1 MIN':
-                    df = resample(df)
-                # Slice df into daily blocks
-                blocks = slice_day_blocks(df)
+            names.append(ts.strftime('%Y%m%d_%H%M'))
 
-            # Write splitted files
-            for block in blocks:
+        # Aggregate the 10 Hz blocks for the half-hour summary
+        if summary and extension == "_eddy.csv":
+            block_summary = summarize_blocks(df, names, starts, stops)
 
-                ts = block.index[0]
+        # Keep the 10 Hz blocks for the columnar archive
+        if archive and extension == "_eddy.csv":
+            archived_blocks = [(name, df.iloc[start:stop], header)
+                               for name, start, stop in zip(names, starts, stops)]
+            return None, [], archived_blocks, block_summary
 
-                if enforce_eddypro_half_hour_start and extension == "_eddy.csv":
-                    if ts.minute not in (0, 30):
-                            minute_floor = 30 if ts.minute >= 30 else 0
-                            ts = ts.replace(minute=minute_floor, second=0, microsecond=0)
+        # Format all blocks at once
+        payloads = format_blocks(df, starts, stops, float_precision)
+
+        # Write splitted files
+        for name, payload in zip(names, payloads):
+            file_name = csv_file_dir.joinpath(station_name, name + extension)
+            written_blocks.append(
+                (write_tmp_block(file_name, header, payload), file_name))
+
+    except Exception as e:
+        for tmp_name, _ in written_blocks:
+            os.remove(tmp_name)
+        return str(e) or type(e).__name__, [], [], None
+
+    return None, written_blocks, archived_blocks, block_summary
+
+
+def summarize_blocks(df, names, starts, stops):
+    """
+    Compute statistics of each block of high frequency data: number of
+    records, and for each variable the number of valid samples, mean,
+    variance and, for diagnostic flags, the number of flagged samples.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Time-indexed data.
+    names : list of str
+        Name of each block, as ``YYYYMMDD_HHMM``.
+    starts, stops : array-like of int
+        Positional bounds of the blocks, as returned by :func:`block_bounds`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per block and variable with the columns 'half_hour',
+        'variable', 'n_records', 'count', 'mean', 'var' and 'n_flagged'.
+        'n_flagged' is the number of non-zero values of the variables whose
+        name starts with 'diag', and NaN for the others.
+    """
+    columns = ['half_hour', 'variable', 'n_records', 'count', 'mean', 'var', 'n_flagged']
+    numeric = df.select_dtypes('number').drop(columns='RECORD', errors='ignore')
+    if numeric.shape[1] == 0 or len(starts) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Label each row with its block, -1 for the rows out of any block
+    labels = np.full(len(df), -1)
+    for k, (start, stop) in enumerate(zip(starts, stops)):
+        labels[start:stop] = k
+    in_block = labels >= 0
+    grouped = numeric[in_block].groupby(labels[in_block])
+
+    stats = grouped.agg(['count', 'mean', 'var'])
+    stats = stats.stack(level=0).rename_axis(['block', 'variable']).reset_index()
+
+    diag = [col for col in numeric.columns if col.lower().startswith('diag')]
+    flagged = ((numeric[diag][in_block] != 0) & numeric[diag][in_block].notna()).groupby(
+        labels[in_block]).sum().rename_axis('block').melt(
+            ignore_index=False, var_name='variable', value_name='n_flagged').reset_index()
+    stats = stats.merge(flagged, on=['block', 'variable'], how='left')
+
+    stats['n_records'] = np.diff(np.stack([starts, stops]), axis=0)[0][stats['block']]
+    stats['half_hour'] = pd.to_datetime(np.asarray(names)[stats['block']],
+                                        format='%Y%m%d_%H%M')
+    return stats[columns]
+
+
+def summary_path(station_name, csv_file_dir):
+    """
+    Path to the half-hour summary of the high frequency data of a station.
+    """
+    return Path(csv_file_dir).joinpath(f'{station_name}_half_hour_summary.sqlite')
+
+
+def open_summary(summary_file):
+    """
+    Open the SQLite half-hour summary of a station, and create it if it does
+    not exist. See :func:`summarize_blocks`.
+
+    Parameters
+    ----------
+    summary_file : pathlib.Path
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(summary_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS half_hour_summary ("
+        "half_hour TEXT, variable TEXT, n_records INTEGER, count INTEGER, "
+        "mean REAL, var REAL, n_flagged INTEGER, "
+        "PRIMARY KEY (half_hour, variable))")
+    conn.commit()
+    return conn
+
+
+def upsert_summary(conn, block_summary):
+    """
+    Replace the summary of the half-hours of ``block_summary`` in a single
+    transaction. As for the CSV files, the last converted file wins.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by :func:`open_summary`.
+    block_summary : pandas.DataFrame
+        Statistics returned by :func:`summarize_blocks`.
+    """
+    half_hours = block_summary['half_hour'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    rows = [
+        (half_hour, variable, int(n_records), int(count),
+         None if pd.isna(mean) else float(mean),
+         None if pd.isna(var) else float(var),
+         None if pd.isna(n_flagged) else int(n_flagged))
+        for half_hour, variable, n_records, count, mean, var, n_flagged in zip(
+            half_hours, block_summary['variable'], block_summary['n_records'],
+            block_summary['count'], block_summary['mean'], block_summary['var'],
+            block_summary['n_flagged'])]
+    with conn:
+        conn.executemany("DELETE FROM half_hour_summary WHERE half_hour = ?",
+                         [(h,) for h in half_hours.unique()])
+        conn.executemany(
+            "INSERT INTO half_hour_summary VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def read_summary(station_name, csv_file_dir, variables=None, start=None, end=None):
+    """
+    Read the half-hour summary of the high frequency data of a station.
+
+    Parameters
+    ----------
+    station_name : str
+        Station identifier, as used by :func:`convert`.
+    csv_file_dir : str or pathlib.Path
+        Base directory of the CSV files, as used by :func:`convert`.
+    variables : list of str, optional
+        Variables to read. The default reads all of them.
+    start, end : str or datetime-like, optional
+        Bounds (inclusive) of the half-hours to read, by their start time.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by the start of the half-hours ('timestamp'), with the
+        number of records in column 'n_records' and the statistics of each
+        variable in columns named '<variable>_<statistic>', statistic being
+        'count', 'mean', 'var' or 'n_flagged'.
+    """
+    query = "SELECT * FROM half_hour_summary WHERE 1 = 1"
+    params = []
+    if variables is not None:
+        query += f" AND variable IN ({', '.join('?' * len(variables))})"
+        params += list(variables)
+    if start is not None:
+        query += " AND half_hour >= ?"
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d %H:%M:%S'))
+    if end is not None:
+        query += " AND half_hour <= ?"
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d %H:%M:%S'))
+
+    conn = open_summary(summary_path(station_name, csv_file_dir))
+    long_df = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+
+    long_df['half_hour'] = pd.to_datetime(long_df['half_hour'])
+    stats = ['count', 'mean', 'var', 'n_flagged']
+    long_df[stats] = long_df[stats].astype(float)
+    n_records = long_df.groupby('half_hour')['n_records'].max()
+    df = long_df.pivot(index='half_hour', columns='variable',
+                       values=stats)
+    df = df.dropna(axis=1, how='all')
+    df.columns = [f'{variable}_{stat}' for stat, variable in df.columns]
+    df = df[sorted(df.columns)]
+    df.insert(0, 'n_records', n_records)
+    df.index.name = 'timestamp'
+    return df
+
+
+def format_blocks(df, starts, stops, float_precision=None):
+    """
+    Format the rows of a DataFrame as TOA5 CSV lines, block by block.
+
+    All rows are formatted at once and the lines of each block are then
+    joined. pandas picks the timestamp format from the values being written
+    (date only, seconds, milli-, micro- or nanoseconds), so blocks whose
+    timestamps call for another format than the whole DataFrame are
+    formatted on their own. The output is thus identical to
+    ``df.iloc[start:stop].to_csv(header=False, float_format=...)`` for each
+    block.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Time-indexed data.
+    starts, stops : array-like of int
+        Positional bounds of the blocks, as returned by :func:`block_bounds`.
+    float_precision : int, optional
+        Number of significant digits of the float values. If the DataFrame
+        only holds numbers, the rows are then formatted with a single format
+        string each, which is several times faster than ``to_csv``. The
+        default, None, writes the shortest representation that round-trips,
+        as ``to_csv`` does.
+
+    Returns
+    -------
+    payloads : list of str
+        CSV lines of each block, newline terminated, without header.
+    """
+    if len(starts) == 0:
+        return []
+
+    if float_precision is not None and all(
+            dtype.kind in 'iuf' for dtype in df.dtypes):
+        def format_lines(data):
+            return format_numeric_rows(data, float_precision)
+    else:
+        float_format = None if float_precision is None else f'%.{float_precision}g'
+
+        def format_lines(data):
+            return data.to_csv(header=False, index=True, float_format=float_format,
+                               lineterminator='\n').splitlines(keepends=True)
+
+    lines = format_lines(df)
+
+    # Timestamp format class of each block, as chosen by pandas
+    ns = df.index.values.astype('datetime64[ns]').view(np.int64)
+    counts = [np.concatenate(([0], np.cumsum(ns % unit != 0)))
+              for unit in (86400 * 10**9, 10**9, 10**6, 10**3)]
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+
+    def format_class(lo, hi):
+        return tuple(c[hi] - c[lo] > 0 for c in counts)
+
+    frame_class = np.stack(format_class(0, len(ns)))
+    block_class = np.stack(format_class(starts, stops), axis=-1)
+    same_format = (block_class == frame_class).all(axis=-1)
+
+    payloads = []
+    for start, stop, same in zip(starts, stops, same_format):
+        block_lines = lines[start:stop] if same else format_lines(df.iloc[start:stop])
+        payloads.append(''.join(block_lines))
+    return payloads
+
+
+def format_numeric_rows(df, float_precision):
+    """
+    Format the rows of a DataFrame of numbers as CSV lines, like ``to_csv``
+    with ``float_format=f'%.{float_precision}g'`` does, but with a single
+    ``%`` operation per row. Missing values are written as empty fields.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Time-indexed data whose columns are all integers or floats.
+    float_precision : int
+        Number of significant digits of the float values.
+
+    Returns
+    -------
+    lines : list of str
+        One newline terminated line per row, starting with the timestamp.
+    """
+    row_format = ','.join(
+        ['%s'] + [f'%.{float_precision}g' if dtype.kind == 'f' else '%d'
+                  for dtype in df.dtypes]) + '\n'
+    columns = [df.index.astype(str).tolist()]
+    for name in df.columns:
+        values = df[name].to_numpy()
+        columns.append(values.astype(np.float64).tolist() if values.dtype.kind == 'f'
+                       else values.tolist())
+    lines = [row_format % row for row in zip(*columns)]
+
+    # '%g' writes 'nan' where to_csv writes an empty field
+    if df.isna().to_numpy().any():
+        lines = [line.replace(',nan', ',') for line in lines]
+    return lines
+
+
+def write_tmp_block(file_name, header, payload):
+    """
+    Write a block with its TOA5 header to a uniquely named temporary file
+    next to ``file_name``, and return its path. The temporary name does not
+    end with ``.csv`` and is therefore ignored by the file listings of the
+    workflow.
+    """
+    file_name = Path(file_name)
+    tmp_name = file_name.with_name(
+        f'{file_name.name}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp')
+    try:
+        with open(tmp_name, 'w') as f:
+            f.write(''.join(header) + payload)
+    except BaseException:
+        if tmp_name.exists():
+            os.remove(tmp_name)
+        raise
+    return tmp_name
+
+
+def export_toa5(station_name, archive_dir, csv_file_dir, half_hours,
+                float_precision=None, overwrite=False):
+    """
+    Export half-hours of the columnar archive as TOA5 ``_eddy.csv`` files,
+    e.g. to run EddyPro on the periods being processed only.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+    csv_file_dir : str or pathlib.Path
+        Base directory of the CSV files. Files are written under
+        ``csv_file_dir / station_name``.
+    half_hours : iterable of str or datetime-like
+        Half-hours to export, as ``YYYYMMDD_HHMM`` names or timestamps.
+    float_precision : int, optional
+        Number of significant digits of the float values. See
+        :func:`format_blocks`.
+    overwrite : bool, optional
+        Export again the half-hours whose file already exists. The default is
+        False.
 
-                file_name = csv_file_dir.joinpath(
-                    station_name,
-                    ts.strftime('%Y%m%d_%H%M') + extension
-                )
+    Returns
+    -------
+    list of pathlib.Path
+        Files written. Half-hours that are not archived are skipped.
+    """
+    from process_micromet import hf_archive
 
-                # Write header
-                with open(file_name,'w') as f:
-                    for h in header:
-                        f.write(h)
-                block.to_csv(file_name, mode='a', header=False, index=True)
+    station_dir = Path(csv_file_dir).joinpath(station_name)
+    station_dir.mkdir(parents=True, exist_ok=True)
 
-            os.remove(tmp_file)
+    written = []
+    for name in half_hours:
+        if not isinstance(name, str):
+            name = pd.Timestamp(name).strftime('%Y%m%d_%H%M')
+        file_name = station_dir.joinpath(f'{name}_eddy.csv')
+        if file_name.exists() and not overwrite:
+            continue
 
-        except:
-            logf.write(f'{csbin_file}: Cannot convert\n')
+        df, header = hf_archive.read_half_hour(station_name, archive_dir, name)
+        if df is None or df.empty:
             continue
 
-    logf.close()
+        payload, = format_blocks(df, [0], [len(df)], float_precision)
+        os.replace(write_tmp_block(file_name, header, payload), file_name)
+        written.append(file_name)
+    return written
 
 
-def list_csbinary_files(root_dir,station):
+def toa5_header_from_tob3(tob3_file_header):
+    """
+    Build the 4-line TOA5 header corresponding to a TOB3 file, as written by
+    Campbell Scientific converters.
+
+    Parameters
+    ----------
+    tob3_file_header : list of list of str
+        Cleaned 6-line TOB3 header, as returned by ``dl.tob3_header``.
+
+    Returns
+    -------
+    header : list of str
+        The 4 TOA5 header lines, newline terminated.
+    """
+    environment, table, names, units, processing = tob3_file_header[:5]
+    lines = [
+        ['TOA5'] + environment[1:7] + [table[0]],
+        ['TIMESTAMP', 'RECORD'] + names,
+        ['TS', 'RN'] + units,
+        ['', ''] + processing,
+        ]
+    return [','.join(f'"{field}"' for field in line) + '\n' for line in lines]
+
+
+def list_csbinary_files(root_dir, station, raw_files=None):
     """
     Recursively list Campbell Scientific binary files (.dat) under ``root_dir``
     for a given station.
 
-    This function walks the directory tree rooted at ``root_dir`` and collects
-    all ``.dat`` files located in directories whose path contains a segment
-    matching the pattern ``{station}_YYYYMMDD`` (8-digit date). It is designed
-    for repositories organized by acquisition date and station name.
+    This function collects all ``.dat`` files located in directories whose
+    path contains a segment matching the pattern ``{station}_YYYYMMDD``
+    (8-digit date). It is designed for repositories organized by acquisition
+    date and station name.
 
     The function will not look into folders named _quarantine.
 
@@ -280,6 +971,11 @@ def list_csbinary_files(root_dir,station):
         Station name prefix used in directory names. Directories are considered
         a match if their path contains ``f"{station}_\\d{{8}}"`` (e.g.,
         ``Romaine-2_reservoir_shore_20180710``).
+    raw_files : list of str, optional
+        All binary files under ``root_dir``, as returned by
+        :func:`list_raw_files`. Listing the tree once and passing it for each
+        station avoids walking it again. By default the tree is listed with
+        :func:`list_raw_files`.
 
     Returns
     -------
@@ -302,20 +998,171 @@ def list_csbinary_files(root_dir,station):
         │       └── bar.dat
 
     """
-    # List Campbell binary files located in the root dir, that contain
-    pattern = re.compile(re.escape(station) + r"_\d{8}")
-    csbin_files = []
+    if raw_files is None:
+        raw_files = list_raw_files(root_dir)
 
-    for root, dirs, files in os.walk(root_dir):
-        # Prevent os.walk from searching in "_quarantine" folders
-        dirs[:] = [d for d in dirs if d != "_quarantine"]
-        # Check if the directory matches the pattern
-        if pattern.search(root):
-            for file in files:
-                # Check if the file ends with .dat
-                if file.endswith(".dat"):
-                    csbin_files.append(os.path.join(root, file))
-    return csbin_files
+    # Keep the files located in a directory that matches the station
+    pattern = re.compile(re.escape(str(station)) + r"_\d{8}")
+    return [f for f in raw_files if pattern.search(os.path.dirname(f))]
+
+
+def list_raw_files(root_dir, manifest_file=None):
+    """
+    Recursively list all Campbell Scientific binary files (.dat) under
+    ``root_dir``, whatever the station, in the order of ``os.walk``.
+
+    The content of each directory is stored in a manifest along with the
+    modification time of the directory. Adding, removing or renaming an entry
+    changes the modification time of its directory, so a directory whose
+    modification time is unchanged is not listed again: only one ``stat`` is
+    needed to validate it. On a warm run, only the new
+    ``YYYYMMDD/station_YYYYMMDD`` folders and their parents are listed.
+
+    Folders named _quarantine are not searched.
+
+    Parameters
+    ----------
+    root_dir : str or pathlib.Path
+        Path to the root directory to search recursively.
+    manifest_file : str or pathlib.Path, optional
+        Path to the SQLite manifest. The default is
+        ``./Logs/raw_file_manifest.sqlite``.
+
+    Returns
+    -------
+    list of str
+        Paths of all ``.dat`` files found under ``root_dir``.
+    """
+    if manifest_file is None:
+        manifest_file = Path('.', 'Logs', 'raw_file_manifest.sqlite')
+    root_dir = os.fspath(root_dir)
+
+    conn = open_manifest(manifest_file)
+    manifest = {
+        path: (mtime_ns, json.loads(subdirs), json.loads(files))
+        for path, mtime_ns, subdirs, files in conn.execute(
+            "SELECT path, mtime_ns, subdirs, files FROM raw_directories "
+            "WHERE root = ?", (root_dir,))
+        }
+    new_rows = []
+    visited = set()
+    raw_files = []
+
+    def walk(directory, mtime_ns):
+        visited.add(directory)
+        cached = manifest.get(directory)
+        if cached and cached[0] == mtime_ns:
+            subdirs, files = cached[1], cached[2]
+            subdirs_mtime = []
+            for name in subdirs:
+                try:
+                    subdirs_mtime.append(
+                        (name, os.stat(os.path.join(directory, name)).st_mtime_ns))
+                except OSError:
+                    continue
+        else:
+            listing_time_ns = time.time_ns()
+            subdirs_mtime, files = list_directory(directory)
+            if subdirs_mtime is None:
+                return
+            subdirs = [name for name, _ in subdirs_mtime]
+            # A directory modified during the current second may still
+            # change without its modification time changing: list it again
+            # on the next run
+            if listing_time_ns - mtime_ns > 2 * 10**9:
+                new_rows.append((directory, root_dir, mtime_ns,
+                                 json.dumps(subdirs), json.dumps(files)))
+
+        raw_files.extend(os.path.join(directory, name) for name in files)
+        for name, sub_mtime_ns in subdirs_mtime:
+            walk(os.path.join(directory, name), sub_mtime_ns)
+
+    try:
+        walk(root_dir, os.stat(root_dir).st_mtime_ns)
+    except OSError:
+        pass
+
+    # Forget the directories that were removed
+    removed = [(path,) for path in manifest if path not in visited]
+    conn.executemany("DELETE FROM raw_directories WHERE path = ?", removed)
+    conn.executemany(
+        "INSERT INTO raw_directories (path, root, mtime_ns, subdirs, files) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET "
+        "root = excluded.root, mtime_ns = excluded.mtime_ns, "
+        "subdirs = excluded.subdirs, files = excluded.files", new_rows)
+    conn.commit()
+    conn.close()
+
+    return raw_files
+
+
+def list_directory(directory):
+    """
+    List the subdirectories and binary files of a directory with a single
+    ``os.scandir``, as ``os.walk`` would do.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory.
+
+    Returns
+    -------
+    subdirs : list of tuple or None
+        ``(name, mtime_ns)`` of the subdirectories to search, symbolic links
+        and _quarantine folders excluded. None if the directory cannot be
+        listed.
+    files : list of str
+        Names of the ``.dat`` files of the directory.
+    """
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    if entry.name.endswith(".dat"):
+                        files.append(entry.name)
+                elif entry.name != "_quarantine" and not entry.is_symlink():
+                    try:
+                        subdirs.append((entry.name, entry.stat().st_mtime_ns))
+                    except OSError:
+                        continue
+    except OSError:
+        return None, []
+    return subdirs, files
+
+
+def open_manifest(manifest_file):
+    """
+    Open the SQLite manifest of the raw data directories, and create it if it
+    does not exist. See :func:`list_raw_files`.
+
+    Parameters
+    ----------
+    manifest_file : str or pathlib.Path
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(manifest_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS raw_directories ("
+        "path TEXT PRIMARY KEY, root TEXT, mtime_ns INTEGER, "
+        "subdirs TEXT, files TEXT)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS raw_directories_root "
+        "ON raw_directories (root)")
+    conn.commit()
+    return conn
 
 
 def list_csv_files(csv_dir):
@@ -415,36 +1262,8 @@ def slice_30min_blocks(df):
         raise TypeError("DataFrame index must be a DatetimeIndex")
 
     df = df.sort_index()
-
-    start = df.index[0]
-    end = df.index[-1]
-
-    # Floor to 30-minute boundary
-    aligned_start = start.floor("30min")
-
-    # Build theoretical boundaries
-    boundaries = pd.date_range(
-        start=aligned_start,
-        end=end.ceil("30min"),
-        freq="30min"
-    )
-
-    blocks = []
-
-    for b_start, b_end in zip(boundaries[:-1], boundaries[1:]):
-        # Apply the 0.1s / 0.0s rule
-        block_start = b_start + pd.Timedelta(milliseconds=100)
-        block_end = b_end
-
-        # Clip to actual data range
-        block_start = max(block_start, start)
-        block_end = min(block_end, end)
-
-        if block_start <= block_end:
-            block = df.loc[block_start:block_end]
-            if not block.empty:
-                blocks.append(block)
-    return blocks
+    starts, stops = block_bounds(df.index, '30min', pd.Timedelta(milliseconds=100))
+    return [df.iloc[i:j] for i, j in zip(starts, stops)]
 
 
 def slice_day_blocks(df):
@@ -474,39 +1293,46 @@ def slice_day_blocks(df):
         raise TypeError("DataFrame index must be a DatetimeIndex")
 
     df = df.sort_index()
+    starts, stops = block_bounds(df.index, '1D', pd.Timedelta(minutes=30))
+    return [df.iloc[i:j] for i, j in zip(starts, stops)]
 
-    start = df.index[0]
-    end = df.index[-1]
-
-    # Floor to 30-minute boundary
-    aligned_start = start.floor("1D")
 
-    # Build theoretical boundaries
-    boundaries = pd.date_range(
-        start=aligned_start,
-        end=end.ceil("1D"),
-        freq="1D"
-    )
+def block_bounds(index, freq, start_offset):
+    """
+    Positions of the blocks of a sorted DatetimeIndex, found with a single
+    binary search over all the block boundaries.
 
-    blocks = []
+    A block covers the rows whose timestamps are in
+    ``[boundary + start_offset, next boundary]``, boundaries being aligned
+    on ``freq``. Empty blocks are dropped.
 
-    for b_start, b_end in zip(boundaries[:-1], boundaries[1:]):
-        # Apply the 0.1s / 0.0s rule
-        block_start = b_start + pd.Timedelta(minutes=30)
-        block_end = b_end
+    Parameters
+    ----------
+    index : pandas.DatetimeIndex
+        Monotonically increasing index.
+    freq : str
+        Alignment of the block boundaries (e.g. ``'30min'`` or ``'1D'``).
+    start_offset : pandas.Timedelta
+        Offset of the first timestamp of a block from its boundary.
 
-        # Clip to actual data range
-        block_start = max(block_start, start)
-        block_end = min(block_end, end)
+    Returns
+    -------
+    starts, stops : numpy.ndarray
+        Positional bounds of each block, so that block ``k`` is
+        ``df.iloc[starts[k]:stops[k]]``.
+    """
+    if len(index) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
 
-        if block_start <= block_end:
-            block = df.loc[block_start:block_end]
-            if not block.empty:
-                blocks.append(block)
-    return blocks
+    boundaries = pd.date_range(start=index[0].floor(freq),
+                               end=index[-1].ceil(freq), freq=freq)
+    starts = index.searchsorted(boundaries[:-1] + start_offset, side='left')
+    stops = index.searchsorted(boundaries[1:], side='right')
+    keep = stops > starts
+    return starts[keep], stops[keep]
 
 
-def resample(df):
+def resample(df, min_count=1):
     """
     Resample a time-indexed DataFrame to 30‑minute intervals using column‑specific
     aggregation rules.
@@ -516,38 +1342,265 @@ def resample(df):
        which are aggregated by summation.
     2. **Average columns**: all remaining columns, which are aggregated by mean.
 
+    Each group is reduced at once with the built-in ``sum`` and ``mean`` of
+    the pandas resampler. Missing values are skipped, so an interval whose
+    records are all NaN sums to 0 and averages to NaN.
+
     Parameters
     ----------
     df : pandas.DataFrame
         Input DataFrame with a ``DatetimeIndex``. Values represent higher
         frequency measurements (typically 1‑minute resolution).
+    min_count : int, optional
+        Minimum number of records (missing values included) in an interval.
+        All columns of intervals with fewer records are set to NaN. The
+        default is 1, which only discards intervals without any record.
 
     Returns
     -------
     pandas.DataFrame
-        A DataFrame resampled to 30‑minute intervals. Columns matching
-        ``"_Tot"`` or ``"_aggregate"`` are summed, and all other columns are
-        averaged.
+        A DataFrame resampled to 30‑minute intervals, with the columns of
+        ``df`` in the same order. Columns matching ``"_Tot"`` or
+        ``"_aggregate"`` are summed, and all other columns are averaged.
 
     """
     # Identify columns that are summed and columns that are averaged.
     col_to_sum = df.filter(regex=('_Tot|_aggregate')).columns
     col_to_average = df.columns.difference(col_to_sum, sort=False)
-    func_all = {**{col_to_sum[i]: lambda x: x.sum() if len(x) >= 1 else None for i in range(len(col_to_sum))},
-                **{col_to_average[i]: lambda x: x.mean() if len(x) >= 1 else None for i in range(len(col_to_average))}}
 
-    # Resample the minute columns into 30-min using function defined for each column
-    return df.resample('30min').agg(func_all)
+    # Resample each group of columns with a single reduction
+    resampler = df.resample('30min')
+    df_30min = pd.concat([resampler[list(col_to_sum)].sum(),
+                          resampler[list(col_to_average)].mean()], axis=1)
+
+    # Discard intervals without enough records
+    enough_records = resampler.size() >= min_count
+    return df_30min[df.columns].where(enough_records, np.nan, axis=0)
 
 
-def load_cache(tob3_cache_file):
-    if tob3_cache_file.exists():
-        df = pd.read_csv(tob3_cache_file, parse_dates=["first_ts", "last_ts"])
-        return dict(zip(df["path"], zip(df["first_ts"], df["last_ts"])))
-    return {}
+def cache_path(station_name_raw):
+    """
+    Path to the cache of a station, that stores the first/last timestamps of
+    its binary files and the files that failed to be read or converted.
+    """
+    return Path(".", "Logs", f"{station_name_raw}_tob3_timestamps_cache.sqlite")
 
 
-def append_to_cache(tob3_cache_file, rows):
-    df = pd.DataFrame(rows, columns=["path", "first_ts", "last_ts"])
-    header = not tob3_cache_file.exists()
-    df.to_csv(tob3_cache_file, mode="a", index=False, header=header)
\ No newline at end of file
+def open_cache(tob3_cache_file):
+    """
+    Open the SQLite index of TOB3 first/last timestamps, and create it if it
+    does not exist.
+
+    The database uses write-ahead logging so that several processes can read
+    it while another one writes to it.
+
+    Parameters
+    ----------
+    tob3_cache_file : pathlib.Path
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(tob3_cache_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tob3_timestamps ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+        "header_hash TEXT, first_ts TEXT, last_ts TEXT, "
+        "table_name TEXT, span_start TEXT)")
+    # Columns added after the creation of the cache
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tob3_timestamps)")}
+    for column in ('table_name', 'span_start'):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE tob3_timestamps ADD COLUMN {column} TEXT")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tob3_failures ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+        "header_hash TEXT, stage TEXT, reason TEXT, failed_at TEXT)")
+    conn.commit()
+    return conn
+
+
+def file_identity(file, hash_header=False):
+    """
+    Return the identity used to validate cache entries of a binary file.
+
+    Parameters
+    ----------
+    file : str or pathlib.Path
+        Path to the binary file.
+    hash_header : bool, optional
+        Also compute a SHA-1 hash of the 6-line TOB3 header. The default is
+        False.
+
+    Returns
+    -------
+    tuple of (int, int, str or None)
+        ``(size, mtime_ns, header_hash)``
+    """
+    stat = os.stat(file)
+    header_hash = None
+    if hash_header:
+        with open(file, 'rb') as f:
+            header = b''.join(f.readline() for _ in range(6))
+        header_hash = hashlib.sha1(header).hexdigest()
+    return stat.st_size, stat.st_mtime_ns, header_hash
+
+
+def lookup_cache(conn, path, identity):
+    """
+    Return the cached (first_ts, last_ts, table_name, span_start) of a file,
+    or None if the file is not in cache or changed since it was cached.
+    ``first_ts`` is the start of the first complete block expected from the
+    file, while ``span_start`` is the timestamp of its first record.
+    ``table_name`` and ``span_start`` are None for entries cached before
+    they were recorded.
+    """
+    row = conn.execute(
+        "SELECT size, mtime_ns, header_hash, first_ts, last_ts, table_name, "
+        "span_start FROM tob3_timestamps WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return None
+    if not _same_identity(row[:3], identity):
+        return None
+    span_start = pd.Timestamp(row[6]) if row[6] else None
+    return pd.Timestamp(row[3]), pd.Timestamp(row[4]), row[5], span_start
+
+
+def _same_identity(stored, identity):
+    """
+    Compare a stored (size, mtime_ns, header_hash) with the current identity
+    of a file. Header hashes are only compared when both are known.
+    """
+    if tuple(stored[:2]) != tuple(identity[:2]):
+        return False
+    if identity[2] and stored[2] and stored[2] != identity[2]:
+        return False
+    return True
+
+
+def upsert_cache(conn, rows):
+    """
+    Insert or replace cache entries in a single transaction.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by :func:`open_cache`.
+    rows : list of tuple
+        ``(path, size, mtime_ns, header_hash, first_ts, last_ts, table_name,
+        span_start)``. ``table_name`` and ``span_start`` may be None.
+    """
+    with conn:
+        conn.executemany(
+            "INSERT INTO tob3_timestamps (path, size, mtime_ns, header_hash, "
+            "first_ts, last_ts, table_name, span_start) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET size=excluded.size, "
+            "mtime_ns=excluded.mtime_ns, header_hash=excluded.header_hash, "
+            "first_ts=excluded.first_ts, last_ts=excluded.last_ts, "
+            "table_name=excluded.table_name, span_start=excluded.span_start",
+            [(path, size, mtime_ns, header_hash, str(first_ts), str(last_ts),
+              table_name, None if span_start is None else str(span_start))
+             for path, size, mtime_ns, header_hash, first_ts, last_ts,
+             table_name, span_start in rows])
+
+
+def migrate_csv_cache(conn, legacy_cache_file):
+    """
+    Import the entries of the former CSV cache, which was keyed on the path
+    only. Entries are stamped with the current identity of the files that
+    still exist.
+    """
+    df = pd.read_csv(legacy_cache_file, parse_dates=["first_ts", "last_ts"])
+    rows = []
+    for path, first_ts, last_ts in zip(df["path"], df["first_ts"], df["last_ts"]):
+        if os.path.exists(path):
+            rows.append((path, *file_identity(path), first_ts, last_ts, None, None))
+    upsert_cache(conn, rows)
+
+
+def lookup_failure(conn, path, identity):
+    """
+    Return the reason why a file previously failed, or None if it did not
+    fail or changed since the failure.
+    """
+    row = conn.execute(
+        "SELECT size, mtime_ns, header_hash, reason "
+        "FROM tob3_failures WHERE path = ?", (path,)).fetchone()
+    if row is None or not _same_identity(row[:3], identity):
+        return None
+    return row[3]
+
+
+def record_failures(conn, rows):
+    """
+    Insert or replace failure entries in a single transaction.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by :func:`open_cache`.
+    rows : list of tuple
+        ``(path, size, mtime_ns, header_hash, stage, reason)`` where
+        ``stage`` is 'scan' or 'convert'.
+    """
+    failed_at = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+    with conn:
+        conn.executemany(
+            "INSERT INTO tob3_failures VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET size=excluded.size, "
+            "mtime_ns=excluded.mtime_ns, header_hash=excluded.header_hash, "
+            "stage=excluded.stage, reason=excluded.reason, "
+            "failed_at=excluded.failed_at",
+            [(*row, failed_at) for row in rows])
+
+
+def list_failures(station_name_raw):
+    """
+    List the binary files of a station that failed to be read or converted.
+
+    Parameters
+    ----------
+    station_name_raw : str
+        Name of the station as stored in the raw data.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per failed file with its identity, the stage that failed
+        ('scan' or 'convert'), the reason and the time of the failure.
+    """
+    conn = open_cache(cache_path(station_name_raw))
+    df = pd.read_sql_query(
+        "SELECT * FROM tob3_failures ORDER BY failed_at, path", conn)
+    conn.close()
+    return df
+
+
+def clear_failures(station_name_raw, paths=None):
+    """
+    Forget failures so that the files are tried again on the next run.
+
+    Parameters
+    ----------
+    station_name_raw : str
+        Name of the station as stored in the raw data.
+    paths : list of str, optional
+        Files to forget. All failures of the station are forgotten if None.
+    """
+    conn = open_cache(cache_path(station_name_raw))
+    _delete_failures(conn, paths)
+    conn.close()
+
+
+def _delete_failures(conn, paths=None):
+    with conn:
+        if paths is None:
+            conn.execute("DELETE FROM tob3_failures")
+        else:
+            conn.executemany("DELETE FROM tob3_failures WHERE path = ?",
+                             [(str(p),) for p in paths])
@@ -9,6 +9,10 @@ import pandas as pd
 from utils import data_loader as dl
 from datetime import datetime
 
+# Sidecar index of the timestamps of the full_output files, in the output
+# directory of each station (see ``processed_timestamps``)
+TIMESTAMP_INDEX = 'processed_timestamps.npz'
+
 def run(station_name,csv_folder,eddypro_config_dir,eddypro_out_dir,dates):
     """Calls EddyPro software in command lines with arguments specified in the
     config file
@@ -33,52 +37,18 @@ def run(station_name,csv_folder,eddypro_config_dir,eddypro_out_dir,dates):
 
     station_eddypro_out_dir = eddypro_out_dir.joinpath(station_name)
     station_csv_folder = csv_folder.joinpath(station_name)
-    
-    # Construct a datime index with previous EddyPro full_output files.
-    output_list = list(station_eddypro_out_dir.glob('*full_output*.csv'))
-        
-    index_list = []
-    for i_file in output_list:
-        df = dl.eddypro_fulloutput_file(i_file)
-        if not df.index.empty:
-            index_list.append(df.index)
-    
-    if index_list:
-        timestamps = pd.DatetimeIndex(np.concatenate(index_list))
-        timestamps = timestamps.sort_values().unique()
-    else:
-        timestamps = pd.DatetimeIndex([], dtype="datetime64[ns]")
-        
-    # Identify the timestamps in the date range that are not in the EddyPro 
+
+    # Identify the timestamps in the date range that are not in the EddyPro
     # output files
-    missing_timestamps = pd.DatetimeIndex(
-        set(pd.date_range(dates['start'], dates['end'], freq='30min'))
-        - set(timestamps)
-        ).sort_values()
-    
+    missing_timestamps = find_missing_timestamps(station_eddypro_out_dir, dates)
+
     # Exit if everything has been ran
     if len(missing_timestamps)==0:
         return
-            
-    # Check the EddyPro configuration folder, list the EddyPro configuration 
+
+    # Check the EddyPro configuration folder, list the EddyPro configuration
     # files for the station, store their path, their validity period
-    config_files = list(eddypro_config_dir.glob(f'*{station_name}*.eddypro'))
-    eddypro_configs = []
-    for path in config_files:
-        name = path.stem
-        config_dates = name.replace(f'{station_name}_','')
-        start_str, end_str = config_dates.split("-")
-        start = datetime.strptime(start_str, "%Y%m%d_%H%M")
-        if end_str == "current":
-            end = datetime(2100, 1, 1)
-        else:
-            end = datetime.strptime(end_str, "%Y%m%d_%H%M")
-    
-        eddypro_configs.append({
-            "path": path,
-            "start": start,
-            "end": end,
-        })
+    eddypro_configs = list_configs(eddypro_config_dir, station_name)
 
     for config in eddypro_configs:
         
@@ -142,6 +112,155 @@ def run(station_name,csv_folder,eddypro_config_dir,eddypro_out_dir,dates):
         process=os.path.join("./Bin","EddyPro","bin","eddypro_rp.exe")
         subprocess.call([process, config['path']])
 
+    # Index the new full_output files
+    processed_timestamps(station_eddypro_out_dir)
+
     print('Done!')
 
 
+def processed_timestamps(station_eddypro_out_dir):
+    """
+    Timestamps of the half-hours found in the EddyPro full_output files of a
+    station.
+
+    The timestamps of each file are kept in a sidecar index in the output
+    directory (``TIMESTAMP_INDEX``), along with the size and modification
+    time of the file, so that only the files that are new or changed since
+    the last call are read. The index is updated on each call.
+
+    Parameters
+    ----------
+    station_eddypro_out_dir : pathlib.Path
+        Directory of the EddyPro outputs of the station.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        Sorted unique timestamps.
+    """
+    index_file = station_eddypro_out_dir.joinpath(TIMESTAMP_INDEX)
+    index = read_timestamp_index(index_file)
+
+    entries = {}
+    for i_file in sorted(station_eddypro_out_dir.glob('*full_output*.csv')):
+        stat = i_file.stat()
+        entry = index.get(i_file.name)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            df = dl.eddypro_fulloutput_file(i_file)
+            entry = (stat.st_mtime_ns, stat.st_size,
+                     df.index.values.astype('datetime64[m]'))
+        entries[i_file.name] = entry
+
+    if entries.keys() != index.keys() or any(
+            entries[k][:2] != index[k][:2] for k in entries):
+        write_timestamp_index(index_file, entries)
+
+    if entries:
+        timestamps = np.unique(np.concatenate([e[2] for e in entries.values()]))
+    else:
+        timestamps = np.array([], dtype='datetime64[m]')
+    return pd.DatetimeIndex(timestamps.astype('datetime64[ns]'))
+
+
+def read_timestamp_index(index_file):
+    """
+    Read the sidecar index of ``processed_timestamps``.
+
+    Returns
+    -------
+    dict
+        ``{file name: (mtime_ns, size, timestamps)}``, empty if the index
+        does not exist or cannot be read.
+    """
+    if not index_file.exists():
+        return {}
+    try:
+        with np.load(index_file) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+    except Exception:
+        return {}
+    bounds = np.r_[0, np.cumsum(arrays['counts'])]
+    return {str(name): (int(mtime), int(size), arrays['timestamps'][lo:hi])
+            for name, mtime, size, lo, hi in zip(
+                arrays['files'], arrays['mtimes'], arrays['sizes'],
+                bounds[:-1], bounds[1:])}
+
+
+def write_timestamp_index(index_file, entries):
+    """
+    Write the sidecar index of ``processed_timestamps``, replacing the
+    previous one only once complete.
+    """
+    tmp_file = index_file.with_name(index_file.name + '.tmp')
+    with open(tmp_file, 'wb') as fp:
+        np.savez(fp,
+                 files=np.array(list(entries), dtype=str),
+                 mtimes=np.array([e[0] for e in entries.values()], dtype=np.int64),
+                 sizes=np.array([e[1] for e in entries.values()], dtype=np.int64),
+                 counts=np.array([len(e[2]) for e in entries.values()], dtype=np.int64),
+                 timestamps=np.concatenate(
+                     [e[2] for e in entries.values()]
+                     + [np.array([], dtype='datetime64[m]')]))
+    os.replace(tmp_file, index_file)
+
+
+def find_missing_timestamps(station_eddypro_out_dir, dates):
+    """
+    Half-hours of a date range that are not in the EddyPro full_output files
+    of a station.
+
+    Parameters
+    ----------
+    station_eddypro_out_dir : pathlib.Path
+        Directory of the EddyPro outputs of the station.
+    dates : dict
+        'start' and 'end' of the date range.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        Sorted missing timestamps.
+    """
+    timestamps = processed_timestamps(station_eddypro_out_dir)
+    expected = pd.date_range(dates['start'], dates['end'], freq='30min')
+    return pd.DatetimeIndex(np.setdiff1d(
+        expected.values, timestamps.values.astype(expected.values.dtype),
+        assume_unique=True))
+
+
+def list_configs(eddypro_config_dir, station_name):
+    """
+    List the EddyPro configuration files of a station and their validity
+    period, given by their name: ``{station}_{start}-{end}.eddypro``, with
+    dates as ``YYYYMMDD_HHMM`` and ``end`` possibly 'current'.
+
+    Parameters
+    ----------
+    eddypro_config_dir : pathlib.Path
+        Directory of the .eddypro and .metadata files.
+    station_name : str
+        Name of the station.
+
+    Returns
+    -------
+    list of dict
+        'path', 'start' and 'end' of each configuration.
+    """
+    config_files = list(eddypro_config_dir.glob(f'*{station_name}*.eddypro'))
+    eddypro_configs = []
+    for path in config_files:
+        name = path.stem
+        config_dates = name.replace(f'{station_name}_','')
+        start_str, end_str = config_dates.split("-")
+        start = datetime.strptime(start_str, "%Y%m%d_%H%M")
+        if end_str == "current":
+            end = datetime(2100, 1, 1)
+        else:
+            end = datetime.strptime(end_str, "%Y%m%d_%H%M")
+
+        eddypro_configs.append({
+            "path": path,
+            "start": start,
+            "end": end,
+        })
+    return eddypro_configs
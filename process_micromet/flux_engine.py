@@ -0,0 +1,1611 @@
+# -*- coding: utf-8 -*-
+"""
+Half-hourly eddy covariance fluxes computed with NumPy, from the settings of
+the EddyPro projects of the stations.
+
+The .eddypro and .metadata files used by ``eddypro.run`` are read to know the
+layout of the 10 Hz files, the processing options and the site description.
+Half-hours are loaded and processed in batches, as arrays of shape
+(half-hours, samples), and the results are written as EddyPro full_output
+files, so that they are picked up by ``eddypro.find_missing_timestamps`` and
+merged like the EddyPro outputs::
+
+    flux_engine.run(station, csv_folder, eddypro_config_dir, eddypro_out_dir,
+                    dates, n_workers=4)
+
+Processing options implemented:
+    - raw data: gain and offset, unit conversion, flag columns
+      (flagN_column), despiking (filter_sr), absolute limits (filter_al) and
+      maximum of missing records (max_lack);
+    - statistical tests of Vickers and Mahrt (1997) (test_sr, test_ar,
+      test_do, test_al, test_sk, see ``statistical_tests``);
+    - rotation (rot_meth): none, double rotation, planar fit with or
+      without velocity bias, by wind sector, estimated on the half-hours of
+      the configuration period (see ``planar_fit``);
+    - detrending (detrend_meth): block average (0) and linear (1);
+    - time lags (tlag_meth): constant, covariance maximization with or
+      without default, within the time lag window of the metadata (see
+      ``time_lag``);
+    - fluxes: Tau, H (with the humidity correction of the sonic temperature),
+      LE, H2O, CO2 and CH4 with the WPL terms for molar densities, or the
+      dilution term for mole fractions;
+    - quality flags (qc_meth): 0-1-2 scheme of Mauder and Foken (2004), from
+      the steady state test and the integral turbulence characteristics of w;
+    - random errors (ru_meth): Finkelstein and Sims (2001);
+    - storage fluxes from the mean values of consecutive half-hours.
+
+The despiking of Mauder et al. (2013) (despike_vm=1), the discontinuity,
+time lag, angle of attack and non-steady horizontal wind tests, the footprint
+and the spectroscopic correction of the LI-7700 are not applied. The
+configurations asking for options that are not implemented (see
+``IMPLEMENTED_OPTIONS``: spectral corrections, triple rotation, running mean
+and exponentially weighted detrending) are skipped, so that their half-hours
+remain missing for EddyPro.
+"""
+import os
+import configparser
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pysolar # conda install -c conda-forge pysolar
+from tqdm import tqdm
+from joblib import Parallel, delayed
+from . import eddypro
+from . import hf_loader
+from . import planar_fit
+from . import statistical_tests
+from . import time_lag
+
+# Physical constants
+R = 8.31451         # Universal gas constant [J mol-1 K-1]
+MD = 0.02897        # Molar mass of dry air [kg mol-1]
+MV = 0.01802        # Molar mass of water vapour [kg mol-1]
+CPD = 1004.67       # Specific heat of dry air [J kg-1 K-1]
+CPV = 1859.         # Specific heat of water vapour [J kg-1 K-1]
+G = 9.81            # Gravitational acceleration [m s-2]
+VON_KARMAN = 0.41
+OMEGA = 7.2921e-5   # Angular velocity of the Earth [rad s-1]
+
+# Molar mass of the gases [g mol-1]
+GAS_MOLAR_MASS = {'co2': 44.01, 'h2o': 18.02, 'ch4': 16.04}
+
+# Units of the mole fractions and mixing ratios written, relative to mol mol-1
+GAS_SCALE = {'co2': 1e6, 'h2o': 1e3, 'ch4': 1e6}
+
+# Conversion of the input units to m s-1, K, Pa, mmol m-3 (molar densities) or
+# mol mol-1 (mole fractions and mixing ratios)
+UNIT_FACTORS = {
+    'm_sec': (1, 0),
+    'cm_sec': (1e-2, 0),
+    'mm_sec': (1e-3, 0),
+    'celsius': (1, 273.15),
+    'kelvin': (1, 0),
+    'pa': (1, 0),
+    'hpa': (1e2, 0),
+    'kpa': (1e3, 0),
+    'ppm': (1e-6, 0),
+    'ppt': (1e-3, 0),
+    'ppb': (1e-9, 0),
+    'mmol_m3': (1, 0),
+    'umol_m3': (1e-3, 0),
+    }
+
+# Variables of the metadata used by the engine. The other numeric columns are
+# averaged and written as {variable}_mean
+WIND_VARIABLES = ['u', 'v', 'w', 'ts']
+GASES = ['co2', 'h2o', 'ch4']
+AMBIENT_VARIABLES = ['air_t', 'air_p']
+
+# Columns of the full_output files, in order, and their units
+FULL_OUTPUT_UNITS = {
+    'filename': '',
+    'date': 'yyyy-mm-dd',
+    'time': 'HH:MM',
+    'DOY': 'ddd.ddd',
+    'daytime': '1=daytime',
+    'file_records': '#',
+    'used_records': '#',
+    'Tau': 'kg+1m-1s-2',
+    'qc_Tau': '#',
+    'rand_err_Tau': 'kg+1m-1s-2',
+    'H': 'W+1m-2',
+    'qc_H': '#',
+    'rand_err_H': 'W+1m-2',
+    'LE': 'W+1m-2',
+    'qc_LE': '#',
+    'rand_err_LE': 'W+1m-2',
+    'co2_flux': 'µmol+1s-1m-2',
+    'qc_co2_flux': '#',
+    'rand_err_co2_flux': 'µmol+1s-1m-2',
+    'h2o_flux': 'mmol+1s-1m-2',
+    'qc_h2o_flux': '#',
+    'rand_err_h2o_flux': 'mmol+1s-1m-2',
+    'ch4_flux': 'µmol+1s-1m-2',
+    'qc_ch4_flux': '#',
+    'rand_err_ch4_flux': 'µmol+1s-1m-2',
+    'H_strg': 'W+1m-2',
+    'LE_strg': 'W+1m-2',
+    'co2_strg': 'µmol+1s-1m-2',
+    'h2o_strg': 'mmol+1s-1m-2',
+    'ch4_strg': 'µmol+1s-1m-2',
+    'co2_molar_density': 'mmol+1m-3',
+    'co2_mole_fraction': 'µmol+1mol_a-1',
+    'co2_mixing_ratio': 'µmol+1mol_d-1',
+    'co2_time_lag': 's',
+    'co2_def_timelag': '1=default',
+    'h2o_molar_density': 'mmol+1m-3',
+    'h2o_mole_fraction': 'mmol+1mol_a-1',
+    'h2o_mixing_ratio': 'mmol+1mol_d-1',
+    'h2o_time_lag': 's',
+    'h2o_def_timelag': '1=default',
+    'ch4_molar_density': 'mmol+1m-3',
+    'ch4_mole_fraction': 'µmol+1mol_a-1',
+    'ch4_mixing_ratio': 'µmol+1mol_d-1',
+    'ch4_time_lag': 's',
+    'ch4_def_timelag': '1=default',
+    'sonic_temperature': 'K',
+    'air_temperature': 'K',
+    'air_pressure': 'Pa',
+    'air_density': 'kg+1m-3',
+    'air_heat_capacity': 'J+1kg-1K-1',
+    'air_molar_volume': 'm+3mol-1',
+    'ET': 'mm+1hour-1',
+    'water_vapor_density': 'kg+1m-3',
+    'e': 'Pa',
+    'es': 'Pa',
+    'specific_humidity': 'kg+1kg-1',
+    'RH': '%',
+    'VPD': 'Pa',
+    'Tdew': 'K',
+    'u_unrot': 'm+1s-1',
+    'v_unrot': 'm+1s-1',
+    'w_unrot': 'm+1s-1',
+    'u_rot': 'm+1s-1',
+    'v_rot': 'm+1s-1',
+    'w_rot': 'm+1s-1',
+    'wind_speed': 'm+1s-1',
+    'max_wind_speed': 'm+1s-1',
+    'wind_dir': 'deg_from_north',
+    'yaw': 'deg',
+    'pitch': 'deg',
+    'roll': 'deg',
+    'u*': 'm+1s-1',
+    'TKE': 'm+2s-2',
+    'L': 'm',
+    '(z-d)/L': '#',
+    'bowen_ratio': '#',
+    'T*': 'K',
+    'u_var': 'm+2s-2',
+    'v_var': 'm+2s-2',
+    'w_var': 'm+2s-2',
+    'ts_var': 'K+2',
+    'co2_var': '--',
+    'h2o_var': '--',
+    'ch4_var': '--',
+    'w/ts_cov': 'm+1K+1s-1',
+    'w/co2_cov': '--',
+    'w/h2o_cov': '--',
+    'w/ch4_cov': '--',
+    'u_spikes': '#',
+    'v_spikes': '#',
+    'w_spikes': '#',
+    'ts_spikes': '#',
+    'co2_spikes': '#',
+    'h2o_spikes': '#',
+    'ch4_spikes': '#',
+    'spikes_hf': '8u/v/w/ts/co2/h2o/ch4/none',
+    'amplitude_resolution_hf': '8u/v/w/ts/co2/h2o/ch4/none',
+    'drop_out_hf': '8u/v/w/ts/co2/h2o/ch4/none',
+    'absolute_limits_hf': '8u/v/w/ts/co2/h2o/ch4/none',
+    'skewness_kurtosis_hf': '8u/v/w/ts/co2/h2o/ch4/none',
+    'skewness_kurtosis_sf': '8u/v/w/ts/co2/h2o/ch4/none',
+    }
+
+# Columns of the statistical tests in the full_output files, with the
+# setting enabling them and their bit in the flags of ``statistical_tests``,
+# and the variables of their codes ('none' for N2O)
+TEST_COLUMNS = {
+    'spikes_hf': ('test_sr', 'spikes'),
+    'amplitude_resolution_hf': ('test_ar', 'amplitude_resolution'),
+    'drop_out_hf': ('test_do', 'dropouts'),
+    'absolute_limits_hf': ('test_al', 'absolute_limits'),
+    'skewness_kurtosis_hf': ('test_sk', 'skewness_kurtosis_hf'),
+    'skewness_kurtosis_sf': ('test_sk', 'skewness_kurtosis_sf'),
+    }
+TEST_CODE_VARIABLES = WIND_VARIABLES + GASES + ['n2o']
+# Values of the EddyPro options implemented by the engine
+IMPLEMENTED_OPTIONS = {
+    'hf_meth': (0,),
+    'lf_meth': (0,),
+    'rot_meth': (0, 1, 3, 4),
+    'detrend_meth': (0, 1),
+    }
+
+
+def run(station_name, csv_folder, eddypro_config_dir, eddypro_out_dir, dates,
+        batch_size=48, n_workers=1):
+    """
+    Compute the fluxes of the half-hours of a date range that are not in the
+    EddyPro outputs of a station, with the EddyPro configuration of each
+    half-hour. Same arguments as ``eddypro.run``. Configurations asking for
+    options that are not implemented (see ``unsupported_options``) are
+    logged and skipped: their half-hours are left to ``eddypro.run``.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    csv_folder : pathlib.Path
+        Directory of the 10 Hz files, one subdirectory per station.
+    eddypro_config_dir : pathlib.Path
+        Directory of the .eddypro and .metadata files.
+    eddypro_out_dir : pathlib.Path
+        Directory of the outputs, one subdirectory per station.
+    dates : dict
+        'start' and 'end' of the date range.
+    batch_size : int, optional
+        Number of half-hours loaded and processed together. The default is
+        48 (one day).
+    n_workers : int, optional
+        Number of worker processes computing batches concurrently. The
+        results are collected and written by the calling process. The
+        default is 1 (serial).
+
+    Returns
+    -------
+    None. Write a full_output file per configuration in the station output
+    directory. Skipped configurations and half-hours that could not be
+    loaded are logged in ./Logs/flux_engine_{station}.log
+    """
+    print(f'Start computing the fluxes of the {station_name} station')
+
+    station_eddypro_out_dir = eddypro_out_dir.joinpath(station_name)
+    station_csv_folder = csv_folder.joinpath(station_name)
+
+    missing_timestamps = eddypro.find_missing_timestamps(station_eddypro_out_dir, dates)
+    if len(missing_timestamps)==0:
+        return
+
+    logf = open(os.path.join('.', 'Logs', f'flux_engine_{station_name}.log'), "w")
+
+    for config, settings, timestamps, results in map_configs(
+            station_name, csv_folder, eddypro_config_dir, missing_timestamps,
+            process_batch, batch_size=batch_size, n_workers=n_workers):
+
+        unsupported = unsupported_options(settings)
+        if unsupported:
+            # The batches are only dispatched when results is iterated
+            logf.write(f'{config["path"].name}: {", ".join(unsupported)} not implemented '
+                       'by the flux engine, configuration skipped\n')
+            continue
+
+        if settings['rot_meth'] in (3, 4):
+            avrg_len = pd.Timedelta(minutes=settings['avrg_len'])
+            try:
+                settings['planar_fit'] = update_planar_fit(
+                    station_name, config, settings, station_csv_folder,
+                    timestamps[-1] - avrg_len, station_eddypro_out_dir,
+                    batch_size, n_workers)
+            except ValueError as e:
+                # Too few half-hours yet in the configuration period
+                logf.write(f'{config["path"].name}: {str(e)}, double rotation used instead\n')
+                settings['rot_meth'] = 1
+
+        frames = []
+        progress = tqdm(total=len(timestamps), desc=f'{station_name}: Computing fluxes')
+        for df, errors in results:
+            for error in errors:
+                logf.write(error)
+            frames.append(df)
+            progress.update(len(df))
+        progress.close()
+
+        df = add_storage_fluxes(pd.concat(frames), settings)
+
+        out_file = station_eddypro_out_dir.joinpath(
+            f"eddypro_{settings['project_id']}_full_output_"
+            f"{datetime.now().strftime('%Y-%m-%dT%H%M%S')}_flux_engine.csv")
+        write_full_output(df, out_file)
+
+    # Index the new full_output files
+    eddypro.processed_timestamps(station_eddypro_out_dir)
+
+    # Close error log file
+    logf.close()
+    print('Done!')
+
+
+def time_lag_climatology(station_name, csv_folder, eddypro_config_dir, dates,
+                         batch_size=48, n_workers=1):
+    """
+    Optimal time lags of the gases of a station over a date range, with the
+    lag window of the metadata file of each half-hour.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    csv_folder : pathlib.Path
+        Directory of the 10 Hz files, one subdirectory per station.
+    eddypro_config_dir : pathlib.Path
+        Directory of the .eddypro and .metadata files.
+    dates : dict
+        'start' and 'end' of the date range.
+    batch_size : int, optional
+        Number of half-hours loaded and processed together. The default is
+        48 (one day).
+    n_workers : int, optional
+        Number of worker processes. The default is 1 (serial).
+
+    Returns
+    -------
+    lags : pandas.DataFrame
+        '{gas}_time_lag' [s] and the covariance 'w/{gas}_cov' at that lag,
+        indexed by the end of the half-hours.
+    histograms : dict
+        Number of half-hours per time lag [s] (pandas.Series) of each gas.
+    """
+    timestamps = pd.date_range(dates['start'], dates['end'], freq='30min')
+
+    frames = []
+    histograms = {}
+    for config, settings, config_timestamps, results in map_configs(
+            station_name, csv_folder, eddypro_config_dir, timestamps,
+            batch_time_lags, batch_size=batch_size, n_workers=n_workers):
+        unsupported = unsupported_options(settings, ['detrend_meth'])
+        if unsupported:
+            print(f'{config["path"].name}: {", ".join(unsupported)} not implemented, '
+                  'configuration skipped')
+            continue
+        n_batches = int(np.ceil(len(config_timestamps) / batch_size))
+        for df, batch_histograms in tqdm(results, total=n_batches,
+                                         desc=f'{station_name}: Time lags'):
+            frames.append(df)
+            for gas, histogram in batch_histograms.items():
+                if gas in histograms:
+                    histogram = histograms[gas].add(histogram, fill_value=0).astype(int)
+                histograms[gas] = histogram
+
+    lags = pd.concat(frames).sort_index() if frames else pd.DataFrame()
+    return lags, histograms
+
+
+def map_configs(station_name, csv_folder, eddypro_config_dir, timestamps, func,
+                args=(), batch_size=48, n_workers=1):
+    """
+    Apply a function to batches of half-hours of a station, with the EddyPro
+    configuration of each half-hour. Half-hours without a 10 Hz file are
+    skipped.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    csv_folder : pathlib.Path
+        Directory of the 10 Hz files, one subdirectory per station.
+    eddypro_config_dir : pathlib.Path
+        Directory of the .eddypro and .metadata files.
+    timestamps : pandas.DatetimeIndex
+        End of the half-hours.
+    func : callable
+        Called as ``func(files, timestamps, settings, *args)`` on each batch.
+        It must be picklable if ``n_workers > 1``.
+    args : tuple, optional
+        Other arguments of ``func``. The default is ().
+    batch_size : int, optional
+        Number of half-hours per batch. The default is 48 (one day).
+    n_workers : int, optional
+        Number of worker processes computing batches concurrently. The
+        default is 1 (serial).
+
+    Yields
+    ------
+    config : dict
+        Configuration period, see ``eddypro.list_configs``.
+    settings : dict
+        See ``read_settings``.
+    timestamps : list of pandas.Timestamp
+        End of the half-hours of the period that have a 10 Hz file.
+    results : generator
+        Result of ``func`` for each batch, in order. Batches are dispatched
+        when ``results`` is first iterated, so that ``settings`` can still be
+        completed, e.g. with the planar fit coefficients.
+    """
+    station_csv_folder = csv_folder.joinpath(station_name)
+
+    for config in eddypro.list_configs(eddypro_config_dir, station_name):
+        config_timestamps = timestamps.intersection(
+            pd.date_range(config['start'], config['end'], freq='30min'))
+        if len(config_timestamps) == 0:
+            continue
+
+        settings = read_settings(config['path'])
+
+        # Files are named after the start of their half-hour, while the
+        # results are labelled with its end
+        avrg_len = pd.Timedelta(minutes=settings['avrg_len'])
+        found = [(f, t) for f, t in
+                 ((station_csv_folder.joinpath(raw_file_name(settings, t - avrg_len)), t)
+                  for t in config_timestamps) if f.exists()]
+        if not found:
+            continue
+        files, config_timestamps = map(list, zip(*found))
+
+        yield (config, settings, config_timestamps,
+               _map_batches(func, files, config_timestamps, settings, args,
+                            batch_size, n_workers))
+
+
+def _map_batches(func, files, timestamps, settings, args, batch_size, n_workers):
+    """
+    Results of ``func`` on the batches of a configuration period. See
+    ``map_configs``.
+    """
+    batches = [(files[i:i + batch_size], timestamps[i:i + batch_size])
+               for i in range(0, len(files), batch_size)]
+    if n_workers > 1:
+        yield from Parallel(n_jobs=n_workers, return_as='generator')(
+            delayed(func)(batch_files, batch_timestamps, settings, *args)
+            for batch_files, batch_timestamps in batches)
+    else:
+        for batch_files, batch_timestamps in batches:
+            yield func(batch_files, batch_timestamps, settings, *args)
+
+
+def batch_time_lags(files, timestamps, settings):
+    """
+    Optimal time lags of the gases for a batch of half-hours. See
+    ``time_lag_climatology``.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Time lags and covariances.
+    histograms : dict
+        Number of half-hours per time lag [s] of each gas.
+    """
+    columns = settings['columns']
+    fs = settings['acquisition_frequency']
+    gases = [g for g in GASES if g in columns]
+    data, _, _, _, _ = load_batch(files, settings, gases)
+
+    if settings['rot_meth'] == 0:
+        w = data['w']
+    else:
+        w = double_rotation(data['u'], data['v'], data['w'])[2]
+    w = detrend(w, settings['detrend_meth'])
+
+    out = {}
+    histograms = {}
+    for gas in gases:
+        min_lag = int(round(columns[gas]['min_timelag'] * fs))
+        max_lag = int(round(columns[gas]['max_timelag'] * fs))
+        lag, cov, histogram = time_lag.optimize(
+            w, detrend(data[gas], settings['detrend_meth']), min_lag, max_lag)
+        valid = np.isfinite(cov)
+        out[f'{gas}_time_lag'] = np.where(valid, lag / fs, np.nan)
+        out[f'w/{gas}_cov'] = cov
+        histograms[gas] = pd.Series(
+            histogram, index=np.round(np.arange(min_lag, max_lag + 1) / fs, 6),
+            name=f'{gas}_time_lag')
+    return pd.DataFrame(out, index=pd.DatetimeIndex(timestamps, name='timestamp')), histograms
+
+
+def read_settings(eddypro_file):
+    """
+    Read the processing settings of an EddyPro project and its metadata file
+    (same name, .metadata suffix).
+
+    Parameters
+    ----------
+    eddypro_file : pathlib.Path
+        Path to the .eddypro file.
+
+    Returns
+    -------
+    settings : dict
+        Processing options, site and instrument description, and 'columns':
+        ``{variable: {'index', 'measure_type', 'unit_in', 'a_value',
+        'b_value', 'nom_timelag', 'min_timelag', 'max_timelag'}}`` for the
+        numeric columns of the raw files, where 'index' is 0-based. The
+        nominal time lag defaults to the middle of the time lag window.
+    """
+    project = _read_ini(eddypro_file)
+    metadata = _read_ini(eddypro_file.with_suffix('.metadata'))
+
+    proj = project['Project']
+    general = project['RawProcess_General']
+    raw_settings = project['RawProcess_Settings']
+    parameters = project['RawProcess_ParameterSettings']
+    tests = project['RawProcess_Tests']
+    tilt = project['RawProcess_TiltCorrection_Settings']
+    site = metadata['Site']
+    timing = metadata['Timing']
+    instruments = metadata['Instruments']
+    description = metadata['FileDescription']
+
+    settings = {
+        'project_id': proj.get('project_id', eddypro_file.stem),
+        'file_prototype': proj['file_prototype'],
+        'header_rows': int(description.get('header_rows', 4)),
+        'acquisition_frequency': float(timing['acquisition_frequency']),
+        'file_duration': float(timing['file_duration']),
+        'avrg_len': float(raw_settings.get('avrg_len', 30)),
+        'max_lack': float(raw_settings.get('max_lack', 10)),
+        'rot_meth': int(raw_settings.get('rot_meth', 1)),
+        'detrend_meth': int(raw_settings.get('detrend_meth', 0)),
+        'tlag_meth': int(raw_settings.get('tlag_meth', 2)),
+        'hf_meth': int(project['Project'].get('hf_meth', 0)),
+        'lf_meth': int(project['Project'].get('lf_meth', 0)),
+        'qc_meth': int(project['Project'].get('qc_meth', 1)),
+        'ru_meth': int(project['Project'].get('ru_meth', 1)),
+        'ru_tlag_max': float(project['Project'].get('ru_tlag_max', 10)),
+        'filter_sr': int(raw_settings.get('filter_sr', 1)),
+        'filter_al': int(raw_settings.get('filter_al', 1)),
+        'pf_w_max': float(tilt.get('pf_w_max', 99)),
+        'pf_u_min': float(tilt.get('pf_u_min', 0)),
+        'pf_min_num_per_sec': int(tilt.get('pf_min_num_per_sec', 1)),
+        'pf_north_offset': float(tilt.get('pf_north_offset', 0)),
+        'altitude': float(site['altitude']),
+        'latitude': float(site['latitude']),
+        'longitude': float(site['longitude']),
+        'displacement_height': float(site.get('displacement_height', 0)),
+        'height': float(instruments['instr_1_height']),
+        'north_offset': float(instruments.get('instr_1_north_offset', 0)),
+        }
+
+    settings['pf_sectors'] = []
+    i = 1
+    while f'pf_sect_{i}_width' in tilt:
+        settings['pf_sectors'].append({
+            'width': float(tilt[f'pf_sect_{i}_width']),
+            'exclude': int(tilt.get(f'pf_sect_{i}_exclude', 0)),
+            })
+        i += 1
+    if not settings['pf_sectors']:
+        settings['pf_sectors'] = [{'width': 360., 'exclude': 0}]
+
+    settings['limits'] = {
+        'u': float(parameters.get('al_u_max', 30)),
+        'w': float(parameters.get('al_w_max', 5)),
+        'ts': (float(parameters.get('al_tson_min', -40)) + 273.15,
+               float(parameters.get('al_tson_max', 50)) + 273.15),
+        }
+    settings['tests'] = {}
+    for k, default in statistical_tests.DEFAULT_PARAMETERS.items():
+        section = tests if k.startswith('test_') else parameters
+        settings['tests'][k] = float(section.get(k, default))
+    settings['default_time_lags'] = {}
+    for gas in GASES:
+        settings['limits'][gas] = (float(parameters.get(f'al_{gas}_min', -np.inf)),
+                                   float(parameters.get(f'al_{gas}_max', np.inf)))
+        settings['default_time_lags'][gas] = float(parameters.get(f'tl_def_{gas}', 0))
+
+    # Flag columns discard the records where the flag is above (upper=0) or
+    # below (upper=1) its threshold
+    settings['flags'] = []
+    for i in range(1, 11):
+        column = int(general.get(f'flag{i}_column', 0))
+        if column > 0:
+            settings['flags'].append({
+                'index': column - 1,
+                'threshold': float(general[f'flag{i}_threshold']),
+                'upper': int(general[f'flag{i}_upper']),
+                })
+
+    columns = {}
+    i = 1
+    while f'col_{i}_variable' in description:
+        variable = description[f'col_{i}_variable']
+        if variable not in ('ignore', 'not_numeric', ''):
+            columns[variable] = {
+                'index': i - 1,
+                'measure_type': description.get(f'col_{i}_measure_type', ''),
+                'unit_in': description.get(f'col_{i}_unit_in', ''),
+                'conversion': description.get(f'col_{i}_conversion', ''),
+                'a_value': float(description.get(f'col_{i}_a_value', 1)),
+                'b_value': float(description.get(f'col_{i}_b_value', 0)),
+                'min_timelag': float(description.get(f'col_{i}_min_timelag', 0)),
+                'max_timelag': float(description.get(f'col_{i}_max_timelag', 0)),
+                }
+            columns[variable]['nom_timelag'] = float(description.get(
+                f'col_{i}_nom_timelag',
+                (columns[variable]['min_timelag'] + columns[variable]['max_timelag']) / 2))
+        i += 1
+    settings['columns'] = columns
+
+    missing = [v for v in WIND_VARIABLES if v not in columns]
+    if missing:
+        raise ValueError(f'{eddypro_file.name}: no {", ".join(missing)} column in the metadata')
+
+    return settings
+
+
+def unsupported_options(settings, options=IMPLEMENTED_OPTIONS):
+    """
+    Options of a configuration whose value is not implemented by the engine.
+
+    Parameters
+    ----------
+    settings : dict
+        See ``read_settings``.
+    options : iterable of str, optional
+        Names of the options to check. The default is all the options of
+        ``IMPLEMENTED_OPTIONS``.
+
+    Returns
+    -------
+    list of str
+        'option=value' of the unsupported options.
+    """
+    return [f'{option}={settings[option]}' for option in options
+            if settings[option] not in IMPLEMENTED_OPTIONS[option]]
+
+
+def _read_ini(file):
+    """
+    Read an EddyPro ini file, keeping the case of the keys.
+    """
+    parser = configparser.ConfigParser(interpolation=None, strict=False)
+    parser.optionxform = str
+    with open(file, encoding='latin-1') as f:
+        # Skip the ;EDDYPRO_PROCESSING / ;GHG_METADATA line
+        parser.read_string(''.join(line for line in f if not line.startswith(';')))
+    return parser
+
+
+def raw_file_name(settings, timestamp):
+    """
+    Name of the 10 Hz file of a half-hour, from the file prototype of the
+    project (e.g. yyyymmdd_HHMM_eddy_corr.csv).
+
+    Parameters
+    ----------
+    settings : dict
+        See ``read_settings``.
+    timestamp : pandas.Timestamp
+        Start of the half-hour.
+
+    Returns
+    -------
+    str
+    """
+    return settings['file_prototype'].replace(
+        'yyyymmdd_HHMM', timestamp.strftime('%Y%m%d_%H%M'))
+
+
+def read_half_hours(files, settings, variables=None):
+    """
+    Load 10 Hz files as arrays of shape (half-hours, samples), see
+    ``hf_loader.read_blocks``. Files are truncated or padded with NaN to the
+    nominal number of samples of a half-hour.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        10 Hz files, with the layout described in the metadata.
+    settings : dict
+        See ``read_settings``.
+    variables : list of str, optional
+        Variables to load. The default loads all numeric columns.
+
+    Returns
+    -------
+    data : dict
+        Array of each variable, gain, offset and unit conversion applied.
+    flags : numpy.ndarray
+        True where a flag column discards the record.
+    file_records : numpy.ndarray
+        Number of records of each file (0 if the file could not be read).
+    errors : list
+        Log line of each file that could not be read.
+    """
+    columns = settings['columns']
+    if variables is None:
+        variables = list(columns)
+    n_samples = nominal_samples(settings)
+
+    positions = sorted({columns[v]['index'] for v in variables}
+                       | {f['index'] for f in settings['flags']})
+    raw, file_records, errors = hf_loader.read_blocks(
+        files, positions, n_samples, header_rows=settings['header_rows'])
+
+    col = {p: j for j, p in enumerate(positions)}
+    flags = np.zeros(raw.shape[:2], dtype=bool)
+    for flag in settings['flags']:
+        with np.errstate(invalid='ignore'):
+            if flag['upper'] == 0:
+                flags |= raw[:, :, col[flag['index']]] > flag['threshold']
+            else:
+                flags |= raw[:, :, col[flag['index']]] < flag['threshold']
+
+    data = {v: convert_units(raw[:, :, col[columns[v]['index']]], v, columns[v])
+            for v in variables}
+    return data, flags, file_records, errors
+
+
+def convert_units(x, variable, column):
+    """
+    Apply the gain and offset of a column and convert it to m s-1 (wind), K
+    (temperatures), Pa (pressures), mmol m-3 (molar densities) or mol mol-1
+    (mole fractions and mixing ratios).
+    """
+    if column['conversion'] == 'gain_offset':
+        x = column['a_value'] * x + column['b_value']
+
+    unit = column['unit_in'].lower()
+    if unit in UNIT_FACTORS:
+        gain, offset = UNIT_FACTORS[unit]
+        return gain * x + offset
+    if variable in GAS_MOLAR_MASS and unit in ('mg_m3', 'g_m3', 'ug_m3'):
+        # Mass densities to mmol m-3
+        gain = {'g_m3': 1e3, 'mg_m3': 1, 'ug_m3': 1e-3}[unit]
+        return gain * x / GAS_MOLAR_MASS[variable]
+    return x
+
+
+def nominal_samples(settings):
+    """
+    Number of samples of an averaging period.
+    """
+    return int(round(settings['avrg_len'] * 60 * settings['acquisition_frequency']))
+
+
+def process_batch(files, timestamps, settings):
+    """
+    Compute the fluxes of a batch of half-hours.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        10 Hz files of the half-hours.
+    timestamps : list of pandas.Timestamp
+        End of the half-hours.
+    settings : dict
+        See ``read_settings``. 'planar_fit' holds the coefficients of
+        ``update_planar_fit`` if rot_meth is 3 or 4.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Results indexed by timestamp, with the names and units of the EddyPro
+        full_output files (see ``FULL_OUTPUT_UNITS``).
+    errors : list
+        Log line of each file that could not be read.
+    """
+    data, file_records, used_records, errors, screening = load_batch(files, settings)
+    columns = settings['columns']
+    fs = settings['acquisition_frequency']
+    n_hh = len(files)
+    gases = [g for g in GASES if g in data]
+    ta, pa = ambient_temperature_pressure(data, settings)
+
+    out = {}
+    out['filename'] = np.array([f.name for f in files], dtype=object)
+    out['DOY'] = np.array([t.dayofyear + (t.hour * 60 + t.minute) / 1440 for t in timestamps])
+    out['daytime'] = daytime(timestamps, settings)
+    out['file_records'] = file_records
+    out['used_records'] = used_records
+    out.update(test_results(screening, settings))
+
+    u, v, w, ts = (data[k] for k in WIND_VARIABLES)
+    out['u_unrot'] = nanmean(u)
+    out['v_unrot'] = nanmean(v)
+    out['w_unrot'] = nanmean(w)
+    out['max_wind_speed'] = nanmax(np.hypot(u, v))
+    out['wind_dir'] = wind_direction(out['u_unrot'], out['v_unrot'], settings)
+
+    # Rotation
+    if settings['rot_meth'] == 1:
+        u, v, w, angles = double_rotation(u, v, w)
+    elif settings['rot_meth'] in (3, 4):
+        sector = planar_fit.sector_of(out['wind_dir'], settings)
+        u, v, w, angles = planar_fit_rotation(u, v, w, settings['planar_fit'][sector])
+    else:
+        angles = {k: np.zeros(n_hh) for k in ('yaw', 'pitch', 'roll')}
+    out.update(angles)
+    out['u_rot'] = nanmean(u)
+    out['v_rot'] = nanmean(v)
+    out['w_rot'] = nanmean(w)
+    out['wind_speed'] = np.hypot(out['u_rot'], out['v_rot'])
+
+    # Mean values
+    means = {k: nanmean(x) for k, x in data.items()}
+    for k, x in means.items():
+        if k not in WIND_VARIABLES + gases + AMBIENT_VARIABLES:
+            out[f'{k.lower()}_mean'] = x
+
+    # Fluctuations
+    primes = {'u': detrend(u, settings['detrend_meth']),
+              'v': detrend(v, settings['detrend_meth']),
+              'w': detrend(w, settings['detrend_meth']),
+              'ts': detrend(ts, settings['detrend_meth'])}
+    for gas in gases:
+        gas_prime = detrend(data[gas], settings['detrend_meth'])
+        lag, default = time_lag.find_time_lag(
+            primes['w'], gas_prime,
+            int(round(columns[gas]['min_timelag'] * fs)),
+            int(round(columns[gas]['max_timelag'] * fs)),
+            int(round(settings['default_time_lags'][gas] * fs)),
+            time_lag.TIME_LAG_METHODS.get(settings['tlag_meth'], 'covariance_with_default'),
+            int(round(columns[gas]['nom_timelag'] * fs)))
+        primes[gas] = shift(gas_prime, lag)
+        out[f'{gas}_time_lag'] = lag / fs
+        out[f'{gas}_def_timelag'] = default.astype(float)
+
+    cov = {}
+    for k, x in primes.items():
+        out[f'{k}_var'] = covariance(x, x)
+    for k in ['u', 'v', 'ts'] + gases:
+        cov[k] = covariance(primes['w'], primes[k])
+    for k in ['ts'] + gases:
+        out[f'w/{k}_cov'] = cov[k]
+
+    # Air properties
+    out['sonic_temperature'] = means['ts']
+    amb = air_properties(means, gases, columns, ta, pa)
+    out.update({k: amb[k] for k in ('air_temperature', 'air_pressure', 'air_density',
+                                    'air_heat_capacity', 'air_molar_volume',
+                                    'water_vapor_density', 'e', 'es',
+                                    'specific_humidity', 'RH', 'VPD', 'Tdew')})
+    for gas in gases:
+        out[f'{gas}_molar_density'] = amb[f'{gas}_molar_density']
+        out[f'{gas}_mole_fraction'] = amb[f'{gas}_mole_fraction'] * GAS_SCALE[gas]
+        out[f'{gas}_mixing_ratio'] = amb[f'{gas}_mixing_ratio'] * GAS_SCALE[gas]
+
+    # Fluxes
+    fluxes = compute_fluxes(cov, amb, gases, columns)
+    out.update(fluxes)
+    ustar = fluxes['u*']
+    zeta = (settings['height'] - settings['displacement_height']) / fluxes['L']
+    out['(z-d)/L'] = zeta
+    out['TKE'] = 0.5 * (out['u_var'] + out['v_var'] + out['w_var'])
+    out['T*'] = -fluxes['cov_wt'] / ustar
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['bowen_ratio'] = fluxes['H'] / fluxes['LE'] if 'LE' in fluxes else np.full(n_hh, np.nan)
+    del out['cov_wt']
+
+    # Quality flags and random errors of each flux, from the covariance it
+    # is computed with
+    n_sub = max(int(round(settings['avrg_len'] / 5)), 1)
+    itc = integral_turbulence(np.sqrt(out['w_var']) / ustar, zeta, ustar,
+                              settings['latitude'])
+    max_lag = int(round(settings['ru_tlag_max'] * fs))
+    flux_covariances = {'Tau': ('u', 'Tau'), 'H': ('ts', 'H')}
+    if 'h2o' in gases:
+        flux_covariances.update({'LE': ('h2o', 'LE'), 'h2o_flux': ('h2o', 'h2o_flux')})
+    for gas in ['co2', 'ch4']:
+        if gas in gases:
+            flux_covariances[f'{gas}_flux'] = (gas, f'{gas}_flux')
+    for flux, (k, _) in flux_covariances.items():
+        ss = steady_state(primes['w'], primes[k], n_sub)
+        out[f'qc_{flux}'] = mauder_foken_flag(ss, itc) if settings['qc_meth'] else np.full(n_hh, np.nan)
+        if settings['ru_meth']:
+            error = random_error(primes['w'], primes[k], max_lag)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[f'rand_err_{flux}'] = np.abs(fluxes[f'{flux}_per_cov'] * error)
+        del out[f'{flux}_per_cov']
+
+    index = pd.DatetimeIndex(timestamps, name='timestamp')
+    df = pd.DataFrame(out, index=index)
+    return df[[c for c in FULL_OUTPUT_UNITS if c in df.columns]
+              + [c for c in df.columns if c not in FULL_OUTPUT_UNITS]], errors
+
+
+def load_batch(files, settings, variables=None):
+    """
+    Load a batch of half-hours and discard the invalid records: records
+    flagged by the flag columns, sonic records with any missing component,
+    spikes (filter_sr, replaced by linear interpolation), values outside the
+    absolute limits (filter_al), and half-hours with too many missing records
+    (max_lack). The statistical tests (see ``statistical_tests``) run on the
+    sonic and gas analyzer variables before the absolute limits are applied.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        10 Hz files of the half-hours.
+    settings : dict
+        See ``read_settings``.
+    variables : list of str, optional
+        Variables to load, along with the sonic variables. The default loads
+        all numeric columns.
+
+    Returns
+    -------
+    data : dict
+        Array of shape (half-hours, samples) of each variable.
+    file_records : numpy.ndarray
+        Number of records of each file.
+    used_records : numpy.ndarray
+        Number of valid sonic records of each half-hour.
+    errors : list
+        Log line of each file that could not be read.
+    screening : dict
+        'variables' tested, and their test 'flags' and number of 'spikes',
+        of shape (half-hours, variables).
+    """
+    if variables is not None:
+        variables = WIND_VARIABLES + [v for v in variables if v not in WIND_VARIABLES]
+    data, flags, file_records, errors = read_half_hours(files, settings, variables)
+    n_samples = flags.shape[1]
+
+    # Discard the flagged records, then the sonic records with any missing
+    # component
+    for x in data.values():
+        x[flags] = np.nan
+    discard_incomplete_sonic(data)
+
+    # Ambient conditions from the raw means, used to express the absolute
+    # limits of the gases in the units of the data
+    ta, pa = ambient_temperature_pressure(data, settings)
+    tested = [v for v in WIND_VARIABLES + GASES if v in data]
+    lower, upper = absolute_limits(tested, settings, pa / (R * ta))
+
+    x = np.stack([data[v] for v in tested], axis=-1)
+    parameters = dict(settings['tests'])
+    parameters['test_sr'] = parameters['test_sr'] or settings['filter_sr']
+    test_flags, despiked, n_spikes = statistical_tests.screen(
+        x, tested, parameters, settings['acquisition_frequency'], lower, upper)
+    if settings['filter_sr']:
+        x = despiked
+    if settings['filter_al']:
+        x[statistical_tests.outside_limits(x, lower, upper)] = np.nan
+    for i, v in enumerate(tested):
+        data[v] = np.ascontiguousarray(x[..., i])
+    sonic_missing = discard_incomplete_sonic(data)
+
+    used_records = (~sonic_missing).sum(axis=1)
+    enough = used_records >= n_samples * (1 - settings['max_lack'] / 100)
+    for x in data.values():
+        x[~enough] = np.nan
+    screening = {'variables': tested, 'flags': test_flags, 'spikes': n_spikes}
+    return data, file_records, used_records, errors, screening
+
+
+def discard_incomplete_sonic(data):
+    """
+    Discard the sonic records with any missing component, in place.
+
+    Returns
+    -------
+    numpy.ndarray
+        True for the discarded records.
+    """
+    sonic_missing = np.zeros(data['u'].shape, dtype=bool)
+    for v in WIND_VARIABLES:
+        sonic_missing |= np.isnan(data[v])
+    for v in WIND_VARIABLES:
+        data[v][sonic_missing] = np.nan
+    return sonic_missing
+
+
+def test_results(screening, settings):
+    """
+    Number of spikes of each variable and codes of the statistical tests
+    enabled, as in the EddyPro full_output files: '8' then a digit per
+    variable of ``TEST_CODE_VARIABLES``, 1 if the test failed, 0 if it
+    passed and 9 if the variable is not available.
+
+    Parameters
+    ----------
+    screening : dict
+        See ``load_batch``.
+    settings : dict
+        See ``read_settings``.
+    """
+    tested = screening['variables']
+    out = {}
+    if settings['tests']['test_sr'] or settings['filter_sr']:
+        for i, v in enumerate(tested):
+            out[f'{v}_spikes'] = screening['spikes'][:, i]
+
+    for column, (switch, test) in TEST_COLUMNS.items():
+        if not settings['tests'][switch]:
+            continue
+        failed = (screening['flags'] & statistical_tests.FLAGS[test]) > 0
+        digits = np.full((len(failed), len(TEST_CODE_VARIABLES)), 9)
+        for j, v in enumerate(TEST_CODE_VARIABLES):
+            if v in tested:
+                digits[:, j] = failed[:, tested.index(v)]
+        out[column] = np.array(['8' + ''.join(map(str, row)) for row in digits], dtype=object)
+    return out
+
+
+def ambient_temperature_pressure(data, settings):
+    """
+    Mean air temperature [K] and pressure [Pa] of each half-hour, from the
+    air_t and air_p columns, or else from the sonic temperature and the
+    altitude of the site.
+    """
+    if 'air_t' in data:
+        ta = nanmean(data['air_t'])
+        ta = np.where(np.isnan(ta), nanmean(data['ts']), ta)
+    else:
+        ta = nanmean(data['ts'])
+    p_altitude = 101325 * (1 - 2.25577e-5 * settings['altitude']) ** 5.25588
+    if 'air_p' in data:
+        pa = nanmean(data['air_p'])
+        pa = np.where(np.isnan(pa), p_altitude, pa)
+    else:
+        pa = np.full(ta.shape, p_altitude)
+    return ta, pa
+
+
+def absolute_limits(variables, settings, air_molar_density):
+    """
+    Absolute limits (al_* settings) of variables, in the units of the data.
+    Gas limits are in µmol mol-1 (CO2, CH4) and mmol mol-1 (H2O), and are
+    converted with the molar density of air for the molar densities.
+
+    Returns
+    -------
+    lower, upper : numpy.ndarray
+        Limits of shape (half-hours, variables).
+    """
+    limits = settings['limits']
+    n_hh = len(air_molar_density)
+    lower = np.full((n_hh, len(variables)), -np.inf)
+    upper = np.full((n_hh, len(variables)), np.inf)
+    for i, v in enumerate(variables):
+        if v in ('u', 'v'):
+            lower[:, i], upper[:, i] = -limits['u'], limits['u']
+        elif v == 'w':
+            lower[:, i], upper[:, i] = -limits['w'], limits['w']
+        elif v == 'ts':
+            lower[:, i], upper[:, i] = limits['ts']
+        elif v in GASES:
+            lo, hi = np.array(limits[v]) / GAS_SCALE[v]
+            if settings['columns'][v]['measure_type'] == 'molar_density':
+                # mol mol-1 to mmol m-3
+                lo, hi = lo * air_molar_density * 1e3, hi * air_molar_density * 1e3
+            lower[:, i], upper[:, i] = lo, hi
+    return lower, upper
+
+
+def daytime(timestamps, settings):
+    """
+    1 if the sun is above the horizon at the middle of the half-hour, else
+    0. Timestamps are in local standard time (UTC-5).
+    """
+    mid = pd.Timedelta(minutes=settings['avrg_len'] / 2)
+    return np.array([
+        float(pysolar.solar.get_altitude(
+            settings['latitude'], settings['longitude'],
+            (t - mid).tz_localize('Etc/GMT+5').to_pydatetime()) > 0)
+        for t in timestamps])
+
+
+def nanmean(x):
+    """
+    Mean over the samples, NaN if no sample is valid.
+    """
+    n = np.sum(~np.isnan(x), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, np.nansum(x, axis=-1) / n, np.nan)
+
+
+def nanmax(x):
+    """
+    Maximum over the samples, NaN if no sample is valid.
+    """
+    filled = np.where(np.isnan(x), -np.inf, x).max(axis=-1)
+    return np.where(np.isinf(filled), np.nan, filled)
+
+
+def covariance(x, y):
+    """
+    Covariance of the samples valid in both series, NaN if less than 2.
+    """
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1)
+    xv = np.where(valid, x, 0)
+    yv = np.where(valid, y, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sx = xv.sum(axis=-1)
+        sy = yv.sum(axis=-1)
+        c = (np.einsum('...i,...i->...', xv, yv) - sx * sy / n) / (n - 1)
+    return np.where(n > 1, c, np.nan)
+
+
+def detrend(x, method):
+    """
+    Fluctuations around the block average (detrend_meth 0) or the linear
+    trend (detrend_meth 1) of each half-hour. The running mean (2) and the
+    exponentially weighted average (3) are not implemented.
+    """
+    if method not in IMPLEMENTED_OPTIONS['detrend_meth']:
+        raise ValueError(f'detrend_meth={method} is not implemented')
+    if method == 1:
+        t = np.arange(x.shape[-1], dtype=float)
+        t = np.where(np.isnan(x), np.nan, t)
+        tp = t - nanmean(t)[..., None]
+        xp = x - nanmean(x)[..., None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = nanmean(tp * xp) / nanmean(tp * tp)
+        return xp - np.nan_to_num(slope)[..., None] * tp
+    return x - nanmean(x)[..., None]
+
+
+def double_rotation(u, v, w):
+    """
+    Align u with the mean wind and cancel the mean vertical wind of each
+    half-hour.
+
+    Returns
+    -------
+    u, v, w : numpy.ndarray
+        Rotated wind components.
+    angles : dict
+        'yaw', 'pitch' and 'roll' angles [deg].
+    """
+    yaw = np.arctan2(nanmean(v), nanmean(u))
+    cy, sy = np.cos(yaw)[:, None], np.sin(yaw)[:, None]
+    u1 = u * cy + v * sy
+    v1 = -u * sy + v * cy
+
+    pitch = np.arctan2(nanmean(w), nanmean(u1))
+    cp, sp = np.cos(pitch)[:, None], np.sin(pitch)[:, None]
+    u2 = u1 * cp + w * sp
+    w2 = -u1 * sp + w * cp
+
+    angles = {'yaw': np.degrees(yaw), 'pitch': np.degrees(pitch),
+              'roll': np.zeros(len(yaw))}
+    return u2, v1, w2, angles
+
+
+def wind_direction(u_mean, v_mean, settings):
+    """
+    Mean wind direction [deg from north] from the mean wind components in
+    the sonic axes.
+    """
+    return np.mod(360 + settings['north_offset']
+                  - np.degrees(np.arctan2(v_mean, u_mean)), 360)
+
+
+def update_planar_fit(station_name, config, settings, station_csv_folder, end,
+                      out_dir=None, batch_size=48, n_workers=1):
+    """
+    Add the half-hours of a configuration period that are not yet in its
+    planar fit sums (see ``planar_fit``), and fit the sectors.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    config : dict
+        Configuration period, see ``eddypro.list_configs``.
+    settings : dict
+        See ``read_settings``.
+    station_csv_folder : pathlib.Path
+        Directory of the 10 Hz files of the station.
+    end : datetime-like
+        Start of the last half-hour to include, if before the end of the
+        configuration period.
+    out_dir : pathlib.Path, optional
+        If given, the planar fit file of the period is written in this
+        directory, replacing the one of the previous runs. The default is
+        None.
+    batch_size : int, optional
+        Number of files loaded together. The default is 48.
+    n_workers : int, optional
+        Number of worker processes. The default is 1 (serial).
+
+    Returns
+    -------
+    numpy.ndarray
+        Coefficients of each sector, see ``planar_fit.fit``.
+
+    Raises
+    ------
+    ValueError
+        If the sectors cannot be fitted yet (see ``planar_fit.fit``).
+    """
+    config_name = config['path'].stem
+    conn = planar_fit.open_cache(planar_fit.cache_path(station_name))
+    try:
+        # Only read the files that are not in the sums, after discarding
+        # sums computed with other settings
+        digest = planar_fit.settings_hash(settings)
+        row = conn.execute("SELECT settings_hash FROM planar_fit_config WHERE config=?",
+                           (config_name,)).fetchone()
+        done = planar_fit.processed_timestamps(conn, config_name) \
+            if row is not None and row[0] == digest else set()
+
+        last = min(pd.Timestamp(config['end']), pd.Timestamp(end))
+        new = []
+        for t in pd.date_range(config['start'], last, freq='30min'):
+            name = t.strftime('%Y%m%d_%H%M')
+            file = station_csv_folder.joinpath(raw_file_name(settings, t))
+            if name not in done and file.exists():
+                new.append((name, file))
+
+        names = [n for n, _ in new]
+        batches = [[f for _, f in new[i:i + batch_size]]
+                   for i in range(0, len(new), batch_size)]
+        if n_workers > 1:
+            results = Parallel(n_jobs=n_workers)(
+                delayed(mean_winds)(batch, settings) for batch in batches)
+        else:
+            results = [mean_winds(batch, settings) for batch in batches]
+        means = np.concatenate(results) if results else np.empty((0, 3))
+        planar_fit.update(conn, config_name, settings, names, means,
+                          wind_direction(means[:, 0], means[:, 1], settings))
+
+        sums = planar_fit.load_sums(conn, config_name, len(settings['pf_sectors']))
+        processed = sorted(planar_fit.processed_timestamps(conn, config_name))
+    finally:
+        conn.close()
+
+    coefficients = planar_fit.fit(sums, settings)
+    if out_dir is not None and processed:
+        planar_fit.write_pf_file(
+            out_dir.joinpath(f"eddypro_{settings['project_id']}_planar_fit_"
+                             f"{config_name}_flux_engine.txt"),
+            settings, sums, coefficients,
+            pd.to_datetime(processed[0], format='%Y%m%d_%H%M'),
+            pd.to_datetime(processed[-1], format='%Y%m%d_%H%M'))
+    return coefficients
+
+
+def mean_winds(files, settings):
+    """
+    Mean u, v and w of each half-hour, from the valid sonic records.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (half-hours, 3).
+    """
+    data, _, _, _, _ = load_batch(files, settings, [])
+    return np.column_stack([nanmean(data[v]) for v in ('u', 'v', 'w')])
+
+
+def planar_fit_rotation(u, v, w, b):
+    """
+    Rotate the wind in the plane of the planar fit of each half-hour, then
+    align u with its mean wind.
+
+    Parameters
+    ----------
+    u, v, w : numpy.ndarray
+        Wind components in the sonic axes.
+    b : numpy.ndarray
+        Coefficients (b0, b1, b2) of the plane of each half-hour, of shape
+        (half-hours, 3), see ``planar_fit.fit``.
+
+    Returns
+    -------
+    u, v, w : numpy.ndarray
+        Rotated wind components.
+    angles : dict
+        'yaw', 'pitch' and 'roll' angles [deg].
+    """
+    P = planar_fit.rotation_matrix(b)[:, :, :, None]
+    w = w - b[:, 0, None]
+    up = P[:, 0, 0] * u + P[:, 0, 1] * v + P[:, 0, 2] * w
+    vp = P[:, 1, 0] * u + P[:, 1, 1] * v + P[:, 1, 2] * w
+    wp = P[:, 2, 0] * u + P[:, 2, 1] * v + P[:, 2, 2] * w
+
+    yaw = np.arctan2(nanmean(vp), nanmean(up))
+    cy, sy = np.cos(yaw)[:, None], np.sin(yaw)[:, None]
+    pitch, roll = planar_fit.tilt_angles(b)
+    angles = {'yaw': np.degrees(yaw), 'pitch': pitch, 'roll': roll}
+    return up * cy + vp * sy, -up * sy + vp * cy, wp, angles
+
+
+def shift(x, lag):
+    """
+    Series advanced by ``lag`` samples, ``y[t] = x[t + lag]``, padded with
+    NaN. ``lag`` is an array with one value per half-hour.
+    """
+    n = x.shape[-1]
+    idx = np.arange(n)[None, :] + np.asarray(lag)[:, None]
+    valid = (idx >= 0) & (idx < n)
+    out = np.take_along_axis(x, np.clip(idx, 0, n - 1), axis=-1)
+    return np.where(valid, out, np.nan)
+
+
+def air_properties(means, gases, columns, ta, pa):
+    """
+    Mean properties of the air and concentrations of the gases.
+
+    Parameters
+    ----------
+    means : dict
+        Mean of each variable over the half-hours.
+    gases : list of str
+        Gases measured.
+    columns : dict
+        See ``read_settings``.
+    ta, pa : numpy.ndarray
+        Air temperature [K] and pressure [Pa].
+
+    Returns
+    -------
+    dict
+        Air properties in the units of the full_output files, plus the molar
+        density of the gases [mmol m-3], their mole fractions and mixing
+        ratios [mol mol-1] and the latent heat of vaporization 'lambda'
+        [J kg-1].
+    """
+    amb = {'air_pressure': pa}
+
+    def vapour_pressure(ta):
+        if 'h2o' not in gases:
+            return np.zeros_like(ta)
+        if columns['h2o']['measure_type'] == 'molar_density':
+            return means['h2o'] * 1e-3 * R * ta
+        return means['h2o'] * pa
+
+    if 'air_t' not in means:
+        # Air temperature from the sonic temperature
+        ta = ta / (1 + 0.32 * vapour_pressure(ta) / pa)
+    e = vapour_pressure(ta)
+    air_molar_density = pa / (R * ta)     # [mol m-3]
+
+    concentrations = {}
+    for gas in gases:
+        if columns[gas]['measure_type'] == 'molar_density':
+            concentrations[gas] = means[gas]                            # [mmol m-3]
+        else:
+            concentrations[gas] = means[gas] * air_molar_density * 1e3
+
+    dv = concentrations.get('h2o', np.zeros_like(ta))                  # [mmol m-3]
+    rho_v = dv * 1e-3 * MV
+    rho_d = (pa - e) * MD / (R * ta)
+    rho_a = rho_d + rho_v
+    q = rho_v / rho_a
+    tc = ta - 273.15
+    es = 611.2 * np.exp(17.62 * tc / (243.12 + tc))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_e = np.log(e / 611.2)
+        tdew = 243.12 * log_e / (17.62 - log_e) + 273.15
+
+    amb.update({
+        'air_temperature': ta,
+        'air_density': rho_a,
+        'air_heat_capacity': CPD * (1 - q) + CPV * q,
+        'air_molar_volume': 1 / air_molar_density,
+        'water_vapor_density': rho_v,
+        'e': e,
+        'es': es,
+        'specific_humidity': q,
+        'RH': e / es * 100,
+        'VPD': es - e,
+        'Tdew': tdew,
+        'rho_d': rho_d,
+        'lambda': (3147.5 - 2.37 * ta) * 1e3,
+        })
+    dry_molar_density = rho_d / MD
+    for gas, c in concentrations.items():
+        amb[f'{gas}_molar_density'] = c
+        amb[f'{gas}_mole_fraction'] = c * 1e-3 / air_molar_density
+        amb[f'{gas}_mixing_ratio'] = c * 1e-3 / dry_molar_density
+    return amb
+
+
+def compute_fluxes(cov, amb, gases, columns):
+    """
+    Fluxes from the covariances with the vertical wind.
+
+    Parameters
+    ----------
+    cov : dict
+        Covariance of w with u, v, ts and the gases (in the units of
+        ``convert_units``).
+    amb : dict
+        See ``air_properties``.
+    gases : list of str
+        Gases measured.
+    columns : dict
+        See ``read_settings``.
+
+    Returns
+    -------
+    dict
+        'Tau' [kg m-1 s-2], 'u*' [m s-1], 'H', 'LE' [W m-2], 'ET' [mm
+        hour-1], 'h2o_flux' [mmol m-2 s-1], 'co2_flux' and 'ch4_flux'
+        [µmol m-2 s-1], 'L' [m] and 'cov_wt' the covariance of w with the
+        air temperature [K m s-1]. '{flux}_per_cov' is the ratio of each flux
+        to the covariance it is computed with, to express its random error.
+    """
+    ta, pa = amb['air_temperature'], amb['air_pressure']
+    rho_a, rho_d, rho_v = amb['air_density'], amb['rho_d'], amb['water_vapor_density']
+    cp = amb['air_heat_capacity']
+    air_molar_density = 1 / amb['air_molar_volume']
+    mu = MD / MV
+    sigma = rho_v / rho_d
+
+    out = {}
+    ustar = (cov['u']**2 + cov['v']**2) ** 0.25
+    out['Tau'] = rho_a * ustar**2
+    out['Tau_per_cov'] = rho_a
+    out['u*'] = ustar
+
+    # Water vapour flux [kg m-2 s-1] and covariance of w with the air
+    # temperature from the sonic temperature (Van Dijk et al., 2004)
+    if 'h2o' in gases:
+        if columns['h2o']['measure_type'] == 'molar_density':
+            cov_wrho_v = cov['h2o'] * 1e-3 * MV
+        else:
+            chi_v = amb['h2o_mole_fraction']
+            cov_wrho_v = air_molar_density * cov['h2o'] / (1 - chi_v) * MV
+    else:
+        cov_wrho_v = np.zeros_like(ta)
+    cov_wt = cov['ts'] - 0.51 * ta * cov_wrho_v / rho_a
+    out['cov_wt'] = cov_wt
+    out['H'] = rho_a * cp * cov_wt
+    out['H_per_cov'] = rho_a * cp
+
+    if 'h2o' in gases:
+        if columns['h2o']['measure_type'] == 'molar_density':
+            # WPL terms (Webb et al., 1980)
+            gain = 1 + mu * sigma
+            evap = gain * (cov_wrho_v + rho_v / ta * cov_wt)
+            per_cov = gain * 1e-3 * MV
+        else:
+            evap = cov_wrho_v
+            per_cov = air_molar_density / (1 - amb['h2o_mole_fraction']) * MV
+        out['LE'] = amb['lambda'] * evap
+        out['LE_per_cov'] = amb['lambda'] * per_cov
+        out['ET'] = evap * 3600
+        out['h2o_flux'] = evap / MV * 1e3
+        out['h2o_flux_per_cov'] = per_cov / MV * 1e3
+
+    for gas in ['co2', 'ch4']:
+        if gas not in gases:
+            continue
+        if columns[gas]['measure_type'] == 'molar_density':
+            c = amb[f'{gas}_molar_density']
+            flux = (cov[gas] + mu * c / rho_d * cov_wrho_v
+                    + (1 + mu * sigma) * c / ta * cov_wt)              # [mmol m-2 s-1]
+            per_cov = 1e3
+        elif columns[gas]['measure_type'] == 'mole_fraction':
+            chi_v = amb.get('h2o_mole_fraction', np.zeros_like(ta))
+            chi = amb[f'{gas}_mole_fraction']
+            cov_wchi_v = cov['h2o'] if 'h2o' in gases else np.zeros_like(ta)
+            per_cov = air_molar_density * 1e6
+            flux = air_molar_density * (cov[gas] + chi / (1 - chi_v) * cov_wchi_v) * 1e3
+        else:
+            per_cov = (rho_d / MD) * 1e6
+            flux = rho_d / MD * cov[gas] * 1e3
+        out[f'{gas}_flux'] = flux * 1e3
+        out[f'{gas}_flux_per_cov'] = per_cov * np.ones_like(ta)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['L'] = -amb['air_temperature'] * ustar**3 / (VON_KARMAN * G * cov['ts'])
+    return out
+
+
+def steady_state(x, y, n_sub):
+    """
+    Relative difference [%] between the covariance of a half-hour and the
+    mean covariance of its sub-periods (Foken and Wichura, 1996).
+    """
+    n_hh, n = x.shape
+    length = n // n_sub
+    xs = x[:, :length * n_sub].reshape(n_hh, n_sub, length)
+    ys = y[:, :length * n_sub].reshape(n_hh, n_sub, length)
+    cov_sub = nanmean(covariance(xs, ys))
+    cov = covariance(x, y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs((cov_sub - cov) / cov) * 100
+
+
+def integral_turbulence(sigma_w_ustar, zeta, ustar, latitude):
+    """
+    Relative difference [%] between the measured and modelled sigma_w / u*
+    (Foken et al., 2004).
+    """
+    f = 2 * OMEGA * np.sin(np.radians(abs(latitude)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        neutral = 0.21 * np.log(f / ustar) + 3.1
+        unstable = 1.3 * np.cbrt(1 - 2 * zeta)
+        model = np.where(zeta < -0.2, unstable, neutral)
+        return np.abs((model - sigma_w_ustar) / model) * 100
+
+
+def mauder_foken_flag(ss, itc):
+    """
+    Overall quality flag: 0 (classes 1-3 of Foken et al., 2004), 1 (classes
+    4-6) or 2 (classes 7-9). NaN if a test could not be computed.
+    """
+    bounds = [15, 30, 50, 75, 100, 250, 500, 1000]
+    ss_class = np.digitize(ss, bounds, right=True) + 1
+    itc_class = np.digitize(itc, bounds, right=True) + 1
+    overall = np.select(
+        [(ss_class == 1) & (itc_class <= 2),
+         (ss_class == 2) & (itc_class <= 2),
+         (ss_class <= 2) & (itc_class <= 4),
+         (ss_class <= 4) & (itc_class <= 2),
+         (ss_class <= 4) & (itc_class <= 5),
+         (ss_class <= 5) & (itc_class <= 5),
+         (ss_class <= 6) & (itc_class <= 6),
+         (ss_class <= 8) & (itc_class <= 8)],
+        [1, 2, 3, 4, 5, 6, 7, 8], default=9)
+    flag = np.select([overall <= 3, overall <= 6], [0., 1.], default=2.)
+    return np.where(np.isnan(ss) | np.isnan(itc), np.nan, flag)
+
+
+def random_error(x, y, max_lag):
+    """
+    Random error of the covariance of two series (Finkelstein and Sims,
+    2001), summing the auto- and cross-covariances up to ``max_lag``.
+    """
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1)
+    x = np.where(valid, x, 0)
+    y = np.where(valid, y, 0)
+    gxx = time_lag.lagged_products(x, x, -max_lag, max_lag)
+    gyy = time_lag.lagged_products(y, y, -max_lag, max_lag)
+    gxy = time_lag.lagged_products(x, y, -max_lag, max_lag)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = np.sum(gxx * gyy + gxy * gxy[:, ::-1], axis=-1) / n**2
+        return np.where(n > 1, np.sqrt(np.abs(variance) / n), np.nan)
+
+
+def add_storage_fluxes(df, settings):
+    """
+    Storage fluxes below the instrument from the change of the mean values
+    between consecutive half-hours. NaN when the previous half-hour is
+    missing.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Results of ``process_batch``.
+    settings : dict
+        See ``read_settings``.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    df = df.sort_index()
+    dt = df.index.to_series().diff().dt.total_seconds()
+    dt = dt.where(dt == settings['avrg_len'] * 60).to_numpy()
+    z = settings['height']
+
+    def rate(column):
+        return z * df[column].diff().to_numpy() / dt
+
+    df['H_strg'] = df['air_density'] * df['air_heat_capacity'] * rate('air_temperature')
+    if 'h2o_molar_density' in df:
+        lam = (3147.5 - 2.37 * df['air_temperature']) * 1e3
+        df['LE_strg'] = lam * rate('water_vapor_density')
+        df['h2o_strg'] = rate('h2o_molar_density')
+    for gas in ['co2', 'ch4']:
+        if f'{gas}_molar_density' in df:
+            df[f'{gas}_strg'] = rate(f'{gas}_molar_density') * 1e3
+    return df[[c for c in FULL_OUTPUT_UNITS if c in df.columns]
+              + [c for c in df.columns if c not in FULL_OUTPUT_UNITS]]
+
+
+def write_full_output(df, out_file):
+    """
+    Write results in the format of the EddyPro full_output files: a line of
+    section names, a line of variable names, a line of units, then one line
+    per half-hour with 'date' and 'time' of its end.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Results indexed by timestamp.
+    out_file : pathlib.Path
+        Path to the output file.
+    """
+    out = df.copy()
+    out.insert(1, 'date', df.index.strftime('%Y-%m-%d'))
+    out.insert(2, 'time', df.index.strftime('%H:%M'))
+
+    sections = ['file_info'] + [''] * (len(out.columns) - 1)
+    units = [f'[{FULL_OUTPUT_UNITS.get(c, "#")}]' for c in out.columns]
+
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, 'w', encoding='utf-8') as fp:
+        fp.write(','.join(sections) + '\n')
+        fp.write(','.join(out.columns) + '\n')
+        fp.write(','.join(units) + '\n')
+        out.to_csv(fp, header=False, index=False, na_rep='NaN', lineterminator='\n')
+
@@ -1,36 +1,47 @@
-import os
+import hashlib
+import sqlite3
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
-import statsmodels.api as sm
-from utils import data_loader as dl
+from pathlib import Path
+from functools import partial
+from joblib import Parallel, delayed
+from . import hf_transforms
 
 
-def find_uncorrected_files(folder, overwrite=False):
+def find_uncorrected_files(folder, overwrite=False, suffix='_eddy_corr.csv',
+                           archive_dir=None):
     """
-    Find _eddy.csv files without a corresponding _eddy_corr.csv file.
-    Returns a list of_eddy.csv files without its corresponding _eddy_corr.csv.
+    Find _eddy.csv files without a corresponding output file, named with
+    ``suffix`` instead of _eddy.csv (_eddy_corr.csv by default, see
+    ``hf_transforms.run``). If ``archive_dir`` is given, the half-hours of
+    the station (name of ``folder``) stored in the columnar archive are
+    listed too, even if their _eddy.csv file does not exist.
+    Returns a list of _eddy.csv files without their corresponding output file.
     """
     eddy_files = set()
     eddy_corr_files = set()
 
+    if archive_dir is not None:
+        from . import hf_archive
+        eddy_files.update(hf_archive.list_half_hours(folder.name, archive_dir))
+
     for p in folder.iterdir():
         name = p.name
 
-        # Extract timestamp of _eddy and _eddy_corr
-        if name.endswith("_eddy.csv") and not name.endswith("_eddy_corr.csv"):
+        # Extract timestamp of _eddy and of the output files
+        if name.endswith("_eddy.csv"):
             timestamp = name.replace("_eddy.csv", "")
             eddy_files.add(timestamp)
 
-        elif name.endswith("_eddy_corr.csv"):
-            timestamp = name.replace("_eddy_corr.csv", "")
+        elif name.endswith(suffix):
+            timestamp = name.replace(suffix, "")
             eddy_corr_files.add(timestamp)
 
     if not overwrite:
-        # timestamps where eddy exists but eddy_corr is missing
+        # timestamps where eddy exists but the output is missing
         missing_corr_timestamp = eddy_files - eddy_corr_files
     else:
-        # return all eddy, regardless if eddy_corr exists
+        # return all eddy, regardless if the output exists
         missing_corr_timestamp = eddy_files
 
     # corresponding eddy filenames
@@ -42,97 +53,100 @@ def find_uncorrected_files(folder, overwrite=False):
     return missing_corr_eddy_files
 
 
-def correct_densities(station, corr_factors, uncorrected_files):
+def correct_densities(station, corr_factors, uncorrected_files, n_workers=1,
+                      chunk_size=48):
     """
     Correct water and CO2 concentrations. Correction factors must be provided
     in csv files that contain 'H2O_slope', 'H2O_intercept', and 'CO2_intercept'
     along with a timestamp column.
 
+    Runs ``hf_transforms.run`` with ``correct_h2o`` as only transform.
+
     Parameters
     ----------
     station : string
         Name of the station
-    asciiOutDir : string
-        Path to the directory that contains raw (10 Hz) .csv files
-    config_dir : string
-        Path to the directory that contains the .csv file with correction
-        coefficients
-    overwrite : Boolean, optional
-        Overwrite or not the previously corrected concentations. The default is False.
+    corr_factors : pandas.DataFrame
+        Correction coefficients 'a' and 'b', indexed by timestamp (see
+        ``get_correction_coeff``).
+    uncorrected_files : list of pathlib.Path
+        _eddy.csv files to correct (see ``find_uncorrected_files``).
+    n_workers : int, optional
+        Number of worker processes correcting files concurrently, see
+        ``hf_transforms.run``. The default is 1 (serial).
+    chunk_size : int, optional
+        Number of files per chunk. The default is 48 (one day).
 
     Returns
     -------
-    None. Write a file file_corr.csv with corrected concentrations
+    None. Write a file file_corr.csv with corrected concentrations. Files
+    that failed are logged in ./Logs/correct_raw_concentrations_{station}.log
 
     """
 
     print(f'Start raw gas concentration correction for the {station} station')
 
-    def resolve_column(df, candidates):
-        """
-        Return the first candidate column that exists in df.columns.
-        If required=True and none exist, raise a KeyError with a helpful message.
-        """
-        for c in candidates:
-            if c in df.columns:
-                return c
-
     # TODO Write option to overwrite last calibration if still open
     # TODO Write a correction for CO2
 
-    # Open log file
-    logf = open( os.path.join(
-        '.','Logs',f'correct_raw_concentrations_{station}.log'), "w")
-
-    for eddy_file in tqdm(uncorrected_files, desc=f'{station}: Correcting densities'):
-
-        eddy_corr_file = eddy_file.with_name(
-            eddy_file.name.replace("_eddy.csv", "_eddy_corr.csv"))
-        timestamp = eddy_file.name.replace("_eddy.csv", "")
-
-        try:
-            # Load file and header
-            df = dl.toa5_file(eddy_file)
-            header = dl.toa5_header(eddy_file,False)
-
-            # Write header to destination file
-            with open(eddy_corr_file, 'w') as fp:
-                for i_line in header:
-                    fp.write(i_line)
-
-            # Check closest timestamp in the corr_factors index
-            # Log an error if no timestamp is found within a day
-            target = pd.to_datetime(timestamp, format="%Y%m%d_%H%M")
-            nearest = corr_factors.index.get_indexer([target], method="nearest", tolerance='1d')
-            if nearest[0] != -1:
-                nearest_date = corr_factors.index[nearest[0]]
-            else:
-                logf.write(f'Failed to find correction factors for {timestamp}: '
-                           +f'{eddy_file}\n')
-                continue
-
-            # Handle the change of column names according to instrument and
-            # code version
-            H2O = resolve_column(df, ['H2O', 'H2O_li', 'H2O_density'])
-            t_sonic = resolve_column(df, ['Ts','T_SONIC'])
-            # CO2 = resolve_column(df, ['CO2_corr', 'CO2', 'CO2_li', 'CO2_density'])
-
-            # Correction of the H2O densities with identified coeficients
-            a, b = corr_factors.loc[nearest_date,['a', 'b']]
-            df[H2O] = df[H2O] + (a*df[t_sonic].mean() + b) * linear_func(df[t_sonic].mean())
-
-            # Save
-            df.to_csv(eddy_corr_file, header=False,
-                      mode='a', quoting=0)
-
-        except Exception as e:
-            print(str(e))
-            logf.write('Failed to correct concentration for file '+
-                       f'{eddy_file}: {str(e)}\n')
-
-    # Close error log file
-    logf.close()
-    print('Done!')
+    hf_transforms.run(station, uncorrected_files,
+                      [partial(correct_h2o, corr_factors=corr_factors)],
+                      n_workers=n_workers, chunk_size=chunk_size,
+                      log_name='correct_raw_concentrations',
+                      desc='Correcting densities')
+
+
+def resolve_column(df, candidates):
+    """
+    Return the first candidate column that exists in df.columns, or None.
+    """
+    for c in candidates:
+        if c in df.columns:
+            return c
+
+
+def correct_h2o(df, timestamp, corr_factors):
+    """
+    Correct the H2O densities of a 10 Hz half-hour with the correction
+    coefficients of the closest timestamp (see ``get_correction_coeff``).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        10 Hz data of the half-hour, as loaded by ``dl.toa5_file``.
+    timestamp : str
+        Half-hour of the data, as ``YYYYMMDD_HHMM`` (name of the _eddy.csv
+        file).
+    corr_factors : pandas.DataFrame
+        Correction coefficients 'a' and 'b', indexed by timestamp.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Data with corrected H2O densities.
+
+    Raises
+    ------
+    LookupError
+        If no correction coefficients are found within a day.
+    """
+    # Check closest timestamp in the corr_factors index
+    target = pd.to_datetime(timestamp, format="%Y%m%d_%H%M")
+    nearest = corr_factors.index.get_indexer([target], method="nearest", tolerance='1d')
+    if nearest[0] == -1:
+        raise LookupError(f'No correction factors within a day of {timestamp}')
+    nearest_date = corr_factors.index[nearest[0]]
+
+    # Handle the change of column names according to instrument and
+    # code version
+    H2O = resolve_column(df, ['H2O', 'H2O_li', 'H2O_density'])
+    t_sonic = resolve_column(df, ['Ts','T_SONIC'])
+    # CO2 = resolve_column(df, ['CO2_corr', 'CO2', 'CO2_li', 'CO2_density'])
+
+    # Correction of the H2O densities with identified coeficients
+    a, b = corr_factors.loc[nearest_date,['a', 'b']]
+    df[H2O] = df[H2O] + (a*df[t_sonic].mean() + b) * linear_func(df[t_sonic].mean())
+    return df
 
 
 def absolute_humidity(T, RH):
@@ -200,10 +214,20 @@ def linear_func(T):
     return -0.5/20 * T + 0.5
 
 
-def get_correction_coeff(df, gas_analyzer_info, iStation, temperature_bounds=(-30,-10)):
+def get_correction_coeff(df, gas_analyzer_info, iStation, temperature_bounds=(-30,-10),
+                         n_workers=1, use_cache=True):
     """
     Get coefficients that will be used to correct the raw gas concentrations
     A set of correction parameters is computed for each calibration periods.
+    The quantile regressions of the calibration periods are performed by
+    ``n_workers`` processes (default 1, serial).
+
+    If ``use_cache`` is True (default), the coefficients of each calibration
+    period are stored in ./Logs/{iStation}_h2o_correction_cache.sqlite along
+    with a hash of the regression input (the slow data of the period that
+    pass the calibration, invalid interval and quality criteria). They are
+    reused as long as this input does not change, so that usually only the
+    open calibration period is fitted again.
 
     """
 
@@ -260,9 +284,10 @@ def get_correction_coeff(df, gas_analyzer_info, iStation, temperature_bounds=(-3
 
 
     # Create time slices between two calibration
-    slices = iter_time_slices(df, gas_analyzer_info['calibration_dates'])
+    slices = list(iter_time_slices(df, gas_analyzer_info['calibration_dates']))
     invalid_periods = build_invalid_datetime_index(gas_analyzer_info['invalid_intervals'])
 
+    regressions = []
     for s in slices:
 
         # Remove invalid periods from regression data
@@ -304,21 +329,54 @@ def get_correction_coeff(df, gas_analyzer_info, iStation, temperature_bounds=(-3
         # Check if at least 10 bins have 20 points
         if sum(cut.value_counts() > 10) < 10:
             # Not enough data accross the different temperature bins to perform
-            # a reliable quantile regression. a = 0 and b = 0 means no
-            # correction is performed
-            a = b = 0
+            # a reliable quantile regression
+            regressions.append(None)
         else:
-            # Perform quantile regression
-
             # Absolute humidity corresponding to 99% relative humidity (close to saturation)
             q_sat = absolute_humidity(s.loc[id_valid, 'air_temp_IRGASON'], 99.0)
             # Distance between IRGASON density and saturation
             r = q_sat - s.loc[id_valid, 'H2O_density_IRGASON']
-
-            X = sm.add_constant(s.loc[id_valid, 'air_temp_IRGASON'])
-            mod = sm.QuantReg(r, X)
-            res = mod.fit(q=0.02)
-            b, a = res.params
+            regressions.append(
+                (s.loc[id_valid, 'air_temp_IRGASON'].to_numpy(dtype=float),
+                 r.to_numpy(dtype=float)))
+
+    # Reuse the coefficients of the periods whose regression input did not
+    # change since they were fitted
+    to_fit = [i for i, reg in enumerate(regressions) if reg is not None]
+    hashes = {i: regression_hash(*regressions[i], q=0.02) for i in to_fit}
+    cached = {}
+    if use_cache:
+        conn = open_coeff_cache(coeff_cache_path(iStation))
+        for i in to_fit:
+            row = conn.execute(
+                "SELECT input_hash, b, a FROM h2o_correction WHERE slice_start = ?",
+                (str(slices[i].index[0]),)).fetchone()
+            if row is not None and row[0] == hashes[i]:
+                cached[i] = (row[1], row[2])
+        to_fit = [i for i in to_fit if i not in cached]
+
+    # Perform quantile regressions, concurrently if requested
+    if n_workers > 1:
+        params = Parallel(n_jobs=n_workers)(
+            delayed(quantile_linear_fit)(*regressions[i], q=0.02) for i in to_fit)
+    else:
+        params = [quantile_linear_fit(*regressions[i], q=0.02) for i in to_fit]
+    params = dict(zip(to_fit, params))
+
+    if use_cache:
+        fitted_at = pd.Timestamp.now().isoformat(timespec='seconds')
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO h2o_correction VALUES (?, ?, ?, ?, ?, ?)",
+                [(str(slices[i].index[0]), str(slices[i].index[-1]), hashes[i],
+                  float(params[i][1]), float(params[i][0]), fitted_at)
+                 for i in to_fit])
+        conn.close()
+    params.update(cached)
+
+    for i, s in enumerate(slices):
+        # a = 0 and b = 0 means no correction is performed
+        b, a = params.get(i, (0, 0))
 
         # Save coeffcients
         corr_factors.loc[s.index,'a'] = a
@@ -331,3 +389,121 @@ def get_correction_coeff(df, gas_analyzer_info, iStation, temperature_bounds=(-3
     return corr_factors
 
 
+def coeff_cache_path(station):
+    """
+    Path to the cache of the H2O correction coefficients of a station.
+    """
+    return Path(".", "Logs", f"{station}_h2o_correction_cache.sqlite")
+
+
+def open_coeff_cache(cache_file):
+    """
+    Open the SQLite cache of the H2O correction coefficients, and create it
+    if it does not exist. Each calibration period is identified by its first
+    timestamp.
+
+    Parameters
+    ----------
+    cache_file : pathlib.Path
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(cache_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS h2o_correction ("
+        "slice_start TEXT PRIMARY KEY, slice_end TEXT, input_hash TEXT, "
+        "a REAL, b REAL, fitted_at TEXT)")
+    conn.commit()
+    return conn
+
+
+def regression_hash(x, y, q):
+    """
+    Hash of the input of a quantile regression, used to validate the cached
+    coefficients of a calibration period.
+    """
+    h = hashlib.sha1()
+    h.update(np.float64(q).tobytes())
+    h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def quantile_linear_fit(x, y, q, xtol=1e-10):
+    """
+    Linear quantile regression ``y = b + a*x`` with a single regressor.
+
+    Minimizes the quantile (pinball) loss exactly, as the linear program
+    solved by ``statsmodels.QuantReg``. For a given slope, the optimal
+    intercept is the q-quantile of the residuals ``y - a*x``, and the loss
+    of the best intercept is convex in the slope. The slope is then found by
+    a golden-section search, each step costing a partial sort.
+
+    Parameters
+    ----------
+    x : array_like
+        Regressor.
+    y : array_like
+        Response.
+    q : float
+        Quantile, between 0 and 1.
+    xtol : float, optional
+        Relative tolerance on the slope. The default is 1e-10.
+
+    Returns
+    -------
+    b : float
+        Intercept.
+    a : float
+        Slope.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) < 2 or np.ptp(x) == 0:
+        raise ValueError('At least two distinct values of x are needed')
+
+    # Order statistic of the residuals that minimizes the loss for a slope
+    k = int(np.ceil(q*len(y))) - 1
+
+    def loss(a):
+        r = y - a*x
+        b = np.partition(r, k)[k]
+        r = r - b
+        return np.sum(r * (q - (r < 0))), b
+
+    # Bracket the minimum around the least squares slope
+    a0 = np.polyfit(x, y, 1)[0]
+    loss0 = loss(a0)[0]
+    scale = np.std(y) / np.std(x)
+    bounds = []
+    for direction in (-1, 1):
+        step = scale
+        bound = a0 + direction*step
+        while loss(bound)[0] < loss0:
+            step *= 2
+            bound = a0 + direction*step
+        bounds.append(bound)
+    lo, hi = bounds
+
+    # Golden-section search of the slope
+    ratio = (np.sqrt(5) - 1) / 2
+    c = hi - ratio*(hi - lo)
+    d = lo + ratio*(hi - lo)
+    loss_c, loss_d = loss(c)[0], loss(d)[0]
+    while hi - lo > xtol*max(1, abs(lo), abs(hi)):
+        if loss_c < loss_d:
+            hi, d, loss_d = d, c, loss_c
+            c = hi - ratio*(hi - lo)
+            loss_c = loss(c)[0]
+        else:
+            lo, c, loss_c = c, d, loss_d
+            d = lo + ratio*(hi - lo)
+            loss_d = loss(d)[0]
+
+    a = (lo + hi) / 2
+    return loss(a)[1], a
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar archive of the high frequency (10 Hz) eddy covariance data.
+
+The archive holds one Parquet file per station and day:
+
+    archive_dir/
+    ├── station/
+    │   ├── YYYYMMDD.parquet
+    │   └── YYYYMMDD.parquet
+
+Each half-hour block (as sliced by ``csbinary_to_csv.slice_30min_blocks``)
+is stored in its own row group, with typed and compressed columns. The file
+metadata maps the name of each half-hour (``YYYYMMDD_HHMM``, as in the
+``_eddy.csv`` files) to its row group, along with its TOA5 header, so that a
+half-hour is read without decoding the rest of the day. The 10 Hz
+transforms read the half-hours from the archive (see ``read_toa5`` and
+``hf_transforms.run``), and they can be exported as TOA5 files on demand
+(see ``csbinary_to_csv.export_toa5``).
+
+pyarrow is only needed when an archive is used: the modules that write or
+read it import this module when given an ``archive_dir``.
+"""
+import os
+import json
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+
+def day_file(station_name, archive_dir, day):
+    """
+    Path of the archive file of a station and day.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+    day : str
+        Day as ``YYYYMMDD``.
+
+    Returns
+    -------
+    pathlib.Path
+    """
+    return Path(archive_dir).joinpath(station_name, f'{day}.parquet')
+
+
+def read_index(file):
+    """
+    Read the half-hour index of an archive file, from its metadata only.
+
+    Parameters
+    ----------
+    file : str or pathlib.Path
+        Path to the archive file.
+
+    Returns
+    -------
+    dict
+        ``{name: {'row_group': int, 'header': list of str,
+        'dtypes': dict}}`` for each half-hour of the file.
+    """
+    metadata = pq.read_metadata(file).metadata or {}
+    return json.loads(metadata.get(b'half_hours', b'{}'))
+
+
+def list_half_hours(station_name, archive_dir):
+    """
+    List the half-hours stored in the archive of a station.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+
+    Returns
+    -------
+    list of str
+        Sorted half-hour names, as ``YYYYMMDD_HHMM``.
+    """
+    names = []
+    for file in Path(archive_dir).joinpath(station_name).glob('*.parquet'):
+        names.extend(read_index(file))
+    return sorted(names)
+
+
+def read_half_hour(station_name, archive_dir, name):
+    """
+    Read one half-hour of the archive.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+    name : str
+        Half-hour name, as ``YYYYMMDD_HHMM``.
+
+    Returns
+    -------
+    df : pandas.DataFrame or None
+        Data indexed by 'timestamp', with the columns and dtypes the block
+        was written with. None if the half-hour is not archived.
+    header : list of str or None
+        The 4 TOA5 header lines of the block, newline terminated.
+    """
+    file = day_file(station_name, archive_dir, name[:8])
+    if not file.exists():
+        return None, None
+    entry = read_index(file).get(name)
+    if entry is None:
+        return None, None
+
+    table = pq.ParquetFile(file).read_row_group(entry['row_group'])
+    return _to_block(table, entry), entry['header']
+
+
+def read_toa5(station_name, archive_dir, name):
+    """
+    Read one half-hour of the archive as ``utils.data_loader.toa5_file``
+    loads its ``_eddy.csv`` file, so that the 10 Hz stages get the same
+    values from the archive as from the CSV file.
+
+    Float32 columns are converted to float64 through their shortest decimal
+    representation, which is what a CSV file written without
+    ``float_precision`` holds, and integer columns to int64. Duplicated
+    timestamps are dropped, keeping the last one.
+
+    Parameters
+    ----------
+    station_name, archive_dir, name
+        See ``read_half_hour``.
+
+    Returns
+    -------
+    df : pandas.DataFrame or None
+        Data indexed by 'timestamp'. None if the half-hour is not archived.
+    header : list of str or None
+        The 4 TOA5 header lines of the block, newline terminated.
+    """
+    df, header = read_half_hour(station_name, archive_dir, name)
+    if df is None:
+        return None, None
+
+    for column, dtype in df.dtypes.items():
+        if dtype == np.float32:
+            df[column] = df[column].astype(str).astype(np.float64)
+        elif dtype.kind in 'iu':
+            df[column] = df[column].astype(np.int64)
+    df = df[~df.index.duplicated(keep='last')]
+    return df, header
+
+
+def read(station_name, archive_dir, start=None, end=None):
+    """
+    Read the archived data of a station between two dates.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+    start, end : str or datetime-like, optional
+        Bounds (inclusive) of the period to read. The default reads
+        everything.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Data indexed by 'timestamp'. Columns that are missing in some
+        half-hours are filled with NaN.
+    """
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    frames = []
+    for file in sorted(Path(archive_dir).joinpath(station_name).glob('*.parquet')):
+        # Day files hold the half-hours named after that day, which may
+        # start up to 30 min before and end 30 min after it
+        day = pd.Timestamp(file.stem)
+        if start is not None and day + pd.Timedelta(days=1, minutes=30) < start:
+            continue
+        if end is not None and day > end:
+            continue
+        df = pq.read_table(file).to_pandas().set_index('timestamp')
+        frames.append(df.loc[start:end])
+
+    if not frames:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='timestamp'))
+    return pd.concat(frames).sort_index(kind='stable')
+
+
+def write(station_name, archive_dir, blocks, compression='zstd'):
+    """
+    Store half-hour blocks in the archive.
+
+    Blocks are grouped by day, and each day file is rewritten once with its
+    previous half-hours and the new ones. A block replaces the archived
+    half-hour of the same name, as converting a file again overwrites its
+    ``_eddy.csv`` files. Day files are replaced atomically.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    archive_dir : str or pathlib.Path
+        Root directory of the archive.
+    blocks : list of tuple
+        ``(name, df, header)`` of each half-hour, where ``name`` is
+        ``YYYYMMDD_HHMM``, ``df`` is indexed by timestamp and ``header``
+        holds the 4 TOA5 header lines. Later blocks replace earlier ones of
+        the same name.
+    compression : str, optional
+        Parquet compression codec. The default is 'zstd'.
+
+    Returns
+    -------
+    list of pathlib.Path
+        Day files written.
+    """
+    by_day = {}
+    for name, df, header in blocks:
+        by_day.setdefault(name[:8], {})[name] = (df, header)
+
+    written = []
+    for day, new_blocks in sorted(by_day.items()):
+        file = day_file(station_name, archive_dir, day)
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Keep the half-hours of the day that are not replaced
+        day_blocks = {}
+        if file.exists():
+            parquet_file = pq.ParquetFile(file)
+            for name, entry in read_index(file).items():
+                if name not in new_blocks:
+                    table = parquet_file.read_row_group(entry['row_group'])
+                    day_blocks[name] = (_to_block(table, entry), entry['header'])
+        day_blocks.update(new_blocks)
+
+        _write_day(file, day_blocks, compression)
+        written.append(file)
+    return written
+
+
+def _write_day(file, day_blocks, compression):
+    """
+    Write the half-hours of a day to a temporary file, one row group each,
+    and move it to ``file``.
+    """
+    names = sorted(day_blocks)
+    tables = [pa.Table.from_pandas(day_blocks[name][0].rename_axis('timestamp').reset_index(),
+                                   preserve_index=False).replace_schema_metadata()
+              for name in names]
+
+    # Blocks may not have the same columns if the logger program changed
+    # during the day: store the union of the columns
+    schema = pa.unify_schemas([t.schema for t in tables], promote_options='permissive')
+    index = {}
+    for i, name in enumerate(names):
+        df, header = day_blocks[name]
+        index[name] = {
+            'row_group': i,
+            'header': list(header),
+            'dtypes': {str(c): str(t) for c, t in df.dtypes.items()},
+            }
+    schema = schema.with_metadata({b'half_hours': json.dumps(index).encode()})
+
+    tmp_name = file.with_name(f'{file.name}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp')
+    try:
+        with pq.ParquetWriter(tmp_name, schema, compression=compression) as writer:
+            for table in tables:
+                for field in schema:
+                    if field.name not in table.column_names:
+                        table = table.append_column(
+                            field.name, pa.nulls(table.num_rows, field.type))
+                table = table.select(schema.names).cast(schema)
+                writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        os.replace(tmp_name, file)
+    except BaseException:
+        if tmp_name.exists():
+            os.remove(tmp_name)
+        raise
+
+
+def _to_block(table, entry):
+    """
+    Convert a row group back to the block it was written from: same columns,
+    in the same order, with the same dtypes.
+    """
+    dtypes = entry['dtypes']
+    df = table.select(['timestamp'] + list(dtypes)).to_pandas().set_index('timestamp')
+    return df.astype(dtypes, copy=False)
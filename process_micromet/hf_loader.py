@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Batched loading of the high frequency (10 Hz) half-hour files.
+
+Half-hour blocks are read concurrently by threads, with a fixed schema, into
+one preallocated array of shape (half-hours, samples, channels), padded with
+NaN where a block is short or missing. The array can be memory-mapped to a
+.npy file for ranges that do not fit in memory::
+
+    x, timestamps, file_records, errors = hf_loader.load(
+        'Reservoir', csv_folder, '2023-07-01 00:00', '2023-07-31 23:30',
+        channels=['Ux', 'Uy', 'Uz', 'T_SONIC', 'CO2_density', 'H2O_density'])
+    w = x[..., 2]
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+# Numeric channels of the _eddy.csv files, as in the TOA5 headers. Integer
+# channels are read as floats to hold NaN
+EDDY_CHANNELS = [
+    'RECORD', 'Ux', 'Uy', 'Uz', 'T_SONIC', 'diag_sonic', 'CO2_density',
+    'CO2_density_fast_tmpr', 'H2O_density', 'diag_irga', 'T_SONIC_corr',
+    'TA_1_1_1', 'PA', 'CO2_sig_strgth', 'H2O_sig_strgth', 'accel_x',
+    'accel_y', 'accel_z', 'ang_rate_x', 'ang_rate_y', 'ang_rate_z', 'roll',
+    'pitch', 'yaw', 'imu_ahrs_checksum_f']
+
+
+def half_hour_files(station_name, csv_folder, start, end, suffix='_eddy_corr.csv'):
+    """
+    Files of the half-hours of a station starting from ``start`` to ``end``
+    (included), whether they exist or not.
+
+    Parameters
+    ----------
+    station_name : str
+        Name of the station.
+    csv_folder : pathlib.Path
+        Directory of the 10 Hz files, one subdirectory per station.
+    start, end : datetime-like
+        Start of the first and last half-hours.
+    suffix : str, optional
+        Suffix of the files after the half-hour (``YYYYMMDD_HHMM``). The
+        default is '_eddy_corr.csv'.
+
+    Returns
+    -------
+    timestamps : pandas.DatetimeIndex
+        Start of each half-hour.
+    files : list of pathlib.Path
+        File of each half-hour.
+    """
+    timestamps = pd.date_range(pd.Timestamp(start).floor('30min'), end, freq='30min')
+    station_folder = csv_folder.joinpath(station_name)
+    files = [station_folder.joinpath(f'{t:%Y%m%d_%H%M}{suffix}') for t in timestamps]
+    return timestamps, files
+
+
+def load(station_name, csv_folder, start, end, channels=None, suffix='_eddy_corr.csv',
+         fs=10, dtype=np.float64, n_threads=8, memmap_file=None):
+    """
+    Load the half-hours of a station in a date range as one array.
+
+    Parameters
+    ----------
+    station_name, csv_folder, start, end, suffix
+        See ``half_hour_files``.
+    channels : list of str, optional
+        Columns to load, by name. The default is ``EDDY_CHANNELS``.
+    fs : float, optional
+        Acquisition frequency [Hz]. The default is 10.
+    dtype, n_threads, memmap_file
+        See ``read_blocks``.
+
+    Returns
+    -------
+    x : numpy.ndarray or numpy.memmap
+        Array of shape (half-hours, samples, channels).
+    timestamps : pandas.DatetimeIndex
+        Start of each half-hour.
+    file_records : numpy.ndarray
+        Number of records of each file (0 if missing or unreadable).
+    errors : list
+        Log line of each file that could not be read.
+    """
+    if channels is None:
+        channels = EDDY_CHANNELS
+    timestamps, files = half_hour_files(station_name, csv_folder, start, end, suffix)
+    x, file_records, errors = read_blocks(files, channels, int(round(fs * 1800)),
+                                          dtype=dtype, n_threads=n_threads,
+                                          memmap_file=memmap_file)
+    return x, timestamps, file_records, errors
+
+
+def read_blocks(files, columns, n_samples, header_rows=4, names_row=1,
+                dtype=np.float64, n_threads=8, memmap_file=None):
+    """
+    Read CSV files into a preallocated array of shape (files, n_samples,
+    columns). Blocks are truncated or padded with NaN to ``n_samples``.
+    Missing columns and non-numeric values are NaN.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        Files to read.
+    columns : list of str or list of int
+        Columns to read, by name (in the ``names_row`` of the header) or by
+        0-based position.
+    n_samples : int
+        Number of samples of each block.
+    header_rows : int, optional
+        Number of header lines. The default is 4 (TOA5).
+    names_row : int, optional
+        Header line with the column names. The default is 1 (TOA5).
+    dtype : numpy.dtype, optional
+        Type of the array. The default is float64.
+    n_threads : int, optional
+        Number of threads reading files concurrently. The default is 8.
+    memmap_file : pathlib.Path, optional
+        If given, the array is memory-mapped to this .npy file (it can be
+        reopened with ``numpy.load(memmap_file, mmap_mode='r')``). The
+        default is None (in memory).
+
+    Returns
+    -------
+    x : numpy.ndarray or numpy.memmap
+        Values of the columns.
+    file_records : numpy.ndarray
+        Number of records of each file (0 if it could not be read).
+    errors : list
+        Log line of each file that could not be read.
+    """
+    shape = (len(files), n_samples, len(columns))
+    if memmap_file is not None:
+        x = open_memmap(memmap_file, mode='w+', dtype=dtype, shape=shape)
+    else:
+        x = np.empty(shape, dtype=dtype)
+    x[:] = np.nan
+
+    # Each thread fills its own blocks of the array
+    by_name = all(isinstance(c, str) for c in columns)
+    with ThreadPoolExecutor(max_workers=max(min(n_threads, len(files)), 1)) as executor:
+        results = list(executor.map(
+            lambda i: _read_block(files[i], columns, by_name, header_rows,
+                                  names_row, x[i]),
+            range(len(files))))
+
+    file_records = np.array([n for n, _ in results], dtype=int)
+    errors = [e for _, e in results if e]
+    if memmap_file is not None:
+        x.flush()
+    return x, file_records, errors
+
+
+def _read_block(file, columns, by_name, header_rows, names_row, out):
+    """
+    Read a file into ``out``, of shape (samples, columns).
+
+    Returns
+    -------
+    n_records : int
+        Number of records of the file.
+    error : str or None
+        Log line if the file could not be read.
+    """
+    if by_name:
+        # Columns missing from the file are left NaN
+        wanted = set(columns)
+        usecols = lambda c: c in wanted
+        skiprows = [i for i in range(header_rows) if i != names_row]
+        header = 0
+    else:
+        usecols = columns
+        skiprows = header_rows
+        header = None
+    try:
+        try:
+            df = pd.read_csv(file, header=header, skiprows=skiprows,
+                             usecols=usecols, dtype=np.float64,
+                             na_values=['NAN', 'NaN', 'nan'])
+        except ValueError:
+            # Non-numeric values, e.g. a truncated last line
+            df = pd.read_csv(file, header=header, skiprows=skiprows,
+                             usecols=usecols, dtype=str,
+                             na_values=['NAN', 'NaN', 'nan'])
+            df = df.apply(pd.to_numeric, errors='coerce')
+    except Exception as e:
+        return 0, f'Failed to load file {file}: {str(e)}\n'
+
+    values = df.reindex(columns=columns).to_numpy(np.float64)
+    n = min(len(values), len(out))
+    out[:n] = values[:n]
+    return len(values), None
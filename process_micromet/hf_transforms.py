@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass over the high frequency (10 Hz) half-hour files.
+
+Each ``_eddy.csv`` file is loaded once, goes through a chain of in-memory
+transforms and is written once as its ``_eddy_corr.csv`` file, instead of
+being read and rewritten by each correction. A transform is a callable
+``transform(df, timestamp)`` that returns the transformed data, e.g.::
+
+    transforms = [
+        functools.partial(gas_analyzer.correct_h2o, corr_factors=corr_coeff),
+        sonic.correct_wind,
+        ]
+    hf_transforms.run(station, gas_analyzer.find_uncorrected_files(folder),
+                      transforms)
+"""
+import os
+import tempfile
+from functools import lru_cache
+import joblib
+from tqdm import tqdm
+from joblib import Parallel, delayed
+from utils import data_loader as dl
+from process_micromet.csbinary_to_csv import write_tmp_block
+
+
+def run(station, eddy_files, transforms, suffix='_eddy_corr.csv', n_workers=1,
+        chunk_size=48, log_name='hf_transforms', desc='Transforming 10 Hz files',
+        archive_dir=None):
+    """
+    Apply a chain of transforms to 10 Hz _eddy.csv files and write the
+    result next to them.
+
+    Parameters
+    ----------
+    station : str
+        Name of the station.
+    eddy_files : list of pathlib.Path
+        _eddy.csv files to transform (see
+        ``gas_analyzer.find_uncorrected_files``).
+    transforms : list of callable
+        Transforms applied in order, as ``df = transform(df, timestamp)``,
+        where ``df`` is loaded with ``dl.toa5_file`` and ``timestamp`` is the
+        half-hour of the file (``YYYYMMDD_HHMM``). A transform raises an
+        exception to skip a file. Transforms must be picklable (module
+        functions or ``functools.partial`` of them) if ``n_workers > 1``.
+    suffix : str, optional
+        Suffix of the output files, replacing '_eddy.csv'. The default is
+        '_eddy_corr.csv'.
+    n_workers : int, optional
+        Number of worker processes transforming files concurrently. The
+        transforms (and the data bound to them, e.g. correction factors) are
+        dumped once to a temporary file that each worker loads once; files
+        are then sent to the workers in chunks of ``chunk_size`` files.
+        Failures are collected and written to the log by the
+        calling process, in the order of ``eddy_files``. The default is 1
+        (serial).
+    chunk_size : int, optional
+        Number of files per chunk. The default is 48 (one day).
+    log_name : str, optional
+        Name of the log file, before the station name. The default is
+        'hf_transforms'.
+    desc : str, optional
+        Description of the progress bar. The default is 'Transforming 10 Hz
+        files'.
+    archive_dir : pathlib.Path, optional
+        Root directory of the columnar archive of the 10 Hz data (see
+        ``hf_archive``). Half-hours stored in the archive are read from it
+        (``hf_archive.read_toa5``) instead of their _eddy.csv file, which
+        may then not exist. The default is None (CSV files only).
+
+    Returns
+    -------
+    None. Write a file for each input file with the transformed data and
+    the TOA5 header of the input file, through a temporary file renamed
+    over the output file. Files that failed are logged in
+    ./Logs/{log_name}_{station}.log
+    """
+    print(f'Start transforming the 10 Hz files of the {station} station')
+
+    eddy_files = list(eddy_files)
+    chunks = [eddy_files[i:i + chunk_size]
+              for i in range(0, len(eddy_files), chunk_size)]
+
+    logf = open(os.path.join('.', 'Logs', f'{log_name}_{station}.log'), "w")
+    progress = tqdm(total=len(eddy_files), desc=f'{station}: {desc}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if n_workers > 1:
+            # Ship the transforms once, instead of pickling them with each chunk
+            transforms_file = os.path.join(tmp_dir, 'transforms.pkl')
+            joblib.dump(transforms, transforms_file)
+            results = Parallel(n_jobs=n_workers, return_as='generator')(
+                delayed(transform_files)(chunk, transforms_file, suffix, archive_dir)
+                for chunk in chunks)
+        else:
+            results = (transform_files(chunk, transforms, suffix, archive_dir)
+                       for chunk in chunks)
+
+        for errors in results:
+            for error in errors:
+                if error:
+                    logf.write(error)
+            progress.update(len(errors))
+    progress.close()
+
+    # Close error log file
+    logf.close()
+    print('Done!')
+
+
+def transform_files(eddy_files, transforms, suffix='_eddy_corr.csv', archive_dir=None):
+    """
+    Transform a chunk of _eddy.csv files. See ``run``. ``transforms`` is
+    either the list of transforms or the file they were dumped to.
+
+    Returns
+    -------
+    errors : list
+        Log line of each file, or None if the file was transformed.
+    """
+    if isinstance(transforms, str):
+        transforms = load_transforms(transforms)
+    return [transform_file(eddy_file, transforms, suffix, archive_dir)
+            for eddy_file in eddy_files]
+
+
+@lru_cache(maxsize=4)
+def load_transforms(transforms_file):
+    """
+    Load the transforms dumped by ``run``, once per worker process.
+    """
+    return joblib.load(transforms_file)
+
+
+def transform_file(eddy_file, transforms, suffix='_eddy_corr.csv', archive_dir=None):
+    """
+    Transform an _eddy.csv file and write the result. See ``run``.
+
+    Returns
+    -------
+    error : str or None
+        Log line if the file could not be transformed, None otherwise.
+    """
+    out_file = eddy_file.with_name(eddy_file.name.replace("_eddy.csv", suffix))
+    timestamp = eddy_file.name.replace("_eddy.csv", "")
+
+    try:
+        # Load data and header once, from the archive if the half-hour is
+        # stored in it
+        df = None
+        if archive_dir is not None:
+            from process_micromet import hf_archive
+            df, header = hf_archive.read_toa5(eddy_file.parent.name, archive_dir, timestamp)
+        if df is None:
+            df = dl.toa5_file(eddy_file)
+            header = dl.toa5_header(eddy_file, False)
+
+        for transform in transforms:
+            df = transform(df, timestamp)
+
+        # Write header and data to a temporary file renamed over the
+        # destination file, so that an interrupted run never leaves a
+        # truncated _eddy_corr.csv file
+        payload = df.to_csv(header=False, quoting=0)
+        os.replace(write_tmp_block(out_file, header, payload), out_file)
+
+    except Exception as e:
+        print(str(e))
+        return f'Failed to transform file {eddy_file}: {str(e)}\n'
+
+    return None
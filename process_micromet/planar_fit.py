@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Planar fit (Wilczak et al., 2001) estimated from running sums.
+
+The half-hourly mean winds of a configuration period are reduced, per wind
+sector, to the sums of the normal equations of the regression
+``w = b0 + b1 u + b2 v``. The sums are stored in
+./Logs/{station}_planar_fit.sqlite along with the half-hours they include,
+so that new half-hours are added to them without reading the period again,
+and the coefficients and tilt angles of each sector are solved from the sums
+at any time (see ``flux_engine.update_planar_fit``).
+
+Sectors follow the planar fit settings of the .eddypro files: they start at
+pf_north_offset and have widths pf_sect_N_width, and sectors with
+pf_sect_N_exclude are not fitted. Half-hours of excluded sectors, or of
+sectors with less than pf_min_num_per_sec half-hours, are rotated with the
+fit of all the sectors that are not excluded.
+"""
+import json
+import hashlib
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+# Sums of the normal equations, in the order of the columns of the cache
+SUMS = ['n', 'su', 'sv', 'sw', 'suu', 'suv', 'svv', 'suw', 'svw']
+
+
+def cache_path(station):
+    """
+    Path to the planar fit sums of a station.
+    """
+    return Path(".", "Logs", f"{station}_planar_fit.sqlite")
+
+
+def open_cache(cache_file):
+    """
+    Open the SQLite database of the planar fit sums, and create it if it does
+    not exist. Each configuration period is identified by the name of its
+    .eddypro file.
+
+    Parameters
+    ----------
+    cache_file : pathlib.Path
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    conn = sqlite3.connect(cache_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS planar_fit_config ("
+        "config TEXT PRIMARY KEY, settings_hash TEXT, updated_at TEXT)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS planar_fit_sums ("
+        "config TEXT, sector INTEGER, "
+        + ", ".join(f"{s} REAL" for s in SUMS)
+        + ", PRIMARY KEY (config, sector))")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS planar_fit_half_hours ("
+        "config TEXT, timestamp TEXT, sector INTEGER, "
+        "PRIMARY KEY (config, timestamp))")
+    conn.commit()
+    return conn
+
+
+def settings_hash(settings):
+    """
+    Hash of the settings the sums depend on. Sums computed with other
+    settings are discarded.
+    """
+    keys = ['rot_meth', 'pf_w_max', 'pf_u_min', 'pf_north_offset', 'pf_sectors',
+            'north_offset', 'flags', 'limits', 'filter_sr', 'filter_al', 'max_lack',
+            'tests']
+    relevant = {k: settings[k] for k in keys}
+    relevant['columns'] = {v: settings['columns'][v] for v in ('u', 'v', 'w', 'ts')}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def sector_of(wind_dir, settings):
+    """
+    Planar fit sector of wind directions.
+
+    Parameters
+    ----------
+    wind_dir : numpy.ndarray
+        Wind directions [deg from north].
+    settings : dict
+        See ``flux_engine.read_settings``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Index of the sector, -1 if the direction is missing or outside the
+        sectors.
+    """
+    widths = np.array([s['width'] for s in settings['pf_sectors']])
+    ends = np.cumsum(widths)
+    relative = np.mod(np.nan_to_num(wind_dir) - settings['pf_north_offset'], 360)
+    sector = np.searchsorted(ends, relative, side='right')
+    return np.where(np.isfinite(wind_dir) & (sector < len(widths)), sector, -1)
+
+
+def processed_timestamps(conn, config):
+    """
+    Half-hours already included in the sums of a configuration period, as
+    ``YYYYMMDD_HHMM`` (start of the half-hour).
+    """
+    rows = conn.execute(
+        "SELECT timestamp FROM planar_fit_half_hours WHERE config=?", (config,))
+    return {r[0] for r in rows}
+
+
+def update(conn, config, settings, names, mean_winds, wind_dir):
+    """
+    Add half-hours to the sums of a configuration period. Sums computed with
+    other settings are reset first.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        See ``open_cache``.
+    config : str
+        Name of the configuration period.
+    settings : dict
+        See ``flux_engine.read_settings``.
+    names : list of str
+        Half-hours, as ``YYYYMMDD_HHMM`` (start of the half-hour).
+    mean_winds : numpy.ndarray
+        Mean u, v, w of the half-hours, of shape (half-hours, 3). Rows with
+        NaN are recorded as processed but not added to the sums.
+    wind_dir : numpy.ndarray
+        Mean wind direction of the half-hours [deg from north].
+
+    Returns
+    -------
+    None
+    """
+    digest = settings_hash(settings)
+    row = conn.execute("SELECT settings_hash FROM planar_fit_config WHERE config=?",
+                       (config,)).fetchone()
+    if row is not None and row[0] != digest:
+        conn.execute("DELETE FROM planar_fit_sums WHERE config=?", (config,))
+        conn.execute("DELETE FROM planar_fit_half_hours WHERE config=?", (config,))
+
+    u, v, w = np.asarray(mean_winds, dtype=float).T
+    keep = (np.isfinite(mean_winds).all(axis=1)
+            & (np.abs(np.nan_to_num(w)) <= settings['pf_w_max'])
+            & (np.hypot(np.nan_to_num(u), np.nan_to_num(v)) >= settings['pf_u_min']))
+    sector = np.where(keep, sector_of(wind_dir, settings), -1)
+
+    n_sectors = len(settings['pf_sectors'])
+    sums = load_sums(conn, config, n_sectors)
+    sums += normal_sums(u, v, w, sector, n_sectors)
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO planar_fit_sums VALUES (?, ?, "
+        + ", ".join("?" * len(SUMS)) + ")",
+        [(config, i, *map(float, sums[i])) for i in range(n_sectors)])
+    conn.executemany(
+        "INSERT OR REPLACE INTO planar_fit_half_hours VALUES (?, ?, ?)",
+        [(config, name, int(s)) for name, s in zip(names, sector)])
+    conn.execute(
+        "INSERT OR REPLACE INTO planar_fit_config VALUES (?, ?, ?)",
+        (config, digest, datetime.now().isoformat(timespec='seconds')))
+    conn.commit()
+
+
+def normal_sums(u, v, w, sector, n_sectors):
+    """
+    Sums of the normal equations of each sector.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (sectors, 9), with the columns of ``SUMS``.
+    """
+    valid = sector >= 0
+    u, v, w, sector = u[valid], v[valid], w[valid], sector[valid]
+    terms = np.column_stack([np.ones_like(u), u, v, w, u * u, u * v, v * v, u * w, v * w])
+    sums = np.zeros((n_sectors, len(SUMS)))
+    np.add.at(sums, sector, terms)
+    return sums
+
+
+def load_sums(conn, config, n_sectors):
+    """
+    Sums of the normal equations of each sector of a configuration period.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (sectors, 9), zeros for a new configuration period.
+    """
+    sums = np.zeros((n_sectors, len(SUMS)))
+    rows = conn.execute(
+        "SELECT sector, " + ", ".join(SUMS) + " FROM planar_fit_sums WHERE config=?",
+        (config,))
+    for row in rows:
+        if row[0] < n_sectors:
+            sums[row[0]] = row[1:]
+    return sums
+
+
+def solve(sums, no_bias=False):
+    """
+    Coefficients (b0, b1, b2) of the plane from the sums of the normal
+    equations. b0 is 0 if ``no_bias``. NaN if the system is singular,
+    including with fewer half-hours than coefficients.
+    """
+    n, su, sv, sw, suu, suv, svv, suw, svw = sums
+    if n < (2 if no_bias else 3):
+        return np.full(3, np.nan)
+    if no_bias:
+        a = np.array([[suu, suv], [suv, svv]])
+        y = np.array([suw, svw])
+    else:
+        a = np.array([[n, su, sv], [su, suu, suv], [sv, suv, svv]])
+        y = np.array([sw, suw, svw])
+    try:
+        b = np.linalg.solve(a, y)
+    except np.linalg.LinAlgError:
+        return np.full(3, np.nan)
+    return np.r_[0, b] if no_bias else b
+
+
+def fit(sums, settings):
+    """
+    Coefficients of the planar fit of each sector.
+
+    Parameters
+    ----------
+    sums : numpy.ndarray
+        See ``load_sums``.
+    settings : dict
+        See ``flux_engine.read_settings``. Planar fit with no velocity bias
+        if rot_meth is 4.
+
+    Returns
+    -------
+    coefficients : numpy.ndarray
+        Array of shape (sectors + 1, 3): (b0, b1, b2) of each sector, then of
+        all the sectors that are not excluded, used for the half-hours of
+        the other sectors (index -1).
+    """
+    no_bias = settings['rot_meth'] == 4
+    n_min = max(settings['pf_min_num_per_sec'], 3)
+    excluded = np.array([s['exclude'] for s in settings['pf_sectors']], dtype=bool)
+
+    overall = solve(sums[~excluded].sum(axis=0), no_bias)
+    if np.isnan(overall).any():
+        raise ValueError(f'Not enough half-hours ({int(sums[~excluded, 0].sum())}) '
+                         'to fit the planar fit')
+    coefficients = np.tile(overall, (len(sums) + 1, 1))
+    for i, s in enumerate(sums):
+        if not excluded[i] and s[0] >= n_min:
+            b = solve(s, no_bias)
+            if np.isfinite(b).all():
+                coefficients[i] = b
+    return coefficients
+
+
+def rotation_matrix(b):
+    """
+    Rotation matrices from the sonic axes to the axes of planes.
+
+    Parameters
+    ----------
+    b : numpy.ndarray
+        Coefficients (b0, b1, b2), of shape (..., 3).
+
+    Returns
+    -------
+    numpy.ndarray
+        Matrices of shape (..., 3, 3).
+    """
+    b = np.asarray(b, dtype=float)
+    b1, b2 = b[..., 1], b[..., 2]
+
+    # P = D C of Wilczak et al. (2001): the third row of P is the unit
+    # normal of the plane (p31, p32, p33)
+    norm = np.sqrt(b1**2 + b2**2 + 1)
+    p31, p32, p33 = -b1 / norm, -b2 / norm, 1 / norm
+    sin_a, cos_a = p31, np.sqrt(p32**2 + p33**2)
+    sin_b, cos_b = -p32 / cos_a, p33 / cos_a
+    zero, one = np.zeros_like(b1), np.ones_like(b1)
+    roll = np.stack([np.stack([one, zero, zero], -1),
+                     np.stack([zero, cos_b, sin_b], -1),
+                     np.stack([zero, -sin_b, cos_b], -1)], -2)
+    pitch = np.stack([np.stack([cos_a, zero, -sin_a], -1),
+                      np.stack([zero, one, zero], -1),
+                      np.stack([sin_a, zero, cos_a], -1)], -2)
+    return pitch @ roll
+
+
+def tilt_angles(b):
+    """
+    Pitch and roll angles [deg] of planes, positive when w increases with u
+    and v respectively.
+    """
+    P = rotation_matrix(b)
+    return (-np.degrees(np.arcsin(P[..., 2, 0])),
+            np.degrees(np.arctan2(-P[..., 2, 1], P[..., 2, 2])))
+
+
+def write_pf_file(out_file, settings, sums, coefficients, start, end):
+    """
+    Write the planar fit of a configuration period as a planar fit file, the
+    file referenced by pf_file in the .eddypro files: for each sector, its
+    bounds, number of half-hours, coefficients, tilt angles and rotation
+    matrix.
+
+    Parameters
+    ----------
+    out_file : pathlib.Path
+        Path to the output file.
+    settings : dict
+        See ``flux_engine.read_settings``.
+    sums : numpy.ndarray
+        See ``load_sums``.
+    coefficients : numpy.ndarray
+        See ``fit``.
+    start, end : datetime-like
+        Period of the half-hours included.
+    """
+    widths = [s['width'] for s in settings['pf_sectors']]
+    starts = np.mod(settings['pf_north_offset'] + np.r_[0, np.cumsum(widths)[:-1]], 360)
+    pitch, roll = tilt_angles(coefficients)
+    matrices = rotation_matrix(coefficients)
+
+    lines = ['Planar Fit Rotation Matrices',
+             f'Processed raw data from: {start:%Y-%m-%d %H:%M} to: {end:%Y-%m-%d %H:%M}',
+             f'Method: {"planar fit with no velocity bias" if settings["rot_meth"] == 4 else "planar fit"}',
+             f'Number of wind sectors: {len(widths)}',
+             f'Max mean vertical wind component (m/s): {settings["pf_w_max"]:.3f}',
+             f'Min mean horizontal wind component (m/s): {settings["pf_u_min"]:.3f}',
+             f'Min number of elements per sector: {settings["pf_min_num_per_sec"]}',
+             '']
+    for i, width in enumerate(widths):
+        lines += [f'Sector #{i + 1}',
+                  f'Starting angle (deg from north): {starts[i]:.1f}',
+                  f'Width (deg): {width:.1f}',
+                  f'Excluded: {int(settings["pf_sectors"][i]["exclude"])}',
+                  f'Number of elements: {int(sums[i, 0])}',
+                  'Regression coefficients (b0, b1, b2): '
+                  + ', '.join(f'{c:.8f}' for c in coefficients[i]),
+                  f'Pitch angle (deg): {pitch[i]:.6f}',
+                  f'Roll angle (deg): {roll[i]:.6f}',
+                  'Rotation matrix:']
+        lines += ['  ' + '  '.join(f'{x:12.8f}' for x in row) for row in matrices[i]]
+        lines.append('')
+
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, 'w') as fp:
+        fp.write('\n'.join(lines))
@@ -1,56 +1,31 @@
 # -*- coding: utf-8 -*-
-import os
+import warnings
 import numpy as np
 import pandas as pd
-from process_micromet.filters import spikes
-from utils import data_loader as dl
-from tqdm import tqdm
+from numpy.lib.stride_tricks import sliding_window_view
 
 
-def find_unrotated_files(folder, overwrite=False):
+def correct_wind(df, timestamp=None):
     """
-    Find _eddy_corr.csv files without a corresponding _eddy_corr_rot.csv file.
-    Returns a list of_eddy_corr.csv files without its corresponding _eddy_corr_rot.csv.
-    """
-    eddy_files = set()
-    eddy_corr_files = set()
-
-    for p in folder.iterdir():
-        name = p.name
-
-        # Extract timestamp of _eddy and _eddy_corr
-        if name.endswith("_eddy_corr.csv") and not name.endswith("_eddy_corr_rot.csv"):
-            timestamp = name.replace("_eddy_corr.csv", "")
-            eddy_files.add(timestamp)
-
-        elif name.endswith("_eddy_corr_rot.csv"):
-            timestamp = name.replace("_eddy_corr_rot.csv", "")
-            eddy_corr_files.add(timestamp)
-
-    # timestamps where eddy exists but eddy_corr is missing
-    missing_corr_timestamp = eddy_files - eddy_corr_files
-
-    # corresponding eddy filenames
-    missing_corr_eddy_files = [
-        folder.joinpath(f"{ts}_eddy_corr.csv")
-        for ts in sorted(missing_corr_timestamp)
-    ]
-
-    return missing_corr_eddy_files
-
-
-def rotate(station_name,unrotated_files):
-    """Perform a rotation of the IRGASON 3D wind components according to the
-    3DM-25 accelerometer measurements.
-    Reads 10Hz _eddy_corr.csv files and write new eddy_corr_rot.csv files.
+    Correct the IRGASON 3D wind components of a 10 Hz half-hour for the
+    platform motion measured by the 3DM-25 accelerometer (Miller et al.,
+    2008). The accelerometer channels are cleaned beforehand (see
+    ``clean_imu``).
 
     Parameters
     ----------
-    station_name: name of the station
-    unrotated_files: list of Pathlib path that contain the files to rotate
+    df : pandas.DataFrame
+        10 Hz data of the half-hour, with the wind components 'Ux', 'Uy',
+        'Uz' and the accelerometer channels.
+    timestamp : str, optional
+        Half-hour of the data. Unused, accepted to be chained with other
+        transforms (see ``hf_transforms.run``).
 
     Returns
     -------
+    df : pandas.DataFrame
+        Data with corrected wind components and cleaned accelerometer
+        channels.
 
     References
     ----------
@@ -59,44 +34,6 @@ def rotate(station_name,unrotated_files):
     over the Open Ocean, Journal of Atmospheric and Oceanic Technology, 25(9),
     1683-1694.
     """
-
-
-    print('Start performing wind correction based on accelerometer data')
-
-    ############################
-    ### Constant declaration ###
-    ############################
-
-    var_dtypes = {
-        'TIMESTAMP':              str,
-        'RECORD':                 np.float64,
-        'Ux':                     np.float64,
-        'Uy':                     np.float64,
-        'Uz':                     np.float64,
-        'T_SONIC':                np.float64,
-        'diag_sonic':             np.float64,
-        'CO2_density':            np.float64,
-        'CO2_density_fast_tmpr':  np.float64,
-        'H2O_density':            np.float64,
-        'diag_irga':              np.float64,
-        'T_SONIC_corr':           np.float64,
-        'TA_1_1_1':               np.float64,
-        'PA':                     np.float64,
-        'CO2_sig_strgth':         np.float64,
-        'H2O_sig_strgth':         np.float64,
-        'accel_x':                np.float64,
-        'accel_y':                np.float64,
-        'accel_z':                np.float64,
-        'ang_rate_x':             np.float64,
-        'ang_rate_y':             np.float64,
-        'ang_rate_z':             np.float64,
-        'roll':                   np.float64,
-        'pitch':                  np.float64,
-        'yaw':                    np.float64,
-        'imu_ahrs_checksum_f':    np.float64}
-    # Note that some variables are int but must be treated as float since
-    # numpy doesn't handle NaN in int, but does for floats.
-
     accel_vars = ['roll', 'pitch', 'yaw',
                   'accel_x', 'accel_y', 'accel_z',
                   'ang_rate_x', 'ang_rate_y', 'ang_rate_z']
@@ -107,166 +44,301 @@ def rotate(station_name,unrotated_files):
     # Gravitational constant
     g = 9.80665
 
-    logf = open(os.path.join('.','Logs','rotate_wind.log'), "w")
-
-    #####################
-    ### Process files ###
-    #####################
-
-    for unrot_file in tqdm(unrotated_files,desc=f'{station_name}: Rotating wind'):
-
-        rotated_file = unrot_file.with_name(
-            unrot_file.name.replace("_eddy.csv", "_eddy_corr.csv"))
-
-        try:
-            # Load file and header
-            df = pd.read_csv(unrot_file,
-                 skiprows=[0,2,3], dtype=var_dtypes,
-                 na_values = "NAN")
-            header = dl.toa5_header(unrot_file,False)
-
-            # Write header to destination file
-            with open(rotated_file, 'w') as fp:
-                for i_line in header:
-                    fp.write(i_line)
-
-            # Pre transformation. IRGASON and accelerometer not in the
-            # same referential frame. Transform wind speeds into
-            # accelerometer frame
-            df['Ux'] = -df['Ux']
-            df['Uy'] = -df['Uy']
-
-            #######################################
-            ### Data cleaning and interpolation ###
-            #######################################
-
-            for iVar in accel_vars:
-
-                # Filtering
-                if iVar in ['roll', 'pitch', 'yaw']:
-                    # Nonsensical values
-                    id_rm = df[iVar].abs() > 2.01*np.pi
-                    df.loc[id_rm,iVar] = np.nan
-                elif iVar in ['accel_x', 'accel_y', 'accel_z',
-                              'ang_rate_x', 'ang_rate_y', 'ang_rate_z']:
-                    # Values that are suspicious (violent mouvement)
-                    id_rm = df[iVar].abs() > 2
-                    df.loc[id_rm,iVar] = np.nan
-
-                if iVar == 'roll':
-                    # Because the accelerometer is mounted upside down, roll values
-                    # are around +/- 2pi. This creates discontinuities with
-                    # detect_spikes. Hence, everything it set back around -2*pi
-                    df.loc[df['roll']>0,'roll'] = df['roll'] - 2*np.pi
-
-                if iVar == ['roll', 'pitch']:
-                    # Values that are suspicious (too far away from horizontal)
-                    id_rm = np.array([np.abs(np.mod(df[iVar],np.pi)),
-                                  np.abs(np.mod(df[iVar],np.pi)-np.pi)]).min(axis=0) > 0.5
-                    df.loc[id_rm,iVar] = np.nan
-
-                # Spike removal
-                id_rm = spikes(df, iVar, 10, 7)
-                df.loc[id_rm,iVar] = np.nan
-
-                # Interpolation
-                df[iVar] = df[iVar].interpolate(method='linear', limit=2)
-
-            # Nullify all accel var if one is missing
-            id_rm = df[accel_vars].isna().any(axis=1)
-            df.loc[id_rm, accel_vars] = np.nan
-
-            # Replace remaining accelerometer NaN values with
-            # 30min average if at least 5 min is available
-            df.loc[id_rm, accel_vars] = df[accel_vars].rolling(
-                window=30*60*10, min_periods=5*60*10,
-                center=True).mean()
-
-            # Replace remaining accelerometer NaN values with
-            # theoretical resting values
-            id_rm = df[accel_vars].isna().any(axis=1)
-            df.loc[id_rm,accel_vars] = 0
-            df.loc[id_rm,'accel_z'] = 1
-            df.loc[id_rm,'roll'] = -np.pi
-
-            ######################
-            ### Initialization ###
-            ######################
-
-            # Timestep (s)
-            dt = 0.1
-
-            # Rotations (rad)
-            phi = (df['roll'] + np.pi).values
-            theta = df['pitch'].values
-            psi = df['yaw'].values
-
-            # Linear acceleration (m/s²)
-            lin_acc = np.array([
-                df['accel_x'].values,
-                df['accel_y'].values,
-                df['accel_z'].values -1
-                ]).transpose() * g
-
-            # Angular rate (rad/s)
-            ang_rate = np.array([
-                df['ang_rate_x'].values,
-                df['ang_rate_y'].values,
-                df['ang_rate_z'].values
-                ]).transpose()
-
-            # Measured wind speed
-            u = np.array([
-                df['Ux'].values,
-                df['Uy'].values,
-                df['Uz'].values
-                ]).transpose()
-
-            # Empty matrix to contain corrected wind speeds
-            u_corr = np.empty((df.shape[0],3))
-
-            for i in range(df.shape[0]):
-
-                ######################################
-                ### Rotation following Miller 2008 ###
-                ######################################
-
-                # x-axis rotation (roll)
-                phi_ = np.array([
-                    [1, 0, 0],
-                    [0, np.cos(phi[i]), -np.sin(phi[i])],
-                    [0, np.sin(phi[i]), np.cos(phi[i])]
-                    ])
-
-                # y-axis rotation (pitch)
-                theta_ = np.array([
-                    [np.cos(theta[i]), 0, np.sin(theta[i])],
-                    [0, 1, 0],
-                    [-np.sin(theta[i]), 0, np.cos(theta[i])]
-                    ])
-
-                # z-axis rotation (yaw)
-                psi_ = np.array([
-                    [np.cos(psi[i]), -np.sin(psi[i]), 0],
-                    [np.sin(psi[i]), np.cos(psi[i]), 0],
-                    [0, 0, 1],
-                    ])
-
-                T_ = psi_ @ theta_ @ phi_
-
-                u_corr[i,:] = T_ @ (u[i,:] + lin_acc[i,:] * dt + ang_rate[i,:] * irga_acc_dist)
-
-            df['Ux'] = -u_corr[:,0]
-            df['Uy'] = -u_corr[:,1]
-            df['Uz'] = u_corr[:,2]
-
-            df.to_csv(rotated_file, header=False, index=False, mode='a', quoting=0)
-
-        except Exception as e:
-            print(str(e))
-            logf.write("Failed to rotate file {0}: {1} \n".format(unrot_file, str(e)))
-
-    # Close error log file
-    logf.close()
-    print('Done!')
+    # Pre transformation. IRGASON and accelerometer not in the
+    # same referential frame. Transform wind speeds into
+    # accelerometer frame
+    df['Ux'] = -df['Ux']
+    df['Uy'] = -df['Uy']
+
+    #######################################
+    ### Data cleaning and interpolation ###
+    #######################################
+
+    df[accel_vars] = clean_imu(df[accel_vars])
+
+    # Replace remaining accelerometer NaN values with
+    # theoretical resting values
+    id_rm = df[accel_vars].isna().any(axis=1)
+    df.loc[id_rm,accel_vars] = 0
+    df.loc[id_rm,'accel_z'] = 1
+    df.loc[id_rm,'roll'] = -np.pi
+
+    ######################
+    ### Initialization ###
+    ######################
+
+    # Timestep (s)
+    dt = 0.1
+
+    # Rotations (rad)
+    phi = (df['roll'] + np.pi).values
+    theta = df['pitch'].values
+    psi = df['yaw'].values
+
+    # Linear acceleration (m/s²)
+    lin_acc = np.array([
+        df['accel_x'].values,
+        df['accel_y'].values,
+        df['accel_z'].values -1
+        ]).transpose() * g
+
+    # Angular rate (rad/s)
+    ang_rate = np.array([
+        df['ang_rate_x'].values,
+        df['ang_rate_y'].values,
+        df['ang_rate_z'].values
+        ]).transpose()
+
+    # Measured wind speed
+    u = np.array([
+        df['Ux'].values,
+        df['Uy'].values,
+        df['Uz'].values
+        ]).transpose()
+
+    ######################################
+    ### Rotation following Miller 2008 ###
+    ######################################
+
+    # Rotation matrices of all samples at once
+    T_ = rotation_matrices(phi, theta, psi)
+
+    u_corr = np.einsum('nij,nj->ni', T_,
+                       u + lin_acc * dt + ang_rate * irga_acc_dist)
+
+    df['Ux'] = -u_corr[:,0]
+    df['Uy'] = -u_corr[:,1]
+    df['Uz'] = u_corr[:,2]
+
+    return df
+
+
+def rotation_matrices(phi, theta, psi):
+    """
+    Rotation matrices from the platform frame to the earth frame, for
+    series of roll, pitch and yaw angles (Miller et al., 2008).
+
+    Each matrix is the closed form of ``psi_ @ theta_ @ phi_``, the
+    successive rotations about the z-axis (yaw), y-axis (pitch) and x-axis
+    (roll).
+
+    Parameters
+    ----------
+    phi : array_like
+        Roll angles (rad).
+    theta : array_like
+        Pitch angles (rad).
+    psi : array_like
+        Yaw angles (rad).
+
+    Returns
+    -------
+    T : ndarray
+        Array of shape (n, 3, 3) with the rotation matrix of each sample.
+    """
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    cos_psi, sin_psi = np.cos(psi), np.sin(psi)
+
+    T = np.empty((np.size(phi), 3, 3))
+    T[:, 0, 0] = cos_psi * cos_theta
+    T[:, 0, 1] = cos_psi * sin_theta * sin_phi - sin_psi * cos_phi
+    T[:, 0, 2] = cos_psi * sin_theta * cos_phi + sin_psi * sin_phi
+    T[:, 1, 0] = sin_psi * cos_theta
+    T[:, 1, 1] = sin_psi * sin_theta * sin_phi + cos_psi * cos_phi
+    T[:, 1, 2] = sin_psi * sin_theta * cos_phi - cos_psi * sin_phi
+    T[:, 2, 0] = -sin_theta
+    T[:, 2, 1] = cos_theta * sin_phi
+    T[:, 2, 2] = cos_theta * cos_phi
+    return T
+
+
+def clean_imu(imu, spike_window=10, spike_z=7, interp_limit=2,
+              fill_window=30*60*10, fill_min_periods=5*60*10):
+    """
+    Clean the 10 Hz IMU channels (3DM-25 accelerometer) before the rotation.
+
+    All channels are processed at once as a 2-D array:
+
+    1. nonsensical angles (> 2.01 pi) and suspicious accelerations and
+       angular rates (> 2, violent movement) are removed;
+    2. roll values are set back around -pi, since the accelerometer is
+       mounted upside down and roll values around +/- pi create
+       discontinuities in the spike detection;
+    3. spikes are removed (see ``spike_mask``);
+    4. gaps are linearly interpolated over at most ``interp_limit`` samples;
+    5. a sample missing in any channel is missing in all of them, and is
+       replaced by the centered rolling mean of each channel when enough
+       samples are available.
+
+    Parameters
+    ----------
+    imu : pandas.DataFrame
+        IMU channels ('roll', 'pitch', 'yaw', 'accel_x', ...), one column
+        each.
+    spike_window : int, optional
+        Window of the moving median of the spike detection (samples).
+    spike_z : float, optional
+        Discrimination factor of the spike detection.
+    interp_limit : int, optional
+        Maximum number of consecutive missing samples to interpolate.
+    fill_window : int, optional
+        Window of the rolling mean used to fill the remaining gaps (samples).
+        The default is 30 min.
+    fill_min_periods : int, optional
+        Minimum number of samples in the window to compute the rolling mean.
+        The default is 5 min.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Cleaned channels, with the index and columns of ``imu``. Samples that
+        could not be filled are NaN.
+    """
+    x = imu.to_numpy(dtype=np.float64, copy=True)
+    columns = list(imu.columns)
+
+    # Nonsensical angles and suspicious accelerations (violent mouvement)
+    is_angle = np.isin(columns, ['roll', 'pitch', 'yaw'])
+    x[np.abs(x) > np.where(is_angle, 2.01*np.pi, 2)] = np.nan
+
+    # Because the accelerometer is mounted upside down, roll values are
+    # around +/- pi. Everything is set back around -pi
+    if 'roll' in columns:
+        roll = x[:, columns.index('roll')]
+        roll[roll > 0] -= 2*np.pi
+
+    x[spike_mask(x, spike_window, spike_z)] = np.nan
+    x = interpolate_gaps(x, interp_limit)
+
+    # Nullify all channels if one is missing, and fill them with the
+    # rolling mean
+    missing = np.isnan(x).any(axis=1)
+    x[missing] = np.nan
+    x[missing] = rolling_nanmean(x, fill_window, fill_min_periods)[missing]
+
+    return pd.DataFrame(x, index=imu.index, columns=imu.columns)
 
+
+def spike_mask(x, window, z):
+    """
+    Detect spikes in each column of a 2-D array, as ``filters.spikes`` does
+    for one series (Papale et al., 2006).
+
+    Missing values are dropped from each column before the detection, like
+    ``filters.spikes`` does, by packing the valid values of each column at
+    its top.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Array of shape (n_samples, n_channels).
+    window : int
+        Window of the centered moving median (samples).
+    z : float
+        Discrimination factor.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array of the shape of ``x``, True for spikes.
+    """
+    order = np.argsort(np.isnan(x), axis=0, kind='stable')
+    packed = np.take_along_axis(x, order, axis=0)
+
+    di = np.full_like(packed, np.nan)
+    di[1:-1] = (packed[1:-1] - packed[:-2]) + (packed[1:-1] - packed[2:])
+
+    # Centered moving median, ignoring missing values (min_periods=1)
+    padded = np.pad(di, ((window//2, window - window//2 - 1), (0, 0)),
+                    constant_values=np.nan)
+    windows = np.sort(sliding_window_view(padded, window, axis=0), axis=-1)
+    cum_count = np.concatenate([np.zeros((1, x.shape[1]), dtype=int),
+                                np.cumsum(~np.isnan(padded), axis=0)])
+    count = cum_count[window:] - cum_count[:-window]
+    lo = np.take_along_axis(windows, np.maximum((count - 1)//2, 0)[..., None], axis=-1)[..., 0]
+    hi = np.take_along_axis(windows, np.maximum(count//2, 0)[..., None], axis=-1)[..., 0]
+    Md = np.where(count > 0, (lo + hi) / 2, np.nan)
+
+    with warnings.catch_warnings():
+        # Channels without data
+        warnings.simplefilter('ignore', RuntimeWarning)
+        MAD = np.nanmedian(np.abs(di - Md), axis=0)
+    lowerBound = Md - (z*MAD / 0.6745)
+    upperBound = Md + (z*MAD / 0.6745)
+    packed_outlier = (di < lowerBound) | (di > upperBound)
+
+    id_outlier = np.zeros(x.shape, dtype=bool)
+    np.put_along_axis(id_outlier, order, packed_outlier, axis=0)
+    return id_outlier
+
+
+def interpolate_gaps(x, limit):
+    """
+    Linearly interpolate the missing values of each column of a 2-D array,
+    over at most ``limit`` consecutive samples after a valid one, as
+    ``pandas.Series.interpolate(method='linear', limit=limit)`` does.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Array of shape (n_samples, n_channels).
+    limit : int
+        Maximum number of consecutive missing samples to fill.
+
+    Returns
+    -------
+    numpy.ndarray
+        Interpolated array.
+    """
+    n = x.shape[0]
+    idx = np.arange(n)[:, None]
+    valid = ~np.isnan(x)
+
+    # Previous and next valid sample of each sample
+    prev = np.maximum.accumulate(np.where(valid, idx, -1), axis=0)
+    nxt = np.minimum.accumulate(np.where(valid, idx, n)[::-1], axis=0)[::-1]
+
+    fill = ~valid & (prev >= 0) & (idx - prev <= limit)
+    x_prev = np.take_along_axis(x, prev.clip(0), axis=0)
+    x_next = np.take_along_axis(x, nxt.clip(max=n-1), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (x_next - x_prev) / (nxt - prev)
+        # Trailing gaps take the last valid value
+        interp = np.where(nxt < n, slope * (idx - prev) + x_prev, x_prev)
+    return np.where(fill, interp, x)
+
+
+def rolling_nanmean(x, window, min_periods):
+    """
+    Centered rolling mean of each column of a 2-D array, ignoring missing
+    values, computed with cumulative sums.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Array of shape (n_samples, n_channels).
+    window : int
+        Window of the rolling mean (samples).
+    min_periods : int
+        Minimum number of valid samples in the window.
+
+    Returns
+    -------
+    numpy.ndarray
+        Rolling mean, NaN where fewer than ``min_periods`` samples are valid.
+    """
+    n = x.shape[0]
+    valid = ~np.isnan(x)
+    zero = np.zeros((1, x.shape[1]))
+    cum_sum = np.concatenate([zero, np.cumsum(np.where(valid, x, 0), axis=0)])
+    cum_count = np.concatenate([zero, np.cumsum(valid, axis=0)])
+
+    # Window of sample i: [i - window//2, i + window - window//2 - 1]
+    i = np.arange(n)
+    start = np.clip(i - window//2, 0, n)
+    stop = np.clip(i + window - window//2, 0, n)
+    count = cum_count[stop] - cum_count[start]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (cum_sum[stop] - cum_sum[start]) / count
+    return np.where(count >= min_periods, mean, np.nan)
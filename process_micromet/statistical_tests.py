@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Despiking and statistical screening tests of Vickers and Mahrt (1997) on
+10 Hz data, for batches of half-hours.
+
+The tests run on arrays of shape (half-hours, samples, variables), missing
+samples being NaN, and return a flag bitmask per half-hour and variable (see
+``FLAGS``) and the despiked series. Parameters are named as in the
+[RawProcess_Tests] and [RawProcess_ParameterSettings] sections of the
+.eddypro files::
+
+    flags, despiked, n_spikes = statistical_tests.screen(
+        x, ['u', 'v', 'w', 'ts', 'co2', 'h2o'], parameters, fs=10)
+    spiky = flags & statistical_tests.FLAGS['spikes'] > 0
+
+Vickers, D. and Mahrt, L. (1997). Quality control and flux sampling
+problems for tower and aircraft data. Journal of Atmospheric and Oceanic
+Technology, 14(3), 512-526.
+"""
+import numpy as np
+
+# Bit of each test in the flags
+FLAGS = {
+    'spikes': 1,
+    'amplitude_resolution': 2,
+    'dropouts': 4,
+    'absolute_limits': 8,
+    'skewness_kurtosis_hf': 16,
+    'skewness_kurtosis_sf': 32,
+    }
+
+# EddyPro defaults of the parameters
+DEFAULT_PARAMETERS = {
+    'test_sr': 1, 'test_ar': 1, 'test_do': 1, 'test_al': 1, 'test_sk': 1,
+    'sr_num_spk': 3, 'sr_lim_u': 3.5, 'sr_lim_w': 5.0, 'sr_lim_co2': 3.5,
+    'sr_lim_h2o': 3.5, 'sr_lim_ch4': 8.0, 'sr_lim_n2o': 8.0, 'sr_lim_hf': 1.0,
+    'ar_lim': 7.0, 'ar_bins': 100, 'ar_hf_lim': 70,
+    'do_extlim_dw': 10, 'do_hf1_lim': 10.0, 'do_hf2_lim': 6.0,
+    'sk_hf_skmin': -2.0, 'sk_hf_skmax': 2.0, 'sk_sf_skmin': -1.0, 'sk_sf_skmax': 1.0,
+    'sk_hf_kumin': 1.0, 'sk_hf_kumax': 8.0, 'sk_sf_kumin': 2.0, 'sk_sf_kumax': 5.0,
+    }
+
+# Spike threshold of each variable, sr_lim_u for the variables not listed
+SPIKE_LIMITS = {'u': 'sr_lim_u', 'v': 'sr_lim_u', 'w': 'sr_lim_w', 'co2': 'sr_lim_co2',
+                'h2o': 'sr_lim_h2o', 'ch4': 'sr_lim_ch4', 'n2o': 'sr_lim_n2o'}
+
+SPIKE_WINDOW = 300          # Moving window of the spike test [s]
+AMPLITUDE_WINDOW = 1000     # Window of the amplitude resolution and dropout tests [samples]
+
+
+def screen(x, variables, parameters, fs, lower=None, upper=None):
+    """
+    Despike a batch of half-hours and run the enabled tests (test_* = 1).
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Series of shape (half-hours, samples, variables).
+    variables : list of str
+        Name of each variable, used to choose its spike threshold.
+    parameters : dict
+        Test parameters, completed by ``DEFAULT_PARAMETERS``.
+    fs : float
+        Acquisition frequency [Hz].
+    lower, upper : numpy.ndarray, optional
+        Absolute limits, broadcastable to (half-hours, variables). The
+        absolute limits test is skipped if not given.
+
+    Returns
+    -------
+    flags : numpy.ndarray
+        Bitmask of the failed tests (see ``FLAGS``), of shape (half-hours,
+        variables).
+    despiked : numpy.ndarray
+        Series with the spikes replaced by linear interpolation, or ``x`` if
+        the spike test is disabled.
+    n_spikes : numpy.ndarray
+        Number of spikes of each half-hour and variable.
+    """
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    n_hh, _, n_vars = x.shape
+    flags = np.zeros((n_hh, n_vars), dtype=np.uint8)
+    n_valid = np.sum(~np.isnan(x), axis=1)
+
+    despiked = x
+    n_spikes = np.zeros((n_hh, n_vars), dtype=int)
+    if p['test_sr']:
+        thresholds = np.array([p[SPIKE_LIMITS.get(v, 'sr_lim_u')] for v in variables])
+        despiked, n_spikes = despike(x, thresholds, int(p['sr_num_spk']),
+                                     int(round(SPIKE_WINDOW * fs)))
+        flags[n_spikes > n_valid * p['sr_lim_hf'] / 100] |= FLAGS['spikes']
+    if p['test_ar'] or p['test_do']:
+        n_bins = int(p['ar_bins'])
+        bins, n_valid_windows = _binned_windows(_rows(despiked), n_bins, p['ar_lim'])
+    if p['test_ar']:
+        failed = _empty_bins(bins, n_valid_windows, n_bins, p['ar_hf_lim'])
+        flags[failed.reshape(n_hh, n_vars)] |= FLAGS['amplitude_resolution']
+    if p['test_do']:
+        failed = _dropouts(bins, n_valid_windows, n_bins, p['do_extlim_dw'],
+                           p['do_hf1_lim'], p['do_hf2_lim'])
+        flags[failed.reshape(n_hh, n_vars)] |= FLAGS['dropouts']
+    if p['test_al'] and lower is not None:
+        outside = outside_limits(despiked, lower, upper).any(axis=1)
+        flags[outside] |= FLAGS['absolute_limits']
+    if p['test_sk']:
+        skewness, kurtosis = skewness_kurtosis(despiked)
+        with np.errstate(invalid='ignore'):
+            hard = ((skewness < p['sk_hf_skmin']) | (skewness > p['sk_hf_skmax'])
+                    | (kurtosis < p['sk_hf_kumin']) | (kurtosis > p['sk_hf_kumax']))
+            soft = ((skewness < p['sk_sf_skmin']) | (skewness > p['sk_sf_skmax'])
+                    | (kurtosis < p['sk_sf_kumin']) | (kurtosis > p['sk_sf_kumax']))
+        flags[hard] |= FLAGS['skewness_kurtosis_hf']
+        flags[soft] |= FLAGS['skewness_kurtosis_sf']
+    return flags, despiked, n_spikes
+
+
+def despike(x, thresholds, max_consecutive, window, max_passes=20, step=0.1):
+    """
+    Spike removal of Vickers and Mahrt (1997): samples further than a
+    threshold times the standard deviation from the mean of a moving window
+    centred on them are spikes, if there are at most ``max_consecutive`` of
+    them in a row. Spikes are replaced by linear interpolation and the test
+    is repeated, with the threshold increased by ``step``, until no spike is
+    found.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Series of shape (half-hours, samples, variables).
+    thresholds : numpy.ndarray
+        Threshold of each variable [standard deviations].
+    max_consecutive : int
+        Maximum number of consecutive outliers counted as spikes.
+    window : int
+        Width of the moving window [samples].
+    max_passes : int, optional
+        Maximum number of passes. The default is 20.
+    step : float, optional
+        Increase of the thresholds at each pass. The default is 0.1.
+
+    Returns
+    -------
+    despiked : numpy.ndarray
+        Despiked series, same shape as ``x``.
+    n_spikes : numpy.ndarray
+        Number of spikes of each half-hour and variable.
+    """
+    n_hh, n, n_vars = x.shape
+    rows = _rows(x)
+    limits = np.tile(np.asarray(thresholds, dtype=float), n_hh)
+    n_spikes = np.zeros(len(rows), dtype=int)
+
+    # Only the series where spikes were found are tested again
+    active = np.arange(len(rows))
+    for _ in range(max_passes):
+        if not active.size:
+            break
+        r = rows[active]
+        mean, std = _moving_mean_std(r, window // 2)
+        with np.errstate(invalid='ignore'):
+            outlier = np.abs(r - mean) > limits[active, None] * std
+        spikes = outlier & (_run_lengths(np.where(outlier, 0, -1)) <= max_consecutive)
+        count = spikes.sum(axis=1)
+        rows[active] = _interpolate(r, spikes)
+        n_spikes[active] += count
+        limits[active] += step
+        active = active[count > 0]
+
+    return _unrows(rows, n_hh, n_vars), n_spikes.reshape(n_hh, n_vars)
+
+
+def amplitude_resolution(x, n_bins, range_sd, max_empty):
+    """
+    Amplitude resolution test: in windows of ``AMPLITUDE_WINDOW`` samples,
+    the values are binned over the smallest of ``range_sd`` standard
+    deviations and their range. The series fails the test if a window has
+    more than ``max_empty`` % of empty bins.
+
+    Returns
+    -------
+    numpy.ndarray
+        True where the test failed, of shape (half-hours, variables).
+    """
+    n_hh, _, n_vars = x.shape
+    bins, n_valid = _binned_windows(_rows(x), n_bins, range_sd)
+    return _empty_bins(bins, n_valid, n_bins, max_empty).reshape(n_hh, n_vars)
+
+
+def dropouts(x, n_bins, range_sd, extreme, max_central, max_extreme):
+    """
+    Dropout test: in the windows and bins of ``amplitude_resolution``, the
+    series fails the test if consecutive values stay in the same bin for
+    more than ``max_central`` % of a window, or ``max_extreme`` % in the
+    bins of the first and last ``extreme`` % of the range.
+
+    Returns
+    -------
+    numpy.ndarray
+        True where the test failed, of shape (half-hours, variables).
+    """
+    n_hh, _, n_vars = x.shape
+    bins, n_valid = _binned_windows(_rows(x), n_bins, range_sd)
+    return _dropouts(bins, n_valid, n_bins, extreme, max_central,
+                     max_extreme).reshape(n_hh, n_vars)
+
+
+def outside_limits(x, lower, upper):
+    """
+    True for the samples outside the absolute limits.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Series of shape (half-hours, samples, variables).
+    lower, upper : numpy.ndarray
+        Limits, broadcastable to (half-hours, variables).
+    """
+    lower = np.broadcast_to(lower, (x.shape[0], x.shape[2]))[:, None, :]
+    upper = np.broadcast_to(upper, (x.shape[0], x.shape[2]))[:, None, :]
+    with np.errstate(invalid='ignore'):
+        return (x < lower) | (x > upper)
+
+
+def skewness_kurtosis(x):
+    """
+    Skewness and kurtosis (not excess) of each half-hour and variable, NaN
+    if less than 2 samples are valid or the variance is 0.
+    """
+    n = np.sum(~np.isnan(x), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(x, axis=1) / n
+        d = np.nan_to_num(x - mean[:, None, :])
+        d2 = d * d
+        m2 = np.sum(d2, axis=1) / n
+        m3 = np.sum(d2 * d, axis=1) / n
+        m4 = np.sum(d2 * d2, axis=1) / n
+        valid = (n > 1) & (m2 > 0)
+        return (np.where(valid, m3 / m2 ** 1.5, np.nan),
+                np.where(valid, m4 / m2 ** 2, np.nan))
+
+
+def _rows(x):
+    """
+    Series of shape (half-hours, samples, variables) as rows of shape
+    (half-hours * variables, samples), half-hour major.
+    """
+    return np.ascontiguousarray(np.moveaxis(x, -1, 1)).reshape(-1, x.shape[1])
+
+
+def _unrows(rows, n_hh, n_vars):
+    """
+    Inverse of ``_rows``.
+    """
+    return np.moveaxis(rows.reshape(n_hh, n_vars, -1), 1, -1)
+
+
+def _moving_mean_std(rows, half_width):
+    """
+    Mean and standard deviation of the valid samples of a window centred on
+    each sample, from cumulative sums.
+    """
+    n = rows.shape[1]
+    valid = ~np.isnan(rows)
+    count = valid.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(count > 0, np.nansum(rows, axis=1, keepdims=True) / count, 0)
+    y = np.where(valid, rows - offset, 0)
+
+    c = np.zeros((len(rows), n + 1))
+    s = np.zeros((len(rows), n + 1))
+    s2 = np.zeros((len(rows), n + 1))
+    np.cumsum(valid, axis=1, out=c[:, 1:])
+    np.cumsum(y, axis=1, out=s[:, 1:])
+    np.cumsum(y ** 2, axis=1, out=s2[:, 1:])
+    i = np.arange(n)
+    lo = np.clip(i - half_width, 0, n)
+    hi = np.clip(i + half_width + 1, 0, n)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k = c[:, hi] - c[:, lo]
+        mean = (s[:, hi] - s[:, lo]) / k
+        var = (s2[:, hi] - s2[:, lo]) / k - mean ** 2
+    return mean + offset, np.sqrt(np.maximum(var, 0))
+
+
+def _run_lengths(values):
+    """
+    Length of the run of consecutive equal values each sample belongs to,
+    for rows of non-negative integers. 0 for negative values.
+    """
+    n_rows, n = values.shape
+    start = np.ones(values.shape, dtype=bool)
+    start[:, 1:] = values[:, 1:] != values[:, :-1]
+    label = np.cumsum(start.ravel()) - 1
+    lengths = np.bincount(label)[label].reshape(n_rows, n)
+    return np.where(values >= 0, lengths, 0)
+
+
+def _interpolate(rows, replace):
+    """
+    Replace samples by linear interpolation between the nearest valid
+    samples that are not replaced, or by the nearest one at the ends.
+    """
+    n = rows.shape[1]
+    keep = ~replace & ~np.isnan(rows)
+    i = np.broadcast_to(np.arange(n), rows.shape)
+    before = np.maximum.accumulate(np.where(keep, i, -1), axis=1)
+    after = np.minimum.accumulate(np.where(keep, i, n)[:, ::-1], axis=1)[:, ::-1]
+    x0 = np.take_along_axis(rows, np.clip(before, 0, n - 1), axis=1)
+    x1 = np.take_along_axis(rows, np.clip(after, 0, n - 1), axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = x0 + (x1 - x0) * (i - before) / (after - before)
+    y = np.where(before < 0, x1, np.where(after >= n, x0, y))
+    y = np.where((before < 0) & (after >= n), np.nan, y)
+    return np.where(replace, y, rows)
+
+
+def _binned_windows(rows, n_bins, range_sd):
+    """
+    Bin of each sample in windows of ``AMPLITUDE_WINDOW`` samples moved by
+    half their width. The bins span ``range_sd`` standard deviations around
+    the mean of the window, or its range if smaller.
+
+    Returns
+    -------
+    bins : numpy.ndarray
+        Bin of each sample, -1 if missing or outside the bins, of shape
+        (rows, windows, window samples).
+    n_valid : numpy.ndarray
+        Number of valid samples of each window, of shape (rows, windows).
+    """
+    n = rows.shape[1]
+    length = min(AMPLITUDE_WINDOW, n)
+    starts = np.arange(0, n - length + 1, max(length // 2, 1))
+    w = rows[:, starts[:, None] + np.arange(length)]
+
+    valid = ~np.isnan(w)
+    n_valid = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(w, axis=-1) / n_valid
+        std = np.sqrt(np.nansum((w - mean[..., None]) ** 2, axis=-1) / n_valid)
+    low = np.min(np.where(valid, w, np.inf), axis=-1)
+    high = np.max(np.where(valid, w, -np.inf), axis=-1)
+
+    # Range of the data if within range_sd standard deviations
+    within = high - low <= range_sd * std
+    width = np.where(within, high - low, range_sd * std)
+    bottom = np.where(within, low, mean - range_sd * std / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b = np.floor((w - bottom[..., None]) / width[..., None] * n_bins)
+    b = np.where(within[..., None] & (w == high[..., None]), n_bins - 1, b)
+    b = np.where((width > 0)[..., None], b, 0)
+    b = np.where(valid & (b >= 0) & (b < n_bins), b, -1)
+    return b.astype(int), n_valid
+
+
+def _empty_bins(bins, n_valid, n_bins, max_empty):
+    """
+    True for the rows with a window of more than ``max_empty`` % of empty
+    bins, among the windows with at least half of their samples valid.
+    """
+    n_rows, n_windows, length = bins.shape
+    window = np.arange(n_rows * n_windows).reshape(n_rows, n_windows, 1)
+    key = (window * n_bins + bins)[bins >= 0]
+    occupied = np.bincount(key, minlength=n_rows * n_windows * n_bins).reshape(
+        n_rows, n_windows, n_bins).astype(bool).sum(axis=-1)
+    empty = 100 * (1 - occupied / n_bins)
+    return ((empty > max_empty) & (n_valid >= length / 2)).any(axis=1)
+
+
+def _dropouts(bins, n_valid, n_bins, extreme, max_central, max_extreme):
+    """
+    True for the rows with a window where consecutive values stay in the
+    same bin for too long, see ``dropouts``.
+    """
+    length = bins.shape[-1]
+    runs = _run_lengths(bins.reshape(-1, length)).reshape(bins.shape)
+    n_extreme = int(round(n_bins * extreme / 100))
+    is_extreme = (bins < n_extreme) | (bins >= n_bins - n_extreme)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        central = 100 * np.max(np.where(is_extreme, 0, runs), axis=-1) / n_valid
+        extremes = 100 * np.max(np.where(is_extreme & (bins >= 0), runs, 0), axis=-1) / n_valid
+    enough = n_valid >= length / 2
+    return (enough & ((central > max_central) | (extremes > max_extreme))).any(axis=1)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Time lags between the vertical wind and the gas analyzer channels, for
+batches of half-hours.
+
+The covariances of all the lags of a window are computed at once with FFT
+cross-correlations, over arrays of shape (half-hours, samples), instead of
+one covariance per lag. Missing samples are excluded pairwise, so that the
+covariance at each lag is the one of the samples valid in both series, as
+with a brute-force search::
+
+    min_lag, max_lag = time_lag.lag_window(metadata_file, 'co2')
+    lag, cov, histogram = time_lag.optimize(w, co2, min_lag, max_lag)
+"""
+import configparser
+import numpy as np
+
+TIME_LAG_METHODS = {0: 'none', 1: 'constant', 2: 'covariance_with_default',
+                    3: 'covariance', 4: 'covariance_with_default'}
+
+
+def lag_window(metadata_file, variable):
+    """
+    Time lag window of a variable in a station metadata file.
+
+    Parameters
+    ----------
+    metadata_file : pathlib.Path
+        Path to the .metadata file.
+    variable : str
+        Name of the variable (col_N_variable), e.g. 'co2'.
+
+    Returns
+    -------
+    min_lag, max_lag : int
+        Bounds of the window [samples].
+    """
+    parser = configparser.ConfigParser(interpolation=None, strict=False)
+    parser.optionxform = str
+    with open(metadata_file, encoding='latin-1') as f:
+        parser.read_string(''.join(line for line in f if not line.startswith(';')))
+    fs = float(parser['Timing']['acquisition_frequency'])
+    description = parser['FileDescription']
+
+    i = 1
+    while f'col_{i}_variable' in description:
+        if description[f'col_{i}_variable'] == variable:
+            return (int(round(float(description[f'col_{i}_min_timelag']) * fs)),
+                    int(round(float(description[f'col_{i}_max_timelag']) * fs)))
+        i += 1
+    raise KeyError(f'No {variable} column in {metadata_file}')
+
+
+def lagged_products(x, y, min_lag, max_lag):
+    """
+    Sums ``sum_t x[t] * y[t + p]`` for the lags p from ``min_lag`` to
+    ``max_lag``, computed with FFTs. Missing samples count as 0.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        Series of shape (half-hours, samples).
+    min_lag, max_lag : int
+        Lag window [samples].
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (half-hours, max_lag - min_lag + 1).
+    """
+    n = x.shape[-1]
+    n_fft = 1 << int(np.ceil(np.log2(n + max(abs(min_lag), abs(max_lag)))))
+    x = np.nan_to_num(x)
+    y = np.nan_to_num(y)
+    r = np.fft.irfft(np.conj(np.fft.rfft(x, n_fft)) * np.fft.rfft(y, n_fft), n_fft)
+    return r[..., np.arange(min_lag, max_lag + 1) % n_fft]
+
+
+def lagged_covariances(x, y, min_lag, max_lag):
+    """
+    Covariances of ``x[t]`` and ``y[t + p]`` for the lags p from ``min_lag``
+    to ``max_lag``, over the pairs of samples valid in both series. NaN if
+    less than 2 pairs.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (half-hours, max_lag - min_lag + 1).
+    """
+    mx = (~np.isnan(x)).astype(float)
+    my = (~np.isnan(y)).astype(float)
+    x = np.nan_to_num(x)
+    y = np.nan_to_num(y)
+
+    n = np.rint(lagged_products(mx, my, min_lag, max_lag))
+    sxy = lagged_products(x, y, min_lag, max_lag)
+    sx = lagged_products(x, my, min_lag, max_lag)
+    sy = lagged_products(mx, y, min_lag, max_lag)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (sxy - sx * sy / n) / (n - 1)
+    return np.where(n > 1, cov, np.nan)
+
+
+def optimize(w, c, min_lag, max_lag):
+    """
+    Lag maximizing the absolute covariance of the vertical wind and a scalar
+    within a lag window, for each half-hour.
+
+    Parameters
+    ----------
+    w, c : numpy.ndarray
+        Fluctuations of the vertical wind and of the scalar, of shape
+        (half-hours, samples). The scalar lags the wind by p samples when
+        ``w[t]`` is paired with ``c[t + p]``.
+    min_lag, max_lag : int
+        Lag window [samples].
+
+    Returns
+    -------
+    lag : numpy.ndarray
+        Optimal lag of each half-hour [samples]. ``min_lag`` if no
+        covariance could be computed.
+    cov : numpy.ndarray
+        Covariance at the optimal lag (NaN if it could not be computed).
+    histogram : numpy.ndarray
+        Number of half-hours with each lag of the window as their optimal
+        lag, from ``min_lag`` to ``max_lag``.
+    """
+    covs = lagged_covariances(w, c, min_lag, max_lag)
+    valid = np.isfinite(covs).any(axis=-1)
+    best = np.argmax(np.where(np.isfinite(covs), np.abs(covs), -1), axis=-1)
+    lag = min_lag + best
+    cov = np.take_along_axis(covs, best[:, None], axis=-1)[:, 0]
+    histogram = np.bincount(best[valid], minlength=max_lag - min_lag + 1)
+    return lag, cov, histogram
+
+
+def find_time_lag(w, c, min_lag, max_lag, default_lag, method, nominal_lag=None):
+    """
+    Time lag [samples] of a scalar on the vertical wind, with the time lag
+    methods of EddyPro (tlag_meth, see ``TIME_LAG_METHODS``).
+
+    Parameters
+    ----------
+    w, c : numpy.ndarray
+        Fluctuations of the vertical wind and of the scalar.
+    min_lag, max_lag, default_lag : int
+        Time lag window and default time lag [samples].
+    method : str
+        'none', 'constant' (nominal time lag), 'covariance' or
+        'covariance_with_default', where the default time lag is used when
+        the maximum is found at an edge of the window.
+    nominal_lag : int, optional
+        Nominal time lag [samples] (col_N_nom_timelag of the metadata), used
+        by the 'constant' method. The default is the middle of the window.
+
+    Returns
+    -------
+    lag : numpy.ndarray
+        Time lag of each half-hour.
+    default : numpy.ndarray
+        True where the default time lag is used.
+    """
+    n_hh = w.shape[0]
+    default = np.zeros(n_hh, dtype=bool)
+    if method == 'none':
+        return np.zeros(n_hh, dtype=int), default
+    if nominal_lag is None:
+        nominal_lag = int(round((min_lag + max_lag) / 2))
+    if method == 'constant':
+        return np.full(n_hh, nominal_lag), default
+    if min_lag >= max_lag:
+        return np.full(n_hh, int(round((min_lag + max_lag) / 2))), default
+
+    lag, cov, _ = optimize(w, c, min_lag, max_lag)
+    if method == 'covariance_with_default':
+        default = np.isfinite(cov) & ((lag == min_lag) | (lag == max_lag))
+        lag = np.where(default, default_lag, lag)
+    return lag, default
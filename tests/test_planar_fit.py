@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from process_micromet import flux_engine
+from process_micromet import planar_fit
+
+
+def test_rotation_matrix_removes_plane():
+    # Winds lying on the plane w = b0 + b1 u + b2 v have no vertical
+    # component once rotated
+    rng = np.random.default_rng(0)
+    for b in ([0, 0, 0.1], [0, 0.1, 0], [0.02, 0.05, -0.08], [-0.01, -0.12, 0.07]):
+        b = np.array(b, dtype=float)
+        u, v = rng.normal(3, 2, 50), rng.normal(-1, 2, 50)
+        w = b[0] + b[1] * u + b[2] * v
+        P = planar_fit.rotation_matrix(b)
+        rotated = P @ np.vstack([u, v, w - b[0]])
+        np.testing.assert_allclose(rotated[2], 0, atol=1e-12)
+        np.testing.assert_allclose(P[2], np.array([-b[1], -b[2], 1]) / np.sqrt(b[1]**2 + b[2]**2 + 1))
+        np.testing.assert_allclose(P @ P.T, np.eye(3), atol=1e-12)
+
+
+def test_rotation_matrix_vectorized():
+    b = np.array([[0, 0.05, -0.08], [0.01, -0.1, 0.03]])
+    P = planar_fit.rotation_matrix(b)
+    assert P.shape == (2, 3, 3)
+    for i in range(2):
+        np.testing.assert_allclose(P[i], planar_fit.rotation_matrix(b[i]))
+
+
+def test_tilt_angles_signs():
+    pitch, roll = planar_fit.tilt_angles(np.array([0, 0.1, 0.1]))
+    assert pitch > 0 and roll > 0
+    pitch, roll = planar_fit.tilt_angles(np.array([0, 0, 0.1]))
+    np.testing.assert_allclose(pitch, 0, atol=1e-12)
+    np.testing.assert_allclose(roll, np.degrees(np.arctan(0.1)))
+
+
+def test_planar_fit_rotation_of_half_hours():
+    # Half-hours of turbulence around winds on the plane have a mean w of 0
+    # after the rotation of flux_engine
+    rng = np.random.default_rng(1)
+    b = np.array([[0.02, 0.06, -0.09], [0.02, 0.06, -0.09]])
+    u = rng.normal(4, 0.5, (2, 1000)) * np.array([[1], [-1]])
+    v = rng.normal(2, 0.5, (2, 1000))
+    w = b[:, [0]] + b[:, [1]] * u + b[:, [2]] * v
+    _, _, w_rot, angles = flux_engine.planar_fit_rotation(u, v, w, b)
+    np.testing.assert_allclose(w_rot, 0, atol=1e-12)
+    np.testing.assert_allclose(angles['pitch'], planar_fit.tilt_angles(b)[0])
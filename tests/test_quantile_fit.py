@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from process_micromet import gas_analyzer
+
+
+def pinball_loss(x, y, q, b, a):
+    r = y - b - a*x
+    return np.sum(r * (q - (r < 0)))
+
+
+def test_quantile_linear_fit_matches_statsmodels():
+    sm = pytest.importorskip('statsmodels.api')
+    # Distance of the IRGASON H2O density to saturation against the air
+    # temperature, with a lower envelope close to zero
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-5, 25, 2000)
+    y = -0.5 + 0.2*x + rng.gamma(2, 1.5, 2000)
+    q = 0.02
+
+    b, a = gas_analyzer.quantile_linear_fit(x, y, q)
+    b_sm, a_sm = sm.QuantReg(y, sm.add_constant(x)).fit(q=q).params
+
+    np.testing.assert_allclose([b, a], [b_sm, a_sm], atol=1e-5)
+    assert pinball_loss(x, y, q, b, a) <= pinball_loss(x, y, q, b_sm, a_sm) + 1e-9
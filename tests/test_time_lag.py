@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from process_micromet import time_lag
+
+
+def test_constant_time_lag_is_nominal():
+    rng = np.random.default_rng(0)
+    w, c = rng.normal(size=(2, 3, 600))
+    lag, default = time_lag.find_time_lag(w, c, 0, 40, 10, 'constant', nominal_lag=12)
+    np.testing.assert_array_equal(lag, 12)
+    assert not default.any()
+    # Middle of the window without a nominal time lag
+    lag, _ = time_lag.find_time_lag(w, c, 0, 40, 10, 'constant')
+    np.testing.assert_array_equal(lag, 20)
+
+
+def test_covariance_time_lag():
+    # c lags w by 7 samples
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(2, 1007))
+    w, c = x[:, 7:], x[:, :-7]
+    lag, default = time_lag.find_time_lag(w, c, 0, 20, 3, 'covariance_with_default', 12)
+    np.testing.assert_array_equal(lag, 7)
+    assert not default.any()
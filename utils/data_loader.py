@@ -6,6 +6,8 @@ Created on Sat Dec 30 17:47:54 2023
 """
 from pathlib import Path
 import yaml
+import mmap
+import numpy as np
 import pandas as pd
 import struct
 import datetime as dt
@@ -294,17 +296,6 @@ def _parse_resolution(res: str):
     return unit, factor
 
 
-def _ticks_to_timedelta(ticks: int, unit: str, factor: int) -> dt.timedelta:
-    if unit == "usec":
-        return dt.timedelta(microseconds=ticks * factor)
-    if unit == "msec":
-        return dt.timedelta(milliseconds=ticks * factor)
-    if unit == "nsec":
-        # datetime supports microseconds; keep floor microseconds
-        return dt.timedelta(microseconds=(ticks * factor) // 1000)
-    raise ValueError(unit)
-
-
 def _parse_interval(s: str) -> dt.timedelta:
     s = s.strip()
     if s == "0":
@@ -368,6 +359,172 @@ def _iter_minor_segments(major_frame: bytes):
         yield seg, foot
 
 
+# Raw NumPy layout of the TOB3 data types. FP2 and the *B / INT / UINT types
+# are stored most significant byte first, the others least significant first.
+_TOB3_NUMPY_DTYPES = {
+    "IEEE4": "<f4", "IEEE4L": "<f4", "IEEE4B": ">f4",
+    "FP2": ">u2",
+    "ULONG": "<u4", "LONG": "<i4", "UINT4": ">u4", "INT4": ">i4",
+    "USHORT": "<u2", "SHORT": "<i2", "UINT2": ">u2", "INT2": ">i2",
+    "BOOL": "u1", "BOOL8": "u1", "BOOL2": "<u2", "BOOL4": "<u4",
+    "SecNano": ("<u4", (2,)), "NSec": ("<u4", (2,)),
+}
+
+
+def _tob3_layout(file):
+    """
+    Parse the 6-line ASCII header of a TOB3 file into the quantities needed to
+    walk its binary frames. Returns None if the header is truncated.
+    """
+    with open(file, "rb") as f:
+        header_lines = []
+        for _ in range(6):
+            line = f.readline().decode("ascii", errors="replace").strip()
+            if not line:
+                # Truncated header or unexpected format
+                return None
+            header_lines.append(line)
+        # Mark the start of the binary region
+        binary_start = f.tell()
+
+    line1 = next(csv_lib.reader([header_lines[0]]))
+    line2 = next(csv_lib.reader([header_lines[1]]))
+    dtypes = next(csv_lib.reader([header_lines[5]]))
+    res_unit, res_factor = _parse_resolution(line2[5])
+
+    return {
+        "binary_start": binary_start,
+        "header_start": dt.datetime.fromisoformat(line1[-1]),
+        "interval": _parse_interval(line2[1]),
+        "frame_size": int(line2[2]),
+        "intended": int(line2[3]),
+        "validation": int(line2[4]),
+        "res_unit": res_unit,
+        "res_factor": res_factor,
+        "field_names": next(csv_lib.reader([header_lines[2]])),
+        "dtypes": dtypes,
+        "record_size": sum(_dtype_size(dt_str) for dt_str in dtypes),
+    }
+
+
+def _tob3_segments(buf, layout):
+    """
+    Locate every valid, non-empty frame segment of a TOB3 binary region.
+
+    Major frames are validated in bulk by reading their headers and footers
+    through a strided structured dtype. Frames whose footer carries the minor
+    frame flag are split with :func:`_iter_minor_segments`.
+
+    Parameters
+    ----------
+    buf : buffer
+        Whole file content (typically a ``mmap.mmap``).
+    layout : dict
+        Output of :func:`_tob3_layout`.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        ``offset`` and ``size`` of each segment in ``buf``, the ``sec``,
+        ``sub`` and ``recno`` fields of its header and its ``footer``, all as
+        int64 and sorted by position in the file.
+    """
+    binary_start = layout["binary_start"]
+    frame_size = layout["frame_size"]
+    validation = layout["validation"]
+
+    n_frames = max((len(buf) - binary_start) // frame_size, 0)
+    frame_dtype = np.dtype({
+        "names": ["sec", "sub", "recno", "footer"],
+        "formats": ["<u4"] * 4,
+        "offsets": [0, 4, 8, frame_size - 4],
+        "itemsize": frame_size})
+    frames = np.frombuffer(buf, dtype=frame_dtype, count=n_frames,
+                           offset=binary_start)
+
+    # Validate major frames via footer stamp
+    footer = frames["footer"].astype(np.int64)
+    vstamp = (footer >> 16) & 0xFFFF
+    is_valid = (vstamp == validation) | (vstamp == validation ^ 0xFFFF)
+    is_minor = is_valid & (((footer >> 15) & 1) == 1)
+    is_major = is_valid & ~is_minor
+
+    id_major = np.flatnonzero(is_major)
+    segments = {
+        "offset": binary_start + id_major.astype(np.int64) * frame_size,
+        "size": np.full(id_major.size, frame_size, dtype=np.int64),
+        "sec": frames["sec"][id_major].astype(np.int64),
+        "sub": frames["sub"][id_major].astype(np.int64),
+        "recno": frames["recno"][id_major].astype(np.int64),
+        "footer": footer[id_major],
+    }
+    del frames
+
+    # Walk the (rare) major frames made of several minor frames
+    minor_rows = []
+    for i_frame in np.flatnonzero(is_minor):
+        frame_start = binary_start + int(i_frame) * frame_size
+        major = buf[frame_start:frame_start + frame_size]
+        minor_segments = list(_iter_minor_segments(major))
+        position = frame_start + frame_size - sum(len(s) for s, _ in minor_segments)
+        for seg, foot in minor_segments:
+            if len(seg) >= 12:
+                sec, sub, recno = struct.unpack("<III", seg[:12])
+                minor_rows.append((position, len(seg), sec, sub, recno, foot))
+            position += len(seg)
+
+    if minor_rows:
+        minor_rows = np.array(minor_rows, dtype=np.int64)
+        for i_key, key in enumerate(["offset", "size", "sec", "sub", "recno", "footer"]):
+            segments[key] = np.concatenate([segments[key], minor_rows[:, i_key]])
+        order = np.argsort(segments["offset"], kind="stable")
+        segments = {key: values[order] for key, values in segments.items()}
+
+    # Discard empty frames and frames too short to hold a record
+    empty_flag = (segments["footer"] >> 14) & 1
+    keep = (empty_flag == 0) & (segments["size"] >= 16)
+    return {key: values[keep] for key, values in segments.items()}
+
+
+def _ticks_to_nanoseconds(ticks, unit, factor):
+    """Convert frame sub-second ticks (scalar or array) to nanoseconds."""
+    ns_per_tick = {"usec": 1_000, "msec": 1_000_000, "nsec": 1}[unit] * factor
+    return np.asarray(ticks, dtype=np.int64) * ns_per_tick
+
+
+def _decode_tob3_field(values, dtype_str):
+    """
+    Convert the raw values of one TOB3 field into their physical value.
+    """
+    dtype_str = dtype_str.strip()
+    if dtype_str in ("IEEE4", "IEEE4L", "IEEE4B"):
+        return values.astype(np.float32)
+    if dtype_str == "FP2":
+        # Campbell 2-byte float: sign bit, 2-bit negative decimal exponent and
+        # 13-bit mantissa
+        raw = values.astype(np.int64)
+        sign = np.where(raw & 0x8000, -1.0, 1.0)
+        exponent = (raw >> 13) & 0x3
+        mantissa = raw & 0x1FFF
+        decoded = sign * mantissa / 10.0 ** exponent
+        # Reserved codes for +/-INF and NAN
+        id_inf = (exponent == 0) & (mantissa == 8191)
+        decoded[id_inf] = sign[id_inf] * np.inf
+        decoded[(exponent == 0) & (mantissa == 8190)] = np.nan
+        return decoded
+    if dtype_str.startswith("BOOL"):
+        # Campbell loggers report True as -1
+        return np.where(values != 0, -1, 0).astype(np.int8)
+    if dtype_str in ("SecNano", "NSec"):
+        epoch = np.datetime64("1990-01-01T00:00:00", "ns")
+        return (epoch
+                + values[:, 0].astype("timedelta64[s]").astype("timedelta64[ns]")
+                + values[:, 1].astype("timedelta64[ns]"))
+    if dtype_str.startswith("ASCII"):
+        return np.char.decode(values, "latin1").astype(object)
+    return values.astype(np.int64)
+
+
 def tob3_first_last_timestamp(
     file: str,
     future_guard_days: int = 1,
@@ -376,7 +533,9 @@ def tob3_first_last_timestamp(
     """
     Returns (first_ts, last_ts) from TOB3 file frames.
 
-    Two-pass strategy:
+    The file is memory-mapped and all frame headers and footers are extracted
+    in a single pass as NumPy arrays (see :func:`_tob3_segments`). Both
+    timestamps are then derived with array operations:
       1) Find a robust *anchor* (first_dt) using the earliest plausible frame
          timestamp close to the table's header start datetime.
          - Option A: The anchor is restricted to a window centered on the
@@ -408,6 +567,7 @@ def tob3_first_last_timestamp(
 
     # Campbell Scientific epoch
     epoch = dt.datetime(1990, 1, 1)
+    one_us = dt.timedelta(microseconds=1)
 
     file = Path(file)
     # Check if file is empty
@@ -418,33 +578,23 @@ def tob3_first_last_timestamp(
         raise
 
     # Read the 6 ASCII header lines
-    with open(file, "rb") as f:
-        header_lines = []
-        for _ in range(6):
-            line = f.readline().decode("ascii", errors="replace").strip()
-            if not line:
-                # Truncated header or unexpected format
-                return None
-            header_lines.append(line)
-        # Mark the start of the binary region
-        binary_start = f.tell()
+    layout = _tob3_layout(file)
+    if layout is None:
+        return None
 
-    # Parse line 1 to get the table start datetime (last CSV field)
-    line1_fields = next(csv_lib.reader([header_lines[0]]))
-    # Expecting something like "YYYY-mm-dd HH:MM:SS"
-    header_start = dt.datetime.fromisoformat(line1_fields[-1])
+    header_start = layout["header_start"]
+    interval = layout["interval"]
+    intended = layout["intended"]
+    record_size = layout["record_size"]
 
-    # Parse line 2 to get Interval, FrameSize, Intended, Validation, Resolution
-    line2 = next(csv_lib.reader([header_lines[1]]))
-    interval = _parse_interval(line2[1])                 # "100 MSEC" -> timedelta
-    frame_size = int(line2[2])                           # major frame size in bytes
-    intended = int(line2[3])                             # intended records count (nominal)
-    validation = int(line2[4])                           # validation stamp
-    res_unit, res_factor = _parse_resolution(line2[5])   # e.g., "Sec100Usec"
+    # Extract every frame header/footer in one pass over the binary region
+    with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        segments = _tob3_segments(buf, layout)
 
-    # Parse line 6 to compute one-record payload size
-    dtypes = next(csv_lib.reader([header_lines[5]]))
-    record_size = sum(_dtype_size(dt_str) for dt_str in dtypes)
+    # Frame timestamps, in microseconds since the Campbell epoch
+    frame_us = (segments["sec"] * 1_000_000
+                + _ticks_to_nanoseconds(segments["sub"], layout["res_unit"],
+                                        layout["res_factor"]) // 1000)
 
     now_utc = dt.datetime.now()
 
@@ -454,53 +604,25 @@ def tob3_first_last_timestamp(
     anchor_max = header_start + dt.timedelta(days=add_window_days)
 
     # ------------------------------------------------------------------------------------
-    # PASS 1: Find FIRST RECORD TIMESTAMP (robust anchor)
+    # Find FIRST RECORD TIMESTAMP (robust anchor)
     # ------------------------------------------------------------------------------------
-    first_dt = None                 # anchor restricted to header window
-    first_dt_any = None             # fallback: global minimum plausible dt
-
-    with open(file, "rb") as f:
-        f.seek(binary_start)
-        while True:
-            major = f.read(frame_size)
-            if len(major) < frame_size:
-                break
-
-            # Validate major frame via footer stamp
-            major_footer = struct.unpack("<I", major[-4:])[0]
-            vstamp = (major_footer >> 16) & 0xFFFF
-            if vstamp not in (validation, validation ^ 0xFFFF):
-                continue
-
-            # Walk (possibly multiple) minor segments within this major frame
-            for seg, foot in _iter_minor_segments(major):
-                empty_flag = (foot >> 14) & 1
-                if empty_flag or len(seg) < 16:
-                    continue
-
-                # Frame header: sec (4), sub (4), recno (4)
-                sec, sub, _recno0 = struct.unpack("<III", seg[:12])
-                dt0 = epoch + dt.timedelta(seconds=sec) + _ticks_to_timedelta(sub, res_unit, res_factor)
-
-                # Guard against far-future frames
-                if dt0 > now_utc + dt.timedelta(days=future_guard_days):
-                    continue
-
-                # Track the global minimum (previous behavior) for fallback
-                if first_dt_any is None or dt0 < first_dt_any:
-                    first_dt_any = dt0
-
-                # NEW: restrict the *anchor* to the header-based time window
-                if anchor_min <= dt0 <= anchor_max:
-                    if first_dt is None or dt0 < first_dt:
-                        first_dt = dt0
-
-    # Fallback if no anchor was found within the header window
-    if first_dt is None:
-        first_dt = first_dt_any
-
-    # If we still don't have an anchor, we can't proceed
-    if first_dt is None:
+    # Guard against far-future frames
+    future_limit = (now_utc + dt.timedelta(days=future_guard_days) - epoch) // one_us
+    plausible_us = frame_us[frame_us <= future_limit]
+
+    # Restrict the *anchor* to the header-based time window
+    in_anchor_window = (
+        (plausible_us >= (anchor_min - epoch) // one_us)
+        & (plausible_us <= (anchor_max - epoch) // one_us))
+
+    if in_anchor_window.any():
+        first_dt = epoch + dt.timedelta(microseconds=int(plausible_us[in_anchor_window].min()))
+    elif plausible_us.size:
+        # Fallback on the global minimum if no anchor was found within the
+        # header window
+        first_dt = epoch + dt.timedelta(microseconds=int(plausible_us.min()))
+    else:
+        # If we still don't have an anchor, we can't proceed
         return None, None
 
     # ------------------------------------------------------------------------------------
@@ -519,45 +641,24 @@ def tob3_first_last_timestamp(
     )
 
     # ------------------------------------------------------------------------------------
-    # PASS 2: Find LAST RECORD TIMESTAMP within plausible window
+    # Find LAST RECORD TIMESTAMP within plausible window
     # ------------------------------------------------------------------------------------
+    # Compute number of full records in each segment
+    data_len = segments["size"] - 12 - 4  # header (12) + footer (4)
+    nrec = data_len // record_size if record_size > 0 else np.zeros_like(data_len)
+    has_records = nrec > 0
+
+    # Last record time in each segment
+    last_us = frame_us[has_records] + (nrec[has_records] - 1) * (interval // one_us)
+
+    # Keep only plausible last times
+    last_us = last_us[
+        (last_us >= (earliest_allowed - epoch) // one_us)
+        & (last_us <= (latest_allowed - epoch) // one_us)]
+
     last_dt = None
-    with open(file, "rb") as f:
-        f.seek(binary_start)
-        while True:
-            major = f.read(frame_size)
-            if len(major) < frame_size:
-                break
-
-            # Validate major frame via footer stamp
-            major_footer = struct.unpack("<I", major[-4:])[0]
-            vstamp = (major_footer >> 16) & 0xFFFF
-            if vstamp not in (validation, validation ^ 0xFFFF):
-                continue
-
-            for seg, foot in _iter_minor_segments(major):
-                empty_flag = (foot >> 14) & 1
-                if empty_flag or len(seg) < 16:
-                    continue
-
-                sec, sub, _recno0 = struct.unpack("<III", seg[:12])
-                dt0 = epoch + dt.timedelta(seconds=sec) + _ticks_to_timedelta(sub, res_unit, res_factor)
-
-                # Compute number of full records in this segment
-                data_len = len(seg) - 12 - 4  # header (12) + footer (4)
-                nrec = data_len // record_size if record_size > 0 else 0
-                if nrec <= 0:
-                    continue
-
-                # Last record time in this segment:
-                dt_last = dt0 if interval.total_seconds() == 0 else dt0 + (nrec - 1) * interval
-
-                # Keep only plausible last times
-                if not (earliest_allowed <= dt_last <= latest_allowed):
-                    continue
-
-                if last_dt is None or dt_last > last_dt:
-                    last_dt = dt_last
+    if last_us.size:
+        last_dt = epoch + dt.timedelta(microseconds=int(last_us.max()))
 
     return first_dt, last_dt
 
@@ -612,4 +713,89 @@ def tob3_header(file,clean=True):
         parts = [p.strip().strip('"') for p in parts]
         cleaned_header.append(parts)
 
-    return cleaned_header
\ No newline at end of file
+    return cleaned_header
+
+
+def read_tob3(file, drop_duplicates=True):
+    """
+    Decode a Campbell Scientific TOB3 file into a DataFrame, without going
+    through an intermediate TOA5 file.
+
+    The file is memory-mapped, frames are validated in bulk from their
+    footers, and the records of all valid frames are decoded at once with a
+    structured NumPy dtype built from the header data types (IEEE4, FP2,
+    ULONG, SecNano, ...). Record timestamps are the frame timestamp plus the
+    record position times the table interval.
+
+    The output mimics :func:`toa5_file` applied to the TOA5 conversion of the
+    file: 'timestamp' index, a 'RECORD' column followed by the table fields.
+
+    Parameters
+    ----------
+    file : str or pathlib.Path
+        Path to a TOB3 file.
+    drop_duplicates : Bool, optional
+        Drop duplicated time index. The default is True
+
+    Returns
+    -------
+    df : Pandas DataFrame or None
+        Decoded records sorted in time, or None if the file is empty or its
+        header is truncated.
+    """
+    file = Path(file)
+
+    # Check if file is empty
+    try:
+        if file.stat().st_size == 0:
+            return None
+    except FileNotFoundError:
+        raise
+
+    layout = _tob3_layout(file)
+    if layout is None:
+        return None
+
+    dtypes = [d.strip() for d in layout["dtypes"]]
+    record_size = layout["record_size"]
+    record_dtype = np.dtype({
+        "names": [f"f{i}" for i in range(len(dtypes))],
+        "formats": [_TOB3_NUMPY_DTYPES.get(d, f"S{_dtype_size(d)}")
+                    for d in dtypes]})
+    if record_dtype.itemsize != record_size:
+        raise ValueError(f"Unsupported TOB3 data types: {dtypes}")
+
+    interval_ns = layout["interval"] // dt.timedelta(microseconds=1) * 1000
+
+    with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        segments = _tob3_segments(buf, layout)
+        nrec = (segments["size"] - 16) // record_size
+
+        records = []
+        for offset, n in zip(segments["offset"], nrec):
+            if n > 0:
+                records.append(np.frombuffer(
+                    buf, dtype=record_dtype, count=int(n), offset=int(offset) + 12))
+        records = (np.concatenate(records) if records
+                   else np.empty(0, dtype=record_dtype))
+
+    # Timestamp and record number of each record
+    keep = nrec > 0
+    nrec = nrec[keep]
+    first_record = np.repeat(np.cumsum(nrec) - nrec, nrec)
+    position = np.arange(nrec.sum(), dtype=np.int64) - first_record
+    frame_ns = (segments["sec"][keep] * 1_000_000_000
+                + _ticks_to_nanoseconds(segments["sub"][keep],
+                                        layout["res_unit"], layout["res_factor"]))
+    timestamps = (np.datetime64("1990-01-01T00:00:00", "ns")
+                  + (np.repeat(frame_ns, nrec) + position * interval_ns).astype("timedelta64[ns]"))
+
+    data = {"RECORD": np.repeat(segments["recno"][keep], nrec) + position}
+    for i, (name, dtype_str) in enumerate(zip(layout["field_names"], dtypes)):
+        data[name] = _decode_tob3_field(records[f"f{i}"], dtype_str)
+
+    df = pd.DataFrame(data, index=pd.DatetimeIndex(timestamps, name="timestamp"))
+    df = df.sort_index(kind="stable")
+    if drop_duplicates:
+        df = df[~df.index.duplicated(keep='last')]
+    return df